@@ -0,0 +1,237 @@
+import os
+import json
+import math
+import time
+import uuid
+import fcntl
+import logging
+from contextlib import contextmanager
+
+# Counters exposed by get_stats
+COUNTER_NAMES = ('admitted', 'released', 'rejected_session', 'rejected_address', 'rejected_global', 'rejected_rate')
+# Prefix of the token bucket keys of client addresses (sessions use their id)
+ADDRESS_KEY_PREFIX = 'address:'
+
+class AdmissionDenied(Exception):
+    """Raised when a request is rejected by admission control."""
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+@contextmanager
+def _locked_state(state_path):
+    """
+    Lock the shared admission state and yield it for reading and updating.
+
+    The state lives in a small JSON file guarded by an exclusive flock, so
+    every gunicorn worker (and every thread) sees the same counters without
+    an external service. Changes to the yielded dict are written back.
+    """
+    with open(state_path, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            content = f.read()
+            try:
+                state = json.loads(content) if content else {}
+            except ValueError:
+                logging.error("Corrupted admission state, resetting it")
+                state = {}
+            state.setdefault('leases', {})
+            state.setdefault('buckets', {})
+            state.setdefault('counters', {})
+            for name in COUNTER_NAMES:
+                state['counters'].setdefault(name, 0)
+
+            try:
+                yield state
+            finally:
+                # Rejections update counters too, so write back even on AdmissionDenied
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def _process_alive(pid):
+    """Check whether a process still exists."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def _reap_leases(state, now):
+    """Drop leases of crashed workers and leases that outlived the longest deadline."""
+    for lease_id, lease in list(state['leases'].items()):
+        if lease['expires'] < now or not _process_alive(lease['pid']):
+            del state['leases'][lease_id]
+
+def request_cost(app_config, quantization_mode, max_resolution):
+    """
+    Compute the admission cost of a processing request.
+
+    The cost grows with the weight of the quantization mode and linearly
+    with the longest side of the requested resolution (128 px = 1x).
+
+    Args:
+        app_config: The Flask app configuration.
+        quantization_mode: The selected quantization mode.
+        max_resolution: The requested resolution as a 'width,height' string.
+
+    Returns:
+        The cost in admission tokens.
+    """
+    weight = app_config['ADMISSION_MODE_COSTS'].get(quantization_mode, 1)
+    try:
+        longest_side = max(int(value) for value in str(max_resolution).split(','))
+    except ValueError:
+        longest_side = 512
+    return weight * max(1.0, longest_side / 128)
+
+def _refill(state, key, bucket_size, refill_rate, now):
+    """Get the tokens of a bucket, refilled for the time since its last request."""
+    bucket = state['buckets'].get(key, {'tokens': bucket_size, 'updated': now})
+    return min(bucket_size, bucket['tokens'] + (now - bucket['updated']) * refill_rate)
+
+def acquire(app_config, client_key, cost, address=None):
+    """
+    Admit a request or reject it immediately.
+
+    A request is admitted when the client has fewer than
+    ADMISSION_MAX_CONCURRENT_PER_CLIENT requests in flight, the total cost in
+    flight stays within ADMISSION_GLOBAL_CAPACITY, and the client's token
+    bucket holds enough tokens to pay for the request. A client that drops
+    its session cookie gets a new session, so the client's address has a
+    concurrency limit (ADMISSION_MAX_CONCURRENT_PER_ADDRESS) and a token
+    bucket of its own as well, sized for several sessions behind one address.
+
+    Args:
+        app_config: The Flask app configuration.
+        client_key: The session id of the client.
+        cost: The cost of the request, see request_cost.
+        address: The client's address, or None.
+
+    Returns:
+        A lease id to pass to release().
+
+    Raises:
+        AdmissionDenied: If the request is rejected.
+    """
+    now = time.time()
+    # A request costing more than a full bucket or the whole server could never be admitted
+    cost = min(cost, app_config['ADMISSION_BUCKET_SIZE'], app_config['ADMISSION_GLOBAL_CAPACITY'])
+    # (key, bucket size, refill rate) of the buckets paying for the request
+    buckets = [(client_key, app_config['ADMISSION_BUCKET_SIZE'], app_config['ADMISSION_REFILL_RATE'])]
+    if address:
+        buckets.append((
+            f"{ADDRESS_KEY_PREFIX}{address}",
+            app_config['ADMISSION_ADDRESS_BUCKET_SIZE'],
+            app_config['ADMISSION_ADDRESS_REFILL_RATE']
+        ))
+
+    with _locked_state(app_config['ADMISSION_STATE_PATH']) as state:
+        _reap_leases(state, now)
+        counters = state['counters']
+        leases = state['leases'].values()
+
+        client_leases = sum(1 for lease in leases if lease['client'] == client_key)
+        if client_leases >= app_config['ADMISSION_MAX_CONCURRENT_PER_CLIENT']:
+            counters['rejected_session'] += 1
+            raise AdmissionDenied("Too many requests in progress for this session", app_config['ADMISSION_RETRY_AFTER'])
+
+        if address:
+            address_leases = sum(1 for lease in leases if lease.get('address') == address)
+            if address_leases >= app_config['ADMISSION_MAX_CONCURRENT_PER_ADDRESS']:
+                counters['rejected_address'] += 1
+                raise AdmissionDenied("Too many requests in progress from this address", app_config['ADMISSION_RETRY_AFTER'])
+
+        cost_in_flight = sum(lease['cost'] for lease in leases)
+        if cost_in_flight + cost > app_config['ADMISSION_GLOBAL_CAPACITY']:
+            counters['rejected_global'] += 1
+            raise AdmissionDenied("The server is busy", app_config['ADMISSION_RETRY_AFTER'])
+
+        # Refill the client's token buckets for the time since its last request
+        tokens = [_refill(state, key, bucket_size, refill_rate, now) for key, bucket_size, refill_rate in buckets]
+        for (key, _, refill_rate), bucket_tokens in zip(buckets, tokens):
+            if bucket_tokens < cost:
+                counters['rejected_rate'] += 1
+                for (other_key, _, _), other_tokens in zip(buckets, tokens):
+                    state['buckets'][other_key] = {'tokens': other_tokens, 'updated': now}
+                raise AdmissionDenied("Rate limit exceeded", math.ceil((cost - bucket_tokens) / refill_rate))
+        for (key, _, _), bucket_tokens in zip(buckets, tokens):
+            state['buckets'][key] = {'tokens': bucket_tokens - cost, 'updated': now}
+
+        # Forget buckets that have been full for a while
+        session_idle_after = app_config['ADMISSION_BUCKET_SIZE'] / app_config['ADMISSION_REFILL_RATE']
+        address_idle_after = app_config['ADMISSION_ADDRESS_BUCKET_SIZE'] / app_config['ADMISSION_ADDRESS_REFILL_RATE']
+        for key, idle_bucket in list(state['buckets'].items()):
+            idle_after = address_idle_after if key.startswith(ADDRESS_KEY_PREFIX) else session_idle_after
+            if now - idle_bucket['updated'] > idle_after:
+                del state['buckets'][key]
+
+        lease_id = uuid.uuid4().hex
+        state['leases'][lease_id] = {
+            'client': client_key,
+            'address': address,
+            'cost': cost,
+            'pid': os.getpid(),
+            'expires': now + app_config['ADMISSION_LEASE_TIMEOUT']
+        }
+        counters['admitted'] += 1
+
+    return lease_id
+
+def release(app_config, lease_id):
+    """
+    Release the concurrency slot of an admitted request.
+
+    Args:
+        app_config: The Flask app configuration.
+        lease_id: The lease id returned by acquire().
+    """
+    if not lease_id:
+        return
+    try:
+        with _locked_state(app_config['ADMISSION_STATE_PATH']) as state:
+            if state['leases'].pop(lease_id, None) is not None:
+                state['counters']['released'] += 1
+    except Exception as e:
+        logging.error(f"Error releasing admission lease: {str(e)}")
+
+@contextmanager
+def admitted(app_config, client_key, cost, address=None):
+    """Hold an admission lease for the duration of a with block."""
+    lease_id = acquire(app_config, client_key, cost, address)
+    try:
+        yield lease_id
+    finally:
+        release(app_config, lease_id)
+
+def get_stats(app_config):
+    """
+    Get the admission counters and the current load.
+
+    Args:
+        app_config: The Flask app configuration.
+
+    Returns:
+        A dict of counters, requests and cost in flight, and the limits.
+    """
+    with _locked_state(app_config['ADMISSION_STATE_PATH']) as state:
+        _reap_leases(state, time.time())
+        leases = list(state['leases'].values())
+        return {
+            'counters': dict(state['counters']),
+            'in_flight': len(leases),
+            'cost_in_flight': sum(lease['cost'] for lease in leases),
+            'active_clients': len({lease['client'] for lease in leases}),
+            'active_addresses': len({lease.get('address') for lease in leases if lease.get('address')}),
+            'global_capacity': app_config['ADMISSION_GLOBAL_CAPACITY'],
+            'max_concurrent_per_client': app_config['ADMISSION_MAX_CONCURRENT_PER_CLIENT'],
+            'max_concurrent_per_address': app_config['ADMISSION_MAX_CONCURRENT_PER_ADDRESS']
+        }
@@ -1,10 +1,14 @@
 import os
 import logging
+import sqlite3
 
 from flask import Flask, session
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import DeclarativeBase
 from werkzeug.utils import secure_filename
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -24,12 +28,30 @@ app.secret_key = os.environ.get("SESSION_SECRET", "pixel-art-secret-key")
 from config import get_config
 app.config.from_object(get_config())
 
+# Behind reverse proxies, take the client address from X-Forwarded-For
+# (admission control limits each address)
+if app.config['TRUSTED_PROXY_COUNT']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXY_COUNT'])
+
 # Configure SQLAlchemy engine options
 app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
     "pool_recycle": 300,
     "pool_pre_ping": True,
 }
 
+# Use WAL journaling for SQLite so concurrent readers (downloads) never block
+# on the single writer (uploads), and let writers wait instead of failing
+@event.listens_for(Engine, "connect")
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    """Apply SQLite pragmas to every new pooled connection."""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={app.config['SQLITE_BUSY_TIMEOUT_MS']}")
+    cursor.close()
+
 # Set an appropriate session timeout (1 day by default)
 app.config['PERMANENT_SESSION_LIFETIME'] = 86400  # 24 hours in seconds
 
@@ -37,6 +59,7 @@ app.config['PERMANENT_SESSION_LIFETIME'] = 86400  # 24 hours in seconds
 os.makedirs(app.config['UPLOADED_PHOTOS_DEST'], exist_ok=True)
 os.makedirs(app.config['UPLOADED_PALETTES_DEST'], exist_ok=True)
 os.makedirs(app.config['PROCESSED_IMAGES_DEST'], exist_ok=True)
+os.makedirs(app.config['CANCEL_FLAGS_DEST'], exist_ok=True)
 
 # Initialize the app with the database
 db.init_app(app)
@@ -51,15 +74,21 @@ with app.app_context():
     from routes import register_routes
     register_routes(app)
     
-    # Load palettes from the palettes directory into memory
-    from import_palettes import main as import_palettes
-    import_palettes()
-    
     # Import session manager
     import session_manager
     
-    # Clean temporary directories on startup
+    # Clean temporary directories on startup, before loading the palettes:
+    # temporary palettes left by a previous run would otherwise be loaded as
+    # built-in palettes whose files are then removed
     session_manager.cleanup_temp_directories(app.config)
+    
+    # Load palettes from the palettes directory into memory
+    from import_palettes import main as import_palettes
+    import_palettes()
+    
+    # Drop records whose processed files have expired
+    purged = models.ProcessedImage.purge_expired(app.config['PROCESSED_IMAGE_TTL'])
+    logging.debug(f"Purged {purged} expired processed image records")
 
 # Register session cleanup when the app closes a request
 @app.teardown_request
@@ -0,0 +1,260 @@
+"""
+ASGI entry point: uvicorn asgi:app --host 0.0.0.0 --port 5000
+
+Serves the Flask app with three differences from the WSGI deployment:
+
+- Request bodies are received on the event loop before a thread runs the
+  Flask view, so slow uploads hold no thread while they trickle in.
+- Image processing is offloaded to a process pool (see processing_pool.py);
+  the threads running Flask views mostly wait on it.
+- The first page of /palettes and /palette/<id> are answered from JSON
+  built at startup (with their ETags), without entering Flask.
+
+Run a single uvicorn process; ASGI_POOL_WORKERS sets the number of
+processing processes (default: one per core).
+"""
+import os
+import re
+import sys
+import json
+import asyncio
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.http import parse_etags, quote_etag
+
+from app import app as flask_app
+from palette_manager import get_all_palettes
+import processing_pool
+import shared_arrays
+import warmup
+
+# Threads running Flask views; they mostly wait on the process pool or the network
+WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', 32))
+# Request bodies larger than this are spooled to disk while they are received
+BODY_SPOOL_BYTES = 1024 * 1024
+
+_threads = ThreadPoolExecutor(max_workers=WSGI_THREADS, thread_name_prefix='wsgi')
+_palette_pattern = re.compile(r'^/palette/([^/]+)$')
+_palette_responses = {}  # path -> (JSON body, ETag) of the built-in palette endpoints
+
+def build_palette_responses():
+    """
+    Render the built-in palette endpoints, which do not change while the app runs.
+
+    The Flask views render them, so bodies and ETags match the WSGI deployment.
+
+    Returns:
+        A dict mapping paths to (body, ETag) tuples.
+    """
+    responses = {}
+    with flask_app.test_request_context():
+        # Without a session, only the built-in palettes are listed
+        requests = [('/palettes', 'get_palettes', {})]
+        requests += [(f"/palette/{palette.id}", 'get_palette', {'palette_id': palette.id}) for palette in get_all_palettes()]
+    for path, endpoint, view_args in requests:
+        with flask_app.test_request_context(path):
+            try:
+                response = flask_app.make_response(flask_app.view_functions[endpoint](**view_args))
+            except Exception as e:
+                logging.error(f"Error caching {path}: {str(e)}")
+                continue
+            if response.status_code == 200:
+                responses[path] = (response.get_data(), response.get_etag()[0])
+    return responses
+
+async def _send_response(send, status, body, content_type=b'application/json', headers=()):
+    """Send a complete response."""
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type), (b'content-length', str(len(body)).encode())] + list(headers)
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+def _has_session(scope):
+    """Check whether the request carries a session cookie (and may see session palettes)."""
+    cookie_name = flask_app.config.get('SESSION_COOKIE_NAME', 'session').encode()
+    return any(name == b'cookie' and cookie_name + b'=' in value for name, value in scope['headers'])
+
+async def _serve_cached(scope, send):
+    """
+    Answer the built-in palette endpoints from memory.
+
+    Returns:
+        True if the request was answered.
+    """
+    if scope['method'] not in ('GET', 'HEAD'):
+        return False
+    path = scope['path']
+    if path == '/palettes' and _has_session(scope):
+        # The session's temporary palettes are listed by Flask
+        return False
+    if path != '/palettes' and not _palette_pattern.match(path):
+        return False
+    if scope['query_string']:
+        # Searches and later pages of the palette list are answered by Flask
+        return False
+    cached = _palette_responses.get(path)
+    if cached is None:
+        return False
+    body, etag = cached
+    headers = [(b'etag', quote_etag(etag).encode())]
+    if_none_match = dict(scope['headers']).get(b'if-none-match')
+    if if_none_match and parse_etags(if_none_match.decode('latin-1')).contains(etag):
+        await _send_response(send, 304, b'', headers=headers)
+        return True
+    await _send_response(send, 200, b'' if scope['method'] == 'HEAD' else body, headers=headers)
+    return True
+
+async def _receive_body(scope, receive, send):
+    """
+    Receive the request body without blocking a thread.
+
+    Returns:
+        A file object positioned at the start of the body and its length, or
+        (None, 0) if the body was refused (too large) or the client left.
+    """
+    max_length = flask_app.config.get('MAX_CONTENT_LENGTH')
+    declared = dict(scope['headers']).get(b'content-length')
+    if max_length and declared and declared.isdigit() and int(declared) > max_length:
+        await _send_response(send, 413, json.dumps({'error': 'File too large'}).encode())
+        return None, 0
+
+    body = tempfile.SpooledTemporaryFile(max_size=BODY_SPOOL_BYTES)
+    length = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            body.close()
+            return None, 0
+        chunk = message.get('body', b'')
+        length += len(chunk)
+        if max_length and length > max_length:
+            body.close()
+            await _send_response(send, 413, json.dumps({'error': 'File too large'}).encode())
+            return None, 0
+        body.write(chunk)
+        if not message.get('more_body', False):
+            break
+    body.seek(0)
+    return body, length
+
+def _make_environ(scope, body, length):
+    """Build the WSGI environ of an ASGI HTTP request."""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    raw_path = scope.get('raw_path')
+    path = raw_path.split(b'?', 1)[0].decode('latin-1') if raw_path else scope['path'].encode().decode('latin-1')
+    root_path = scope.get('root_path', '')
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode().decode('latin-1'),
+        'PATH_INFO': path[len(root_path):] if root_path and path.startswith(root_path) else path,
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'CONTENT_LENGTH': str(length),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+async def _run_wsgi(scope, body, length, send):
+    """
+    Run the Flask app in a thread and send its (possibly streamed) response.
+
+    The view and the whole iteration of its response run on one thread: the
+    memory budget, stage outcomes and profile of a request are thread-local,
+    so a streamed response must not move between threads.
+    """
+    loop = asyncio.get_running_loop()
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+        return lambda data: None  # The legacy write() callable is not used by Flask
+
+    def send_from_thread(message):
+        """Send a message on the event loop, waiting until it is sent (so a slow client slows the stream)."""
+        asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+    def run():
+        try:
+            result = flask_app(_make_environ(scope, body, length), start_response)
+            try:
+                started = False
+                # Streamed responses (Server-Sent Events) produce chunks as they are computed
+                for chunk in result:
+                    if not started:
+                        send_from_thread({'type': 'http.response.start', 'status': response['status'], 'headers': response['headers']})
+                        started = True
+                    if chunk:
+                        send_from_thread({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                if not started:
+                    send_from_thread({'type': 'http.response.start', 'status': response['status'], 'headers': response['headers']})
+                send_from_thread({'type': 'http.response.body', 'body': b''})
+            finally:
+                # Runs the response's close callbacks, e.g. releasing the admission slot
+                if hasattr(result, 'close'):
+                    result.close()
+        finally:
+            body.close()
+
+    await loop.run_in_executor(_threads, run)
+
+async def _lifespan(receive, send):
+    """Start the process pool and palette cache on startup, stop the pool and remove its shared arrays on shutdown."""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                pool_workers = os.environ.get('ASGI_POOL_WORKERS')
+                processing_pool.start(flask_app.config, int(pool_workers) if pool_workers else None)
+                _palette_responses.update(build_palette_responses())
+                # Warms the in-process paths (previews, auto palettes) and flips /ready
+                warmup.start(flask_app.config)
+            except Exception as e:
+                logging.error(f"Error starting the ASGI app: {str(e)}")
+                await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await asyncio.get_running_loop().run_in_executor(None, processing_pool.shutdown)
+            shared_arrays.release_all(flask_app.config['SHARED_ARRAYS_DEST'])
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    """The ASGI application."""
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return  # WebSockets are not used
+
+    if await _serve_cached(scope, send):
+        return
+
+    body, length = await _receive_body(scope, receive, send)
+    if body is None:
+        return
+    await _run_wsgi(scope, body, length, send)
@@ -0,0 +1,100 @@
+import time
+import argparse
+
+import numpy as np
+from PIL import Image
+
+from image_processor import (
+    DOWNSCALE_METHODS,
+    load_source_image,
+    load_palette,
+    resize_to_fit,
+    rgb_to_lab,
+    map_to_nearest_colors,
+)
+
+def make_test_image(width=1024, height=768, seed=0):
+    """
+    Create a synthetic test image with flat regions, hard edges and noise.
+
+    Returns:
+        An RGB PIL image.
+    """
+    rng = np.random.RandomState(seed)
+    # Flat colored cells with hard edges, as in upscaled pixel art and graphics
+    cells = rng.randint(0, 256, size=(height // 28 + 1, width // 28 + 1, 3), dtype=np.uint8)
+    img = np.repeat(np.repeat(cells, 28, axis=0), 28, axis=1)[:height, :width].astype(np.int16)
+    # A smooth gradient over the lower half, as in photos
+    img[height // 2:, :, 2] = np.linspace(0, 255, width)[None, :].astype(np.int16)
+    img += rng.randint(-12, 13, size=img.shape).astype(np.int16)
+    return Image.fromarray(np.clip(img, 0, 255).astype(np.uint8))
+
+def to_lab(image):
+    """Convert an RGB PIL image to a (N, 3) float32 CIELAB array."""
+    pixels = np.asarray(image).reshape(-1, 3)
+    out = np.empty(pixels.shape, dtype=np.float32)
+    return rgb_to_lab(pixels, out, np.empty_like(out))
+
+def palette_fidelity(image, palette):
+    """
+    Measure how well the palette can represent a downscaled image.
+
+    Returns:
+        The mean CIELAB distance between each pixel and its nearest palette color.
+    """
+    lab = to_lab(image)
+    indices = map_to_nearest_colors(np.asarray(image).reshape(-1, 3), palette.lab, np.empty(len(lab), dtype=np.intp))
+    return float(np.linalg.norm(lab - np.asarray(palette.lab, dtype=np.float32)[indices], axis=1).mean())
+
+def benchmark(image, palette_path, max_resolution, repeat=5):
+    """
+    Benchmark every downscale method on an image.
+
+    Args:
+        image: The source RGB PIL image.
+        palette_path: The palette used to measure the palette fidelity.
+        max_resolution: The maximum width and height of the downscaled image.
+        repeat: The number of timed runs per method.
+
+    Returns:
+        A list of dicts with the method, median time, number of distinct
+        colors and palette fidelity of the result.
+    """
+    palette = load_palette(palette_path)
+    results = []
+    for method in DOWNSCALE_METHODS:
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            small = resize_to_fit(image, max_resolution, method=method)
+            timings.append(time.perf_counter() - start)
+
+        pixels = np.asarray(small).reshape(-1, 3)
+        results.append({
+            'method': method,
+            'ms': round(float(np.median(timings)) * 1000, 2),
+            'size': small.size,
+            'colors': len(np.unique(pixels, axis=0)),
+            'palette_delta_e': round(palette_fidelity(small, palette), 2)
+        })
+    return results
+
+def main():
+    """Compare the downscale methods from the command line."""
+    parser = argparse.ArgumentParser(description="Benchmark the downscale methods for speed and palette fidelity.")
+    parser.add_argument('images', nargs='*', help="Source images (default: a synthetic test image)")
+    parser.add_argument('--palette', default='palettes/001.hex', help="The palette used to measure fidelity")
+    parser.add_argument('--resolution', default='128,128', help="The maximum resolution as 'width,height'")
+    parser.add_argument('--repeat', type=int, default=5, help="The number of timed runs per method")
+    args = parser.parse_args()
+
+    sources = [(path, load_source_image(path)) for path in args.images] or [('synthetic', make_test_image())]
+    for name, image in sources:
+        print(f"{name} ({image.width}x{image.height} -> {args.resolution}, palette {args.palette})")
+        print(f"{'method':<10}{'ms':>10}{'size':>12}{'colors':>10}{'palette dE':>12}")
+        for result in benchmark(image, args.palette, args.resolution, args.repeat):
+            size = f"{result['size'][0]}x{result['size'][1]}"
+            print(f"{result['method']:<10}{result['ms']:>10}{size:>12}{result['colors']:>10}{result['palette_delta_e']:>12}")
+
+if __name__ == '__main__':
+    main()
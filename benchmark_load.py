@@ -0,0 +1,492 @@
+import os
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import itertools
+import threading
+import http.client
+from urllib.parse import urlsplit
+
+import numpy as np
+from PIL import Image
+
+from benchmark_serving import multipart_body
+
+LOADTEST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'loadtest')
+FIXTURES_DIR = os.path.join(LOADTEST_DIR, 'fixtures')
+# Statuses of requests refused by admission control rather than failed
+THROTTLED_STATUSES = (429, 503)
+PERCENTILES = (50, 90, 95, 99)
+MIME_TYPES = {'.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png', '.gif': 'image/gif', '.webp': 'image/webp'}
+
+def _photo_pixels(width, height, rng):
+    """Smooth gradients, soft blobs and sensor noise, as in a phone photo."""
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    pixels = np.stack([x / width * 200 + 30, y / height * 160 + 40, (x + y) / (width + height) * 120 + 60], axis=-1)
+    for _ in range(12):
+        cx, cy = rng.uniform(0, width), rng.uniform(0, height)
+        radius = rng.uniform(0.05, 0.25) * max(width, height)
+        blob = np.exp(-((x - cx) ** 2 + (y - cy) ** 2) / (2 * radius ** 2))[..., None]
+        pixels = pixels * (1 - blob) + rng.uniform(0, 255, 3) * blob
+    pixels += rng.normal(0, 6, pixels.shape)
+    return np.clip(pixels, 0, 255).astype(np.uint8)
+
+def _flat_pixels(width, height, rng, n_colors, cell):
+    """Flat rectangles of a few colors, as in screenshots and pixel art."""
+    colors = rng.randint(0, 256, size=(n_colors, 3), dtype=np.uint8)
+    cells = rng.randint(0, n_colors, size=(height // cell + 1, width // cell + 1))
+    return colors[np.repeat(np.repeat(cells, cell, axis=0), cell, axis=1)[:height, :width]]
+
+def make_fixture_images(directory=FIXTURES_DIR):
+    """
+    Write the fixture images of the scenarios.
+
+    The images are synthetic and generated from fixed seeds, so rewriting
+    them gives the same files.
+
+    Returns:
+        The list of written filenames.
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.RandomState(0)
+    fixtures = {
+        'photo_12mp.jpg': (Image.fromarray(_photo_pixels(4000, 3000, rng)), {'quality': 85}),
+        'photo_3mp.jpg': (Image.fromarray(_photo_pixels(2048, 1536, rng)), {'quality': 85}),
+        'photo_small.jpg': (Image.fromarray(_photo_pixels(800, 600, rng)), {'quality': 85}),
+        'screenshot.png': (Image.fromarray(_flat_pixels(1280, 720, rng, 24, 40)), {'optimize': True}),
+        'pixel_art.png': (Image.fromarray(_flat_pixels(256, 256, rng, 12, 8)), {'optimize': True})
+    }
+    for filename, (image, options) in fixtures.items():
+        image.save(os.path.join(directory, filename), **options)
+
+    # A short looping animation
+    base = _photo_pixels(320, 240, rng)
+    frames = [Image.fromarray(np.roll(base, shift * 20, axis=1)) for shift in range(8)]
+    frames[0].save(os.path.join(directory, 'animation.gif'), save_all=True, append_images=frames[1:], duration=100, loop=0)
+    return sorted(fixtures) + ['animation.gif']
+
+def load_scenario(path):
+    """
+    Read a scenario file.
+
+    A scenario gives the number of simulated users, how long they run and
+    the relative frequency (weights) of each image, quantization mode,
+    palette, resolution and upscale factor of their uploads; see
+    loadtest/scenarios/production.json.
+
+    Returns:
+        The scenario as a dict, with defaults filled in.
+    """
+    with open(path) as f:
+        scenario = json.load(f)
+    for key in ('images', 'quantization_modes'):
+        if not scenario.get(key):
+            raise ValueError(f"Scenario {path} has no {key}")
+    scenario.setdefault('name', os.path.splitext(os.path.basename(path))[0])
+    scenario.setdefault('users', 4)
+    scenario.setdefault('duration', 60)
+    scenario.setdefault('ramp_up', 0)
+    scenario.setdefault('think_time', 1.0)
+    scenario.setdefault('download_ratio', 1.0)
+    scenario.setdefault('palettes', {'*': 1})
+    scenario.setdefault('max_resolutions', {'256,256': 1})
+    scenario.setdefault('upscale_factors', {'1': 1})
+    scenario.setdefault('downscale_methods', {'lanczos': 1})
+    scenario.setdefault('seed', 0)
+    return scenario
+
+def _choose(rng, weights):
+    """Pick a key of a {value: weight} dict with probability proportional to its weight."""
+    values = list(weights)
+    return rng.choices(values, weights=[weights[value] for value in values])[0]
+
+def _client_address(number):
+    """Get the private address of the given simulated user (admission control limits each address)."""
+    return f"10.{number >> 16 & 255}.{number >> 8 & 255}.{number & 255}"
+
+class InProcessTarget:
+    """Sends requests to the Flask app through test clients, one per simulated user."""
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self.addresses = itertools.count(1)
+
+    def client(self):
+        """Get a client with its own session cookie and address."""
+        test_client = self.app.test_client()
+        test_client.environ_base['REMOTE_ADDR'] = _client_address(next(self.addresses))
+        return _InProcessClient(test_client)
+
+class _InProcessClient:
+    """A simulated user of InProcessTarget."""
+    def __init__(self, test_client):
+        self.test_client = test_client
+
+    def get(self, path):
+        """Send a GET request; returns (status, JSON data or None)."""
+        response = self.test_client.get(path)
+        return response.status_code, response.get_json(silent=True)
+
+    def upload(self, filename, data, fields):
+        """Upload an image with form fields; returns (status, JSON data or None)."""
+        form = dict(fields, file=(io.BytesIO(data), filename))
+        response = self.test_client.post('/upload', data=form, content_type='multipart/form-data')
+        return response.status_code, response.get_json(silent=True)
+
+class HttpTarget:
+    """Sends requests to a running server (e.g. a local gunicorn), one connection per simulated user."""
+    def __init__(self, base_url, timeout=180):
+        self.url = urlsplit(base_url)
+        self.timeout = timeout
+        self.addresses = itertools.count(1)
+
+    def client(self):
+        """Get a client with its own connection, session cookie and forwarded address."""
+        return _HttpClient(self.url, self.timeout, _client_address(next(self.addresses)))
+
+class _HttpClient:
+    """A simulated user of HttpTarget."""
+    def __init__(self, url, timeout, address):
+        self.url = url
+        self.timeout = timeout
+        self.address = address  # Used by the server only if it trusts a proxy (TRUSTED_PROXY_COUNT)
+        self.cookie = None  # The session cookie, so admission sees one user
+        self.connection = None
+
+    def _request(self, method, path, body=None, content_type=None):
+        """Send a request on the kept-alive connection; returns (status, JSON data or None), status 0 on a connection error."""
+        headers = {'X-Forwarded-For': self.address}
+        if body is not None:
+            headers['Content-Type'] = content_type
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=self.timeout)
+            try:
+                self.connection.request(method, path, body=body, headers=headers)
+                response = self.connection.getresponse()
+                data = response.read()
+                break
+            except (OSError, http.client.HTTPException):
+                # Reconnect once if the server closed a kept-alive connection
+                self.connection.close()
+                self.connection = None
+                if attempt:
+                    return 0, None
+        set_cookie = response.getheader('Set-Cookie')
+        if set_cookie:
+            self.cookie = set_cookie.split(';', 1)[0]
+        try:
+            return response.status, json.loads(data)
+        except ValueError:
+            return response.status, None
+
+    def get(self, path):
+        """Send a GET request; returns (status, JSON data or None)."""
+        return self._request('GET', path)
+
+    def upload(self, filename, data, fields):
+        """Upload an image with form fields; returns (status, JSON data or None)."""
+        content_type = MIME_TYPES.get(os.path.splitext(filename)[1].lower(), 'application/octet-stream')
+        body, form_type = multipart_body(data, fields, filename=filename, file_content_type=content_type)
+        return self._request('POST', '/upload', body, form_type)
+
+def resolve_palettes(target, weights):
+    """
+    Map the palette names of a scenario to palette ids.
+
+    '*' stands for any palette: each upload picks one of all palettes at random.
+
+    Returns:
+        A {palette id or '*': weight} dict and the list of all palette ids.
+    """
+    client = target.client()
+    ids_by_name = {}
+    path = '/palettes?per_page=500'
+    while path:
+        status, data = client.get(path)
+        if status != 200:
+            raise RuntimeError(f"Listing the palettes failed with status {status}")
+        ids_by_name.update((palette['name'], str(palette['id'])) for palette in data['palettes'])
+        path = data['next']
+    resolved = {}
+    for name, weight in weights.items():
+        if name != '*' and name not in ids_by_name:
+            raise ValueError(f"Unknown palette in scenario: {name}")
+        resolved['*' if name == '*' else ids_by_name[name]] = weight
+    return resolved, list(ids_by_name.values())
+
+def process_tree(root_pid):
+    """Get a process and its descendants (e.g. a gunicorn master, its workers and their processing pools)."""
+    children = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/stat') as f:
+                # The parent pid follows the parenthesized command name
+                parent = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(name))
+    pids = [root_pid]
+    for pid in pids:
+        pids.extend(children.get(pid, []))
+    return pids
+
+def read_rss_mb(pid):
+    """Get the resident set size of a process in MB, or None if it is gone."""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+class RssSampler(threading.Thread):
+    """Samples the RSS of every process of the server at a fixed interval."""
+    def __init__(self, root_pid, interval):
+        super().__init__(daemon=True)
+        self.root_pid = root_pid
+        self.interval = interval
+        self.samples = []  # (seconds since start, {pid: rss_mb})
+        self._stop_event = threading.Event()
+
+    def run(self):
+        start = time.monotonic()
+        while True:
+            rss = {pid: read_rss_mb(pid) for pid in process_tree(self.root_pid)}
+            self.samples.append((round(time.monotonic() - start, 2), {pid: round(mb, 1) for pid, mb in rss.items() if mb is not None}))
+            if self._stop_event.wait(self.interval):
+                break
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+def run_scenario(target, scenario, images, palette_weights, palette_ids):
+    """
+    Run the simulated users of a scenario against a target.
+
+    Each user starts after its share of the ramp-up, then loops until the
+    scenario's duration is over: it uploads an image with settings drawn
+    from the scenario's weights, downloads the result (download_ratio of
+    the time) and waits for an exponentially distributed think time.
+
+    Returns:
+        A list of request records (kind, settings, start, latency, status).
+    """
+    records = []
+    lock = threading.Lock()
+    start = time.monotonic()
+    deadline = start + scenario['duration']
+
+    def user(index):
+        rng = random.Random(scenario['seed'] * 1000 + index)
+        client = target.client()
+        time.sleep(scenario['ramp_up'] * index / scenario['users'])
+        while time.monotonic() < deadline:
+            image = _choose(rng, scenario['images'])
+            palette = _choose(rng, palette_weights)
+            settings = {
+                'image': image,
+                'quantization_mode': _choose(rng, scenario['quantization_modes']),
+                'palette': rng.choice(palette_ids) if palette == '*' else palette,
+                'max_resolution': _choose(rng, scenario['max_resolutions']),
+                'upscale_factor': _choose(rng, scenario['upscale_factors']),
+                'downscale_method': _choose(rng, scenario['downscale_methods'])
+            }
+            fields = {key: value for key, value in settings.items() if key != 'image'}
+
+            request_start = time.monotonic()
+            status, data = client.upload(image, images[image], fields)
+            record = dict(settings, kind='upload', start=request_start - start, latency=time.monotonic() - request_start, status=status)
+            if status == 200 and data:
+                record['stages'] = data.get('stages')
+            with lock:
+                records.append(record)
+
+            if status == 200 and data and rng.random() < scenario['download_ratio']:
+                request_start = time.monotonic()
+                status, _ = client.get(data['processed_image_url'])
+                with lock:
+                    records.append({'kind': 'download', 'start': request_start - start, 'latency': time.monotonic() - request_start, 'status': status})
+
+            if scenario['think_time']:
+                time.sleep(min(rng.expovariate(1 / scenario['think_time']), max(deadline - time.monotonic(), 0)))
+
+    threads = [threading.Thread(target=user, args=(index,)) for index in range(scenario['users'])]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return records
+
+def _latency_stats(records, duration):
+    """Get the count, error rates, throughput and latency percentiles (ms) of some requests."""
+    latencies = np.array([record['latency'] for record in records]) * 1000
+    succeeded = np.array([record['status'] == 200 for record in records])
+    throttled = sum(1 for record in records if record['status'] in THROTTLED_STATUSES)
+    stats = {
+        'count': len(records),
+        'ok': int(succeeded.sum()),
+        'error_rate': round((len(records) - int(succeeded.sum()) - throttled) / len(records), 4),
+        'throttled_rate': round(throttled / len(records), 4),
+        'rps': round(int(succeeded.sum()) / duration, 3)
+    }
+    ok_latencies = latencies[succeeded] if succeeded.any() else latencies
+    for percentile in PERCENTILES:
+        stats[f'p{percentile}_ms'] = round(float(np.percentile(ok_latencies, percentile)), 1)
+    stats['max_ms'] = round(float(ok_latencies.max()), 1)
+    return stats
+
+def summarize(records, duration, rss_samples, interval):
+    """
+    Summarize a run.
+
+    Latency percentiles are over successful requests; error_rate counts
+    failures and throttled_rate the requests refused by admission control.
+
+    Returns:
+        A JSON-serializable report.
+    """
+    uploads = [record for record in records if record['kind'] == 'upload']
+    report = {'duration': duration, 'requests': {}, 'by_mode': {}, 'by_image': {}, 'statuses': {}, 'timeline': []}
+    for kind in ('upload', 'download'):
+        kind_records = [record for record in records if record['kind'] == kind]
+        if kind_records:
+            report['requests'][kind] = _latency_stats(kind_records, duration)
+    for group, key in (('by_mode', 'quantization_mode'), ('by_image', 'image')):
+        for value in sorted({record[key] for record in uploads}):
+            report[group][value] = _latency_stats([record for record in uploads if record[key] == value], duration)
+    for record in records:
+        report['statuses'][str(record['status'])] = report['statuses'].get(str(record['status']), 0) + 1
+
+    # Throughput and RSS over time, per sampling interval
+    for t, rss in rss_samples:
+        window = [record for record in uploads if t - interval <= record['start'] + record['latency'] < t]
+        report['timeline'].append({
+            't': t,
+            'uploads_per_s': round(sum(1 for record in window if record['status'] == 200) / interval, 2),
+            'rss_mb': {str(pid): mb for pid, mb in rss.items()},
+            'total_rss_mb': round(sum(rss.values()), 1)
+        })
+    peaks = {}
+    for _, rss in rss_samples:
+        for pid, mb in rss.items():
+            peaks[str(pid)] = max(peaks.get(str(pid), 0), mb)
+    report['peak_rss_mb'] = peaks
+    report['peak_total_rss_mb'] = max((entry['total_rss_mb'] for entry in report['timeline']), default=0)
+    return report
+
+def print_report(report, previous=None):
+    """Print a report, with the change from a previous report of the same scenario if given."""
+    def delta(section, name, key):
+        if not previous or name not in previous.get(section, {}):
+            return ''
+        before = previous[section][name][key]
+        after = report[section][name][key]
+        return f" ({(after - before) / before * 100:+.0f}%)" if before else ''
+
+    header = f"{'':<22}{'count':>7}{'ok':>7}{'err %':>7}{'429 %':>7}{'rps':>8}" + ''.join(f"{f'p{p} ms':>10}" for p in PERCENTILES) + f"{'max ms':>10}"
+    for section in ('requests', 'by_mode', 'by_image'):
+        print(f"\n{section.replace('_', ' ')}")
+        print(header)
+        for name, stats in report[section].items():
+            line = f"{name:<22}{stats['count']:>7}{stats['ok']:>7}{stats['error_rate'] * 100:>7.1f}{stats['throttled_rate'] * 100:>7.1f}{stats['rps']:>8}"
+            line += ''.join(f"{stats[f'p{p}_ms']:>10}" for p in PERCENTILES) + f"{stats['max_ms']:>10}"
+            print(line)
+            if previous:
+                changes = [delta(section, name, key) for key in ('rps', 'p50_ms', 'p95_ms', 'p99_ms')]
+                if any(changes):
+                    print(f"{'':<22}vs previous: rps{changes[0]}, p50{changes[1]}, p95{changes[2]}, p99{changes[3]}")
+
+    print(f"\nstatuses: {report['statuses']}")
+    print(f"\n{'t (s)':>7}{'uploads/s':>11}{'total RSS MB':>14}  RSS MB per process")
+    for entry in report['timeline']:
+        per_process = ' '.join(f"{pid}:{mb:.0f}" for pid, mb in entry['rss_mb'].items())
+        print(f"{entry['t']:>7}{entry['uploads_per_s']:>11}{entry['total_rss_mb']:>14}  {per_process}")
+    line = f"\npeak total RSS: {report['peak_total_rss_mb']} MB"
+    if previous and previous.get('peak_total_rss_mb'):
+        line += f" ({(report['peak_total_rss_mb'] - previous['peak_total_rss_mb']) / previous['peak_total_rss_mb'] * 100:+.0f}%)"
+    print(line)
+
+def main():
+    """Run a load test scenario from the command line."""
+    parser = argparse.ArgumentParser(description="Simulate concurrent users uploading images, and report latency percentiles, throughput, error rates and RSS over time.")
+    parser.add_argument('scenario', nargs='?', default=os.path.join(LOADTEST_DIR, 'scenarios', 'production.json'), help="Scenario file (see loadtest/scenarios)")
+    parser.add_argument('--url', help="Server to load, e.g. http://127.0.0.1:5000 (default: the app, in process)")
+    parser.add_argument('--server-pid', type=int, help="Pid of the server (e.g. the gunicorn master) whose processes' RSS is sampled")
+    parser.add_argument('--pool', type=int, default=0, help="In process: offload processing to a pool of this many processes")
+    parser.add_argument('--users', type=int, help="Override the scenario's number of users")
+    parser.add_argument('--duration', type=float, help="Override the scenario's duration, in seconds")
+    parser.add_argument('--sample-interval', type=float, default=2.0, help="Seconds between RSS samples")
+    parser.add_argument('--output', help="Write the report and scenario as JSON, to compare later runs against")
+    parser.add_argument('--compare', help="A previous --output report to compare against")
+    parser.add_argument('--write-fixtures', action='store_true', help="Regenerate the fixture images and exit")
+    args = parser.parse_args()
+
+    if args.write_fixtures:
+        print(f"Wrote {', '.join(make_fixture_images())} to {FIXTURES_DIR}")
+        return
+
+    scenario = load_scenario(args.scenario)
+    if args.users:
+        scenario['users'] = args.users
+    if args.duration:
+        scenario['duration'] = args.duration
+    images = {}
+    for filename in scenario['images']:
+        with open(os.path.join(FIXTURES_DIR, filename), 'rb') as f:
+            images[filename] = f.read()
+
+    if args.url:
+        target = HttpTarget(args.url)
+        root_pid = args.server_pid
+    else:
+        from app import app
+        if args.pool:
+            import processing_pool
+            processing_pool.start(app.config, args.pool)
+        target = InProcessTarget(app)
+        root_pid = os.getpid()
+
+    palette_weights, palette_ids = resolve_palettes(target, scenario['palettes'])
+    print(f"Scenario {scenario['name']}: {scenario['users']} users for {scenario['duration']:.0f} s against {args.url or 'the app in process'}")
+
+    sampler = RssSampler(root_pid, args.sample_interval) if root_pid else None
+    if sampler:
+        sampler.start()
+    records = run_scenario(target, scenario, images, palette_weights, palette_ids)
+    if sampler:
+        sampler.stop()
+    if not args.url:
+        # Remove the simulated users' processed images and auto palettes
+        import session_manager
+        session_manager.cleanup_all_sessions()
+        if args.pool:
+            processing_pool.shutdown()
+    if not records:
+        print("No request completed")
+        sys.exit(1)
+
+    report = summarize(records, scenario['duration'], sampler.samples if sampler else [], args.sample_interval)
+    report['scenario'] = scenario
+    report['target'] = args.url or ('in process' + (f" with a pool of {args.pool}" if args.pool else ''))
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    print_report(report, previous)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+import io
+import time
+import uuid
+import argparse
+import threading
+import http.client
+from urllib.parse import urlsplit
+
+import numpy as np
+from PIL import Image
+
+def make_upload_image(width, height, seed=0):
+    """Create a noisy PNG that does not compress well, as upload payload."""
+    pixels = (np.random.RandomState(seed).rand(height, width, 3) * 255).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+def multipart_body(image_bytes, fields, filename='bench.png', file_content_type='image/png'):
+    """Encode an upload form; returns (body, content_type)."""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    parts.append(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        f'Content-Type: {file_content_type}\r\n\r\n'.encode() + image_bytes + b'\r\n'
+    )
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+def request(base_url, method, path, body=None, content_type=None, rate=None, timeout=120):
+    """
+    Send a request and read the whole response.
+
+    Args:
+        rate: Optional upload rate in bytes per second, to simulate a slow client.
+
+    Returns:
+        The HTTP status (0 on a connection error).
+    """
+    url = urlsplit(base_url)
+    connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=timeout)
+    try:
+        connection.putrequest(method, path)
+        if body is not None:
+            connection.putheader('Content-Type', content_type)
+            connection.putheader('Content-Length', str(len(body)))
+        connection.endheaders()
+        if body is not None:
+            chunk_size = max(1, int(rate / 10)) if rate else len(body)
+            for start in range(0, len(body), chunk_size):
+                connection.send(body[start:start + chunk_size])
+                if rate:
+                    time.sleep(chunk_size / rate)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    except (OSError, http.client.HTTPException):
+        return 0
+    finally:
+        connection.close()
+
+def run_load(base_url, duration, slow_clients, slow_rate, fast_clients, slow_image, fast_image):
+    """
+    Run slow uploaders and fast clients against a server for a duration.
+
+    Slow uploaders send a large image at slow_rate bytes per second, like
+    phones on a mobile network. Fast clients loop over the palette list, a
+    palette and a small upload; their latencies show whether slow uploads
+    starve the server of request handlers.
+
+    Returns:
+        A dict of request kind -> list of (latency_seconds, status).
+    """
+    results = {'slow_upload': [], 'palettes': [], 'palette': [], 'fast_upload': []}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+    form = {'palette': '1', 'quantization_mode': 'contrast', 'max_resolution': '64,64'}
+    slow_body, slow_type = multipart_body(slow_image, form)
+    fast_body, fast_type = multipart_body(fast_image, form)
+
+    def timed(kind, *args, **kwargs):
+        start = time.perf_counter()
+        status = request(base_url, *args, **kwargs)
+        with lock:
+            results[kind].append((time.perf_counter() - start, status))
+
+    def slow_client():
+        while time.monotonic() < deadline:
+            timed('slow_upload', 'POST', '/upload', slow_body, slow_type, rate=slow_rate)
+
+    def fast_client():
+        while time.monotonic() < deadline:
+            timed('palettes', 'GET', '/palettes')
+            timed('palette', 'GET', '/palette/1')
+            timed('fast_upload', 'POST', '/upload', fast_body, fast_type)
+
+    threads = [threading.Thread(target=slow_client) for _ in range(slow_clients)]
+    threads += [threading.Thread(target=fast_client) for _ in range(fast_clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def summarize(results, duration):
+    """Get the count, error count, throughput and latency percentiles (ms) of each request kind."""
+    summary = {}
+    for kind, samples in results.items():
+        if not samples:
+            continue
+        latencies = np.array([latency for latency, _ in samples]) * 1000
+        summary[kind] = {
+            'count': len(samples),
+            'errors': sum(1 for _, status in samples if status != 200),
+            'rps': round(len(samples) / duration, 2),
+            'p50': round(float(np.percentile(latencies, 50)), 1),
+            'p95': round(float(np.percentile(latencies, 95)), 1),
+            'p99': round(float(np.percentile(latencies, 99)), 1)
+        }
+    return summary
+
+def main():
+    """Compare servers under slow uploads from the command line."""
+    parser = argparse.ArgumentParser(description="Compare the sync (gunicorn) and async (uvicorn asgi:app) deployments under slow uploads.")
+    parser.add_argument('urls', nargs='+', help="Servers to compare, as label=url (e.g. sync=http://127.0.0.1:5000)")
+    parser.add_argument('--duration', type=float, default=20, help="Seconds of load per server")
+    parser.add_argument('--slow-clients', type=int, default=8, help="Concurrent slow uploaders")
+    parser.add_argument('--slow-rate', type=int, default=256 * 1024, help="Upload rate of slow clients, in bytes per second")
+    parser.add_argument('--fast-clients', type=int, default=4, help="Concurrent fast clients")
+    args = parser.parse_args()
+
+    slow_image = make_upload_image(1024, 768)
+    fast_image = make_upload_image(160, 120, seed=1)
+    print(f"{args.slow_clients} slow clients uploading {len(slow_image) / 2**20:.1f} MB at "
+          f"{args.slow_rate / 1024:.0f} KB/s, {args.fast_clients} fast clients, {args.duration:.0f} s per server")
+    for target in args.urls:
+        label, _, url = target.partition('=')
+        summary = summarize(run_load(url or label, args.duration, args.slow_clients, args.slow_rate,
+                                     args.fast_clients, slow_image, fast_image), args.duration)
+        print(f"\n{label}")
+        print(f"{'request':<14}{'count':>7}{'errors':>8}{'rps':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for kind, stats in summary.items():
+            print(f"{kind:<14}{stats['count']:>7}{stats['errors']:>8}{stats['rps']:>8}"
+                  f"{stats['p50']:>10}{stats['p95']:>10}{stats['p99']:>10}")
+
+if __name__ == '__main__':
+    main()
@@ -9,13 +9,24 @@ class Config:
     SQLALCHEMY_DATABASE_URI = 'sqlite:///pixel_art.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SECRET_KEY = os.environ.get('SESSION_SECRET', 'pixel-art-secret-key')
+    SQLITE_BUSY_TIMEOUT_MS = 5000  # How long a writer waits for the SQLite lock
+    PROCESSED_IMAGE_TTL = 24 * 60 * 60  # Seconds before a processed image record expires
     
     # File upload settings
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16 MB max upload
     UPLOADED_PHOTOS_DEST = os.path.join(os.getcwd(), 'uploads')
     UPLOADED_PALETTES_DEST = os.path.join(os.getcwd(), 'palettes')
     PROCESSED_IMAGES_DEST = os.path.join(os.getcwd(), 'processed')
+    PALETTE_BUNDLE_PATH = os.path.join(os.getcwd(), 'palettes.bundle.npy')
+    CANCEL_FLAGS_DEST = os.path.join(os.getcwd(), 'cancel_flags')
+    ADMISSION_STATE_PATH = os.path.join(os.getcwd(), 'admission_state.json')
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp'}
+    REQUEST_MEMORY_BUDGET = 384 * 1024 * 1024  # Peak memory of the arrays of one request
+    # Decoded images handed to the processing pool (see shared_arrays.py);
+    # a tmpfs keeps them in memory
+    SHARED_ARRAYS_DEST = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else os.getcwd(), 'pixelator-shared')
+    SHARED_ARRAYS_MAX_BYTES = 512 * 1024 * 1024  # Shared by one serving process at a time
+    SHARED_ARRAYS_MAX_IDLE = 10 * 60  # Seconds an unused shared source is kept for its session
     
     # Application settings
     DEFAULT_MAX_RESOLUTION = (256, 256)
@@ -27,9 +38,82 @@ class Config:
         {'value': 'contrast', 'name': 'Contrast', 'description': 'Emphasizes edges while quantizing'},
         {'value': 'natural', 'name': 'Natural', 'description': 'Attempts a more natural color reduction using CIELAB color space'},
         {'value': 'kmeans', 'name': 'K-Means', 'description': 'Uses k-means clustering to find dominant colors and match to palette'},
-        {'value': 'kmeans_brightness', 'name': 'K-Means (Brightness)', 'description': 'Uses k-means and maps clusters based on brightness'}
+        {'value': 'kmeans_brightness', 'name': 'K-Means (Brightness)', 'description': 'Uses k-means and maps clusters based on brightness'},
+        {'value': 'tone_map', 'name': 'Tone Map', 'description': 'Maps brightness bands of the image to the palette sorted from dark to light'},
+        {'value': 'tone_map_hue', 'name': 'Tone Map (Hue)', 'description': 'Maps brightness bands like Tone Map, preferring palette colors of a similar hue'},
+        {'value': 'auto', 'name': 'Auto Palette', 'description': 'Builds a palette from the image itself, optionally snapped to the selected palette'}
     ]
     
+    # Downscaling methods (see image_processor.resize_to_fit)
+    DOWNSCALE_METHODS = [
+        {'value': 'lanczos', 'name': 'Smooth (Lanczos)', 'description': 'Smooth resampling; softens edges'},
+        {'value': 'box', 'name': 'Box Average', 'description': 'Averages each block of pixels'},
+        {'value': 'mode', 'name': 'Dominant Color', 'description': 'Keeps the most common color of each block'},
+        {'value': 'edge', 'name': 'Edge Preserving', 'description': 'Averages flat areas but keeps real pixel colors along edges'}
+    ]
+    DEFAULT_DOWNSCALE_METHOD = 'lanczos'
+    
+    # Number of colors the auto palette mode extracts
+    AUTO_PALETTE_SIZES = [4, 8, 16, 32, 64]
+    DEFAULT_AUTO_PALETTE_SIZE = 16
+    
+    # Maximum processing time per quantization mode, in seconds
+    PROCESSING_DEADLINES = {
+        'contrast': 30,
+        'natural': 60,
+        'kmeans': 90,
+        'kmeans_brightness': 90,
+        'tone_map': 30,
+        'tone_map_hue': 30,
+        'auto': 30
+    }
+    DEFAULT_PROCESSING_DEADLINE = 60
+    
+    # Admission control, shared by all worker processes (see admission.py).
+    # A request costs its mode weight times its longest side / 128 px.
+    ADMISSION_MODE_COSTS = {
+        'contrast': 1,
+        'natural': 2,
+        'kmeans': 4,
+        'kmeans_brightness': 4,
+        'tone_map': 1,
+        'tone_map_hue': 1,
+        'auto': 1,
+        'palette_import': 1,
+        'palette_suggest': 1
+    }
+    ADMISSION_MAX_CONCURRENT_PER_CLIENT = 2  # Requests in flight per session
+    # Limits of a client address, shared by its sessions (a client dropping
+    # its cookie gets a new session per request; several users may share a NAT)
+    ADMISSION_MAX_CONCURRENT_PER_ADDRESS = 8
+    ADMISSION_ADDRESS_BUCKET_SIZE = 256
+    ADMISSION_ADDRESS_REFILL_RATE = 4.0
+    ADMISSION_GLOBAL_CAPACITY = 16 * (os.cpu_count() or 1)  # Total cost in flight
+    ADMISSION_BUCKET_SIZE = 64  # Burst allowance of a session, in cost units
+    ADMISSION_REFILL_RATE = 1.0  # Cost units a session regains per second
+    ADMISSION_RETRY_AFTER = 2  # Retry-After (seconds) when at a concurrency limit
+    ADMISSION_LEASE_TIMEOUT = 120  # Seconds after which a leaked slot is reclaimed
+    # Reverse proxies in front of the app whose X-Forwarded-For gives the client address
+    TRUSTED_PROXY_COUNT = int(os.environ.get('TRUSTED_PROXY_COUNT', 0))
+    
+    # Request profiling (see profiling.py), disabled unless an admin token is set
+    PROFILING_ADMIN_TOKEN = os.environ.get('PROFILING_ADMIN_TOKEN')
+    PROFILES_DEST = os.path.join(os.getcwd(), 'profiles')
+    PROFILING_MIN_INTERVAL = 10  # Seconds between two profiled requests of a worker
+    PROFILING_MAX_STORED = 50  # Profiles kept on disk; older ones are deleted
+    PROFILING_TRACEMALLOC_FRAMES = 1  # Stack frames recorded per allocation
+    
+    # Palette import limits (see palette_import.py)
+    PALETTE_IMPORT_MAX_COLORS = 4096
+    PALETTE_IMPORT_MAX_ARCHIVE_ENTRIES = 500  # Palette files per zip archive
+    PALETTE_IMPORT_MAX_ARCHIVE_BYTES = 64 * 1024 * 1024  # Uncompressed size of a zip archive
+    PALETTE_IMPORT_ARCHIVE_BATCH = 50  # Palettes of an archive per palette_import admission cost unit
+    
+    # Palette list API (see routes.get_palettes)
+    PALETTES_PAGE_SIZE = 100  # Palettes per page by default, and rendered with the index page
+    PALETTES_MAX_PAGE_SIZE = 500
+    PALETTES_BATCH_MAX = 64  # Palettes whose colors one /palettes/colors request may fetch
+    
     # Resolution presets
     RESOLUTION_PRESETS = [
         {'value': '64,64', 'name': '64 x 64'},
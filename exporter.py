@@ -0,0 +1,256 @@
+import io
+import json
+import queue
+import logging
+import threading
+
+import numpy as np
+from PIL import Image, ImageSequence
+
+# Export formats and their MIME types
+EXPORT_FORMATS = {
+    'png': 'image/png',
+    'gif': 'image/gif',
+    'npy': 'application/octet-stream',
+    'json': 'application/json'
+}
+# zlib level of indexed PNGs: the strongest level for typical pixel art,
+# a faster one for large (heavily upscaled) images
+PNG_COMPRESS_LEVEL = 9
+LARGE_PNG_COMPRESS_LEVEL = 6
+LARGE_PNG_PIXELS = 1024 * 1024
+# Number of encoded chunks buffered between the encoder thread and the response
+STREAM_QUEUE_SIZE = 16
+
+def png_bit_depth(n_colors):
+    """
+    Get the smallest indexed PNG bit depth for a palette size.
+
+    Args:
+        n_colors: The number of palette colors.
+
+    Returns:
+        1, 2, 4 or 8.
+
+    Raises:
+        ValueError: If the palette has more than 256 colors.
+    """
+    for bits in (1, 2, 4, 8):
+        if n_colors <= 2 ** bits:
+            return bits
+    raise ValueError(f"Indexed images support at most 256 colors, the palette has {n_colors}")
+
+def index_plane(image, palette_rgb):
+    """
+    Get the palette index of every pixel of an image made of palette colors.
+
+    The processed images only contain palette colors, so this is an exact
+    lookup of the packed colors in the sorted palette, not a quantization.
+    Colors missing from the palette (there should be none) take the first index.
+
+    Args:
+        image: An RGB PIL image.
+        palette_rgb: A (N, 3) uint8 array of palette colors.
+
+    Returns:
+        A (H, W) uint8 (or uint16 for large palettes) array of indices.
+    """
+    palette_rgb = np.asarray(palette_rgb, dtype=np.uint32)
+    palette_codes = (palette_rgb[:, 0] << 16) | (palette_rgb[:, 1] << 8) | palette_rgb[:, 2]
+    order = np.argsort(palette_codes, kind='stable')
+    sorted_codes = palette_codes[order]
+
+    pixels = np.asarray(image.convert('RGB'), dtype=np.uint32)
+    codes = (pixels[..., 0] << 16) | (pixels[..., 1] << 8) | pixels[..., 2]
+    positions = np.minimum(np.searchsorted(sorted_codes, codes), len(sorted_codes) - 1)
+    indices = np.where(sorted_codes[positions] == codes, order[positions], 0)
+
+    return indices.astype(np.uint8 if len(palette_rgb) <= 256 else np.uint16)
+
+def load_index_frames(image_path, palette_rgb, scale=1):
+    """
+    Read the index planes of a processed image or animation.
+
+    Args:
+        image_path: The path to the processed image.
+        palette_rgb: A (N, 3) uint8 array of palette colors.
+        scale: The upscale factor of the image; every scale-th pixel is kept
+               to export the native pixel-art resolution.
+
+    Returns:
+        A list of (indices, duration_ms) tuples.
+    """
+    frames = []
+    with Image.open(image_path) as img:
+        for frame in ImageSequence.Iterator(img):
+            indices = index_plane(frame, palette_rgb)
+            if scale > 1:
+                indices = np.ascontiguousarray(indices[::scale, ::scale])
+            frames.append((indices, frame.info.get('duration', img.info.get('duration', 100))))
+    return frames
+
+def _indexed_image(indices, palette_rgb):
+    """Create a 'P' mode image with exactly the palette's colors."""
+    img = Image.fromarray(indices.astype(np.uint8), 'P')
+    img.putpalette(np.asarray(palette_rgb, dtype=np.uint8).flatten().tolist())
+    return img
+
+def sprite_sheet(frames):
+    """Lay the frames out left to right in a single index plane."""
+    return np.hstack([indices for indices, _ in frames])
+
+def sprite_sheet_json(frames, image_name, palette_rgb):
+    """
+    Describe the sprite sheet of the frames in Aseprite's JSON (hash) format.
+
+    Args:
+        frames: A list of (indices, duration_ms) tuples.
+        image_name: The file name of the sprite sheet image.
+        palette_rgb: A (N, 3) uint8 array of palette colors.
+
+    Returns:
+        A JSON-serializable dict.
+    """
+    height, width = frames[0][0].shape
+    base_name = image_name.rsplit('.', 1)[0]
+    sheet = {}
+    for i, (_, duration) in enumerate(frames):
+        sheet[f"{base_name} {i}.png"] = {
+            'frame': {'x': i * width, 'y': 0, 'w': width, 'h': height},
+            'rotated': False,
+            'trimmed': False,
+            'spriteSourceSize': {'x': 0, 'y': 0, 'w': width, 'h': height},
+            'sourceSize': {'w': width, 'h': height},
+            'duration': int(duration)
+        }
+    return {
+        'frames': sheet,
+        'meta': {
+            'app': 'Pixelator',
+            'version': '1.0',
+            'image': image_name,
+            'format': 'I8',
+            'size': {'w': width * len(frames), 'h': height},
+            'scale': '1',
+            'frameTags': [],
+            'layers': [{'name': 'Layer 1', 'opacity': 255, 'blendMode': 'normal'}],
+            'slices': [],
+            'palette': [f"#{r:02x}{g:02x}{b:02x}" for r, g, b in np.asarray(palette_rgb).tolist()]
+        }
+    }
+
+def encode(frames, palette_rgb, export_format, fp, image_name="sprite.png"):
+    """
+    Encode index frames in an export format.
+
+    Args:
+        frames: A list of (indices, duration_ms) tuples.
+        palette_rgb: A (N, 3) uint8 array of palette colors.
+        export_format: One of EXPORT_FORMATS.
+        fp: A writable binary file object; it does not need to be seekable.
+        image_name: The sprite sheet file name referenced by the JSON sidecar.
+    """
+    if export_format == 'png':
+        # Animations are exported as a sprite sheet, see sprite_sheet_json
+        indices = sprite_sheet(frames)
+        compress_level = PNG_COMPRESS_LEVEL if indices.size <= LARGE_PNG_PIXELS else LARGE_PNG_COMPRESS_LEVEL
+        _indexed_image(indices, palette_rgb).save(
+            fp,
+            format='PNG',
+            bits=png_bit_depth(len(palette_rgb)),
+            compress_level=compress_level
+        )
+    elif export_format == 'gif':
+        png_bit_depth(len(palette_rgb))  # GIF is limited to 256 colors as well
+        images = [_indexed_image(indices, palette_rgb) for indices, _ in frames]
+        if len(images) > 1:
+            images[0].save(
+                fp,
+                format='GIF',
+                save_all=True,
+                append_images=images[1:],
+                duration=[duration for _, duration in frames],
+                loop=0
+            )
+        else:
+            images[0].save(fp, format='GIF')
+    elif export_format == 'npy':
+        # (H, W) for images, (frames, H, W) for animations
+        indices = frames[0][0] if len(frames) == 1 else np.stack([indices for indices, _ in frames])
+        np.save(fp, indices)
+    elif export_format == 'json':
+        fp.write(json.dumps(sprite_sheet_json(frames, image_name, palette_rgb), indent=2).encode())
+    else:
+        raise ValueError(f"Unknown export format: {export_format}")
+
+def encode_to_bytes(frames, palette_rgb, export_format, image_name="sprite.png"):
+    """Encode index frames in memory, see encode."""
+    buffer = io.BytesIO()
+    encode(frames, palette_rgb, export_format, buffer, image_name)
+    return buffer.getvalue()
+
+class _QueueWriter:
+    """A write-only file object handing the written chunks to a queue."""
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        while True:
+            if self.closed:
+                raise IOError("The export stream was closed")
+            try:
+                self._chunks.put(data, timeout=1)
+                return len(data)
+            except queue.Full:
+                continue
+
+    def flush(self):
+        pass
+
+def stream_encode(frames, palette_rgb, export_format, image_name="sprite.png"):
+    """
+    Encode index frames in a background thread and yield the encoded chunks.
+
+    The encoder writes straight into a bounded queue, so the export is sent
+    while it is encoded and never written to disk or held in full in memory.
+
+    Yields:
+        Chunks of the encoded file.
+    """
+    chunks = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+    writer = _QueueWriter(chunks)
+    done = object()
+    errors = []
+
+    def run():
+        try:
+            encode(frames, palette_rgb, export_format, writer, image_name)
+        except Exception as e:
+            if not writer.closed:
+                logging.error(f"Error streaming export: {str(e)}")
+                errors.append(e)
+        finally:
+            chunks.put(done)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is done:
+                break
+            yield chunk
+    finally:
+        # Stop the encoder if the client went away, and drain the queue so it can finish
+        writer.closed = True
+        while thread.is_alive():
+            try:
+                chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        thread.join()
+
+    if errors:
+        raise errors[0]
@@ -0,0 +1,49 @@
+"""
+Gunicorn configuration.
+
+Production: gunicorn -c gunicorn.conf.py main:app
+Development: GUNICORN_RELOAD=1 gunicorn -c gunicorn.conf.py main:app
+
+Palettes imported or generated by a session, palette ids and the files of
+each session live in the worker's memory, so there is a single worker until
+that state is shared. Its threads keep serving downloads, progress streams
+and cancels while one is processing, with single-threaded BLAS/OpenMP to
+avoid oversubscribing the cores. The app, its heavy imports and the palette
+bundle are loaded once in the master before forking, so additional workers
+(GUNICORN_WORKERS) share those pages copy-on-write; every worker warms up
+each processing path before /ready reports it ready.
+"""
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+reuse_port = True
+
+# More workers would each have their own session palettes and palette ids
+workers = int(os.environ.get('GUNICORN_WORKERS', 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+# Longer than the slowest processing deadline (see Config.PROCESSING_DEADLINES)
+timeout = 120
+graceful_timeout = 30
+keepalive = 5
+
+# Code reloading needs the app to be imported in each worker
+reload = os.environ.get('GUNICORN_RELOAD') == '1'
+preload_app = not reload
+
+# Each thread computes on one core rather than competing for all of them.
+# This must be set before NumPy is imported, which the preload does.
+for variable in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+    os.environ.setdefault(variable, os.environ.get('GUNICORN_BLAS_THREADS', '1'))
+
+def post_fork(server, worker):
+    """Drop database connections inherited from the master."""
+    from app import app, db
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+def post_worker_init(worker):
+    """Warm up the worker's processing paths in the background."""
+    from app import app
+    import warmup
+    warmup.start(app.config)
@@ -1,16 +1,234 @@
 import os
 import uuid
-from PIL import Image, ImageEnhance
+import hashlib
+import itertools
+import threading
+from collections import deque, namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageEnhance, ImageSequence, GifImagePlugin
 import numpy as np
 from skimage import color
 from sklearn.cluster import KMeans
+from scipy.spatial import cKDTree
 import logging
+import palette_bundle
+import memory_budget
+import stage_cache
+import profiling
+import shared_arrays
+
+# Number of cells per RGB channel in a palette lookup table (must be a power of two)
+LUT_LEVELS = 32
+# Maximum number of palette lookup tables kept in memory
+MAX_CACHED_LUTS = 64
+# Palettes with at least this many colors are searched through a k-d tree
+# instead of comparing every pixel to every color
+KD_TREE_MIN_COLORS = 768
+# Maximum number of palette k-d trees kept in memory
+MAX_CACHED_TREES = 16
+# Largest palette Pillow can quantize or save indexed frames with
+PIL_MAX_PALETTE_COLORS = 256
+# Images with at most this share of distinct colors are quantized one
+# distinct color at a time, and the results scattered back to the pixels
+UNIQUE_COLORS_MAX_RATIO = 0.5
+# K-means costs much more per sample, so distinct colors pay off sooner
+KMEANS_UNIQUE_COLORS_MAX_RATIO = 0.9
+# Number of pixels sampled to estimate the share of distinct colors
+UNIQUE_COLORS_SAMPLE_SIZE = 4096
+# Ordered dither thresholds (4x4 Bayer matrix), centered on zero
+BAYER_MATRIX = (np.array([
+    [0, 8, 2, 10],
+    [12, 4, 14, 6],
+    [3, 11, 1, 9],
+    [15, 7, 13, 5]
+]) + 0.5) / 16 - 0.5
+# Number of threads quantizing the frames of an animation
+ANIMATION_WORKERS = min(4, os.cpu_count() or 1)
+# Maximum number of output pixels of an animation, over all its upscaled frames
+ANIMATION_MAX_OUTPUT_PIXELS = 256 * 1024 * 1024
+# Maximum number of k-means fits kept in memory
+MAX_CACHED_KMEANS = 16
+# Number of pixels matched to the palette at once (between cancellation checks)
+PIXEL_CHUNK_SIZE = 4096
+# Number of k-means restarts; the best of them is kept
+KMEANS_RESTARTS = 10
+# Maximum width and height of progressive previews
+PREVIEW_SIZE = 64
+# Downscaling methods, see resize_to_fit
+DOWNSCALE_METHODS = ('lanczos', 'box', 'mode', 'edge')
+# Bits kept per channel when voting for the dominant color of a block
+MODE_COLOR_BITS = 5
+# Largest block side pooled by the block downscalers; larger reductions are pre-sampled
+MAX_BLOCK_SIZE = 8
+# Luminance range above which the edge-preserving downscaler keeps a real pixel of the block
+EDGE_CONTRAST_THRESHOLD = 48
+# JPEGs are decoded at a reduced scale (draft) down to this many times the
+# downscaled size, so the Lanczos filter still has enough pixels to average
+JPEG_DRAFT_OVERSAMPLING = 2
+# EXIF orientations and the rotation that corrects them
+EXIF_ROTATIONS = {3: 180, 6: 270, 8: 90}
+# Quantization modes that map luminance bands to the palette (see quantize_tone_map)
+TONE_MAP_MODES = ('tone_map', 'tone_map_hue')
+# Integer luminance weights (0.299, 0.587, 0.114 scaled by 256), as palettes are ordered by
+LUMA_WEIGHTS = (77, 150, 29)
+# Palette colors on each side of a brightness rank the hue-aware tone mapping may pick instead
+TONE_MAP_HUE_NEIGHBORS = 3
+# Largest luminance difference to the tone-mapped color of such an alternative
+TONE_MAP_HUE_TOLERANCE = 24
+
+# sRGB to CIELAB constants (D65 white point, 2 degree observer), as used by skimage.color.rgb2lab
+_SRGB_TO_LINEAR = np.where(
+    np.arange(256) / 255.0 > 0.04045,
+    ((np.arange(256) / 255.0 + 0.055) / 1.055) ** 2.4,
+    np.arange(256) / 255.0 / 12.92
+).astype(np.float32)
+# Linear RGB to XYZ, with each row divided by the white point so the result is already normalized
+_LINEAR_TO_XYZ = (np.array([
+    [0.412453, 0.357580, 0.180423],
+    [0.212671, 0.715160, 0.072169],
+    [0.019334, 0.119193, 0.950227]
+]) / np.array([0.95047, 1.0, 1.08883])[:, None]).T.astype(np.float32)
+
+UniqueColors = namedtuple('UniqueColors', ['colors', 'inverse', 'counts'])
+
+# Cache of palette lookup tables, keyed by (palette path, modification time)
+_palette_luts = {}
+# LRU cache of palette k-d trees, keyed by the digest of the palette's CIELAB colors
+_palette_trees = OrderedDict()
+_palette_trees_lock = threading.Lock()
+# LRU cache of k-means fits, keyed by (pixel digest, pixel shape, number of clusters)
+_kmeans_cache = OrderedDict()
+_kmeans_cache_lock = threading.Lock()
 
 def hex_to_rgb(hex_color):
     """Convert a hex color string to RGB tuple."""
     hex_color = hex_color.lstrip('#')
     return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
 
+def load_palette(palette_path):
+    """
+    Load the RGB, CIELAB and luminance-order arrays of a palette.
+
+    Built-in palettes are served from the memory-mapped palette bundle;
+    other palettes are compiled once, when imported or first used.
+
+    Args:
+        palette_path: The path to the palette file.
+
+    Returns:
+        A palette_bundle.PaletteArrays tuple.
+    """
+    return palette_bundle.load_palette_arrays(palette_path)
+
+def crop_box(size, crop):
+    """
+    Convert a normalized crop rectangle to a pixel box.
+
+    Args:
+        size: The (width, height) of the image.
+        crop: An (x, y, width, height) tuple of fractions of the image size.
+
+    Returns:
+        A (left, top, right, bottom) box of at least one pixel.
+    """
+    width, height = size
+    x, y, crop_width, crop_height = crop
+    left = min(int(round(x * width)), width - 1)
+    top = min(int(round(y * height)), height - 1)
+    right = max(min(int(round((x + crop_width) * width)), width), left + 1)
+    bottom = max(min(int(round((y + crop_height) * height)), height), top + 1)
+    return (left, top, right, bottom)
+
+def _resolution_tuple(max_resolution):
+    """Normalize a 'width,height' string or tuple to a (width, height) tuple of ints."""
+    if isinstance(max_resolution, str):
+        return tuple(map(int, max_resolution.split(',')))
+    return tuple(int(value) for value in max_resolution)
+
+def decode_size(max_resolution, downscale_method="lanczos"):
+    """
+    Get the smallest size an image needs to be decoded at for a downscale.
+
+    The block downscalers pool blocks of up to MAX_BLOCK_SIZE pixels, so
+    they get more source pixels than the Lanczos filter.
+
+    Args:
+        max_resolution: A tuple or 'width,height' string with the maximum size.
+        downscale_method: One of DOWNSCALE_METHODS.
+
+    Returns:
+        A (width, height) tuple.
+    """
+    max_resolution = _resolution_tuple(max_resolution)
+    factor = JPEG_DRAFT_OVERSAMPLING if downscale_method == "lanczos" else MAX_BLOCK_SIZE
+    return (max_resolution[0] * factor, max_resolution[1] * factor)
+
+def _draft_size(img, rotation, crop, min_size):
+    """
+    Get the size to request from Image.draft so that the cropped region,
+    once fitted to min_size, is still reduced and never enlarged.
+    """
+    width, height = img.size
+    if rotation in (90, 270):
+        width, height = height, width
+    if crop:
+        width, height = width * crop[2], height * crop[3]
+    # The fitted size scales both sides by the same factor
+    scale = min(min_size[0] / width, min_size[1] / height)
+    if scale >= 1:
+        return None
+    return (int(np.ceil(img.width * scale)), int(np.ceil(img.height * scale)))
+
+def load_source_image(image_path, crop=None, min_size=None):
+    """
+    Decodes an image file once, applying its EXIF orientation.
+
+    Args:
+        image_path: The path to the image file.
+        crop: Optional (x, y, width, height) rectangle, as fractions of the
+              oriented image size, to keep.
+        min_size: Optional (width, height) the (cropped) image will be fitted
+                  to; JPEGs are then decoded at the smallest DCT scale (1/2,
+                  1/4 or 1/8) that is still at least this large (see decode_size).
+
+    Returns:
+        A fully loaded RGB PIL Image object.
+    """
+    with Image.open(image_path) as img:
+        # Read the EXIF orientation before decoding
+        rotation = None
+        try:
+            exif = img._getexif()
+            if exif is not None:
+                orientation = exif.get(274)  # 274 is the orientation tag
+                rotation = EXIF_ROTATIONS.get(orientation)
+        except:
+            pass  # If EXIF data is corrupted or missing, proceed without rotation
+        
+        # Let the JPEG decoder skip the detail that the downscale discards
+        if min_size and img.format == 'JPEG':
+            draft_size = _draft_size(img, rotation, crop, min_size)
+            if draft_size:
+                img.draft(None, draft_size)
+        
+        # Refuse images that decode to more than the request's memory budget
+        # (the decoded pixels plus their RGB copy) before decoding them
+        memory_budget.charge(img.width * img.height * (len(img.getbands()) + 3), "Decoding the image")
+        
+        # Apply EXIF orientation
+        if rotation is not None:
+            img = img.rotate(rotation, expand=True)
+        
+        # Drop the discarded pixels before anything else touches them
+        if crop:
+            img = img.crop(crop_box(img.size, crop))
+        
+        # The quantizers work on RGB pixels; converting also copies the decoded
+        # pixels (the first frame of animations) out of the file before it closes
+        img = img.convert('RGB')
+    
+    return img
+
 def downscale_image(image_path, max_resolution=(512, 512)):
     """
     Downscales an image to a maximum resolution while maintaining aspect ratio and orientation.
@@ -24,117 +242,459 @@ def downscale_image(image_path, max_resolution=(512, 512)):
         A PIL Image object representing the downscaled image.
     """
     try:
-        # Open the image
-        with Image.open(image_path) as img:
-            # Apply EXIF orientation
-            try:
-                exif = img._getexif()
-                if exif is not None:
-                    orientation = exif.get(274)  # 274 is the orientation tag
-                    if orientation is not None:
-                        # Rotation values to correct image orientation
-                        rotate_values = {
-                            3: 180,
-                            6: 270,
-                            8: 90
-                        }
-                        if orientation in rotate_values:
-                            img = img.rotate(rotate_values[orientation], expand=True)
-            except:
-                pass  # If EXIF data is corrupted or missing, proceed without rotation
-                
-            # Convert to RGB if the image is in RGBA mode
-            if img.mode == 'RGBA':
-                img = img.convert('RGB')
-                
-            # Get the original dimensions
-            width, height = img.size
-            
-            # Parse max_resolution if it's a string
-            if isinstance(max_resolution, str):
-                max_width, max_height = map(int, max_resolution.split(','))
-            else:
-                max_width, max_height = max_resolution
-            
-            # Calculate the scaling factor to maintain aspect ratio
-            scale_width = max_width / width
-            scale_height = max_height / height
-            scale = min(scale_width, scale_height)
-            
-            # Calculate the new dimensions
-            new_width = int(width * scale)
-            new_height = int(height * scale)
-            
-            # Resize the image
-            resized_img = img.resize((new_width, new_height), Image.LANCZOS)
-            
-            return resized_img
+        return resize_to_fit(load_source_image(image_path), max_resolution)
     except Exception as e:
         logging.error(f"Error downscaling image: {str(e)}")
         raise
 
+def resize_to_fit(img, max_resolution=(512, 512), reducing_gap=None, method="lanczos"):
+    """
+    Resizes a PIL image to fit a maximum resolution while maintaining aspect ratio.
+
+    Args:
+        img: A PIL Image object.
+        max_resolution: A tuple or 'width,height' string with the maximum size.
+        reducing_gap: Optional PIL reducing gap; trades some quality for speed
+                      on large reductions by shrinking with Image.reduce first.
+        method: One of DOWNSCALE_METHODS. 'lanczos' resamples smoothly; the
+                other methods pool blocks of pixels, see block_downscale.
+
+    Returns:
+        The resized PIL Image object.
+    """
+    # Get the original dimensions
+    width, height = img.size
+    
+    # Parse max_resolution if it's a string
+    if isinstance(max_resolution, str):
+        max_width, max_height = map(int, max_resolution.split(','))
+    else:
+        max_width, max_height = max_resolution
+    
+    # Calculate the scaling factor to maintain aspect ratio
+    scale_width = max_width / width
+    scale_height = max_height / height
+    scale = min(scale_width, scale_height)
+    
+    # Calculate the new dimensions
+    new_width = int(width * scale)
+    new_height = int(height * scale)
+    
+    # Resize the image
+    if method != "lanczos":
+        return block_downscale(img, (new_width, new_height), method)
+    return img.resize((new_width, new_height), Image.LANCZOS, reducing_gap=reducing_gap)
+
+def _pool_blocks(blocks, method):
+    """
+    Reduce blocks of pixels to one color each.
+
+    Args:
+        blocks: A (H, W, K, 3) uint8 array holding the K pixels of each block.
+        method: 'box', 'mode' or 'edge'.
+
+    Returns:
+        A (H, W, 3) uint8 array.
+    """
+    mean = blocks.mean(axis=2, dtype=np.float32)
+    if method == "box":
+        return np.rint(mean).astype(np.uint8)
+    
+    if method == "mode":
+        # Vote on coarse color bins so near-identical colors count together
+        shift = 8 - MODE_COLOR_BITS
+        coarse = (blocks >> shift).astype(np.uint32)
+        codes = (coarse[..., 0] << (2 * MODE_COLOR_BITS)) | (coarse[..., 1] << MODE_COLOR_BITS) | coarse[..., 2]
+        
+        # Length of the run of equal codes ending at each position of the sorted codes
+        ordered = np.sort(codes, axis=2)
+        new_run = np.ones(ordered.shape, dtype=bool)
+        new_run[..., 1:] = ordered[..., 1:] != ordered[..., :-1]
+        positions = np.arange(ordered.shape[2], dtype=np.int16)
+        run_starts = np.maximum.accumulate(np.where(new_run, positions, 0).astype(np.int16), axis=2)
+        run_lengths = positions - run_starts + 1
+        winner = np.take_along_axis(ordered, run_lengths.argmax(axis=2)[..., None], axis=2)
+        
+        # The dominant color is the average of the pixels in the winning bin;
+        # blocks without any repeated color fall back to the block average
+        members = codes == winner
+        counts = members.sum(axis=2)
+        dominant = (blocks * members[..., None]).sum(axis=2, dtype=np.float32) / counts[..., None]
+        return np.rint(np.where(counts[..., None] > 1, dominant, mean)).astype(np.uint8)
+    
+    if method == "edge":
+        # Smooth blocks are averaged; blocks across an edge keep the real pixel
+        # closest to the block average, so no blended in-between colors appear
+        luma = blocks.astype(np.float32) @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+        contrast = luma.max(axis=2) - luma.min(axis=2)
+        nearest = ((blocks - mean[:, :, None, :]) ** 2).sum(axis=3).argmin(axis=2)
+        representative = np.take_along_axis(blocks, nearest[:, :, None, None], axis=2)[:, :, 0]
+        return np.where((contrast > EDGE_CONTRAST_THRESHOLD)[..., None], representative, np.rint(mean).astype(np.uint8))
+    
+    raise ValueError(f"Unknown downscale method: {method}")
+
+def block_downscale(img, size, method="box"):
+    """
+    Downscale an image by pooling square blocks of pixels.
+
+    The image is first brought to an exact multiple k of the target size
+    (k <= MAX_BLOCK_SIZE) with nearest-neighbor sampling, which keeps the
+    original colors, or a box filter for 'box'. It is then split into
+    k x k blocks with a reshape and each block is reduced to one color:
+    'box' averages it, 'mode' keeps its dominant color and 'edge' averages
+    smooth blocks but keeps a real pixel of blocks that cross an edge.
+    Blocks are pooled in strips of rows to bound the working memory.
+
+    Args:
+        img: An RGB (or RGBX) PIL Image.
+        size: The (width, height) of the result.
+        method: 'box', 'mode' or 'edge'.
+
+    Returns:
+        The downscaled RGB PIL Image.
+    """
+    if method not in DOWNSCALE_METHODS:
+        raise ValueError(f"Unknown downscale method: {method}")
+    
+    width, height = size
+    k = min(img.width // width, img.height // height, MAX_BLOCK_SIZE)
+    resample = Image.BOX if method == "box" else Image.NEAREST
+    if k < 2:
+        # Nothing to pool; keep the colors of the source
+        return img.resize(size, resample)
+    
+    if img.size != (width * k, height * k):
+        img = img.resize((width * k, height * k), resample)
+    
+    # RGBX sources (see as_source_image) keep their padding channel until here
+    pixels = np.asarray(img)[..., :3]
+    result = np.empty((height, width, 3), dtype=np.uint8)
+    strip_rows = max(1, PIXEL_CHUNK_SIZE * 64 // (width * k * k))
+    with memory_budget.reserve(pixels.nbytes, "Downscaling the image"):
+        for top in range(0, height, strip_rows):
+            rows = min(strip_rows, height - top)
+            strip = pixels[top * k:(top + rows) * k]
+            # (rows, k, W, k, 3) -> (rows, W, k * k, 3): one row of pixels per block
+            blocks = strip.reshape(rows, k, width, k, 3).swapaxes(1, 2).reshape(rows, width, k * k, 3)
+            result[top:top + rows] = _pool_blocks(blocks, method)
+    return Image.fromarray(result)
+
 def enhance_contrast(image):
     """Enhance the contrast of an image."""
     enhancer = ImageEnhance.Contrast(image)
     return enhancer.enhance(1.5)  # Increase contrast by 50%
 
-def quantize_to_palette_cielab(image, palette_path):
+def _check_cancelled(cancel_token):
+    """Abort processing if the job's cancel token was triggered."""
+    if cancel_token is not None:
+        cancel_token.check()
+
+def rgb_to_lab(pixels, out, scratch):
+    """
+    Convert uint8 RGB pixels to float32 CIELAB without temporary full-size arrays.
+
+    Args:
+        pixels: A (N, 3) uint8 array of RGB pixels.
+        out: A (N, 3) float32 array receiving the CIELAB values.
+        scratch: A (N, 3) float32 working buffer.
+
+    Returns:
+        out.
+    """
+    # Linearize through a lookup table, then convert to white-normalized XYZ
+    np.take(_SRGB_TO_LINEAR, pixels, out=scratch)
+    np.matmul(scratch, _LINEAR_TO_XYZ, out=out)
+    
+    # f(t) of the CIELAB definition, in place in the scratch buffer
+    small = out <= 0.008856
+    np.cbrt(out, out=scratch)
+    scratch[small] = out[small] * 7.787 + 16 / 116
+    
+    fx, fy, fz = scratch[:, 0], scratch[:, 1], scratch[:, 2]
+    np.multiply(fy, 116, out=out[:, 0])
+    out[:, 0] -= 16
+    np.subtract(fx, fy, out=out[:, 1])
+    out[:, 1] *= 500
+    np.subtract(fy, fz, out=out[:, 2])
+    out[:, 2] *= 200
+    return out
+
+def get_palette_tree(palette_lab):
+    """
+    Get the (cached) k-d tree of a palette's CIELAB colors.
+
+    Args:
+        palette_lab: A (K, 3) array of the CIELAB values of the palette.
+
+    Returns:
+        A scipy.spatial.cKDTree over the colors.
+    """
+    key = stage_cache.array_digest(np.asarray(palette_lab, dtype=np.float32))
+    with _palette_trees_lock:
+        tree = _palette_trees.get(key)
+        if tree is not None:
+            _palette_trees.move_to_end(key)
+            return tree
+    
+    tree = cKDTree(np.asarray(palette_lab, dtype=np.float64))
+    with _palette_trees_lock:
+        _palette_trees[key] = tree
+        while len(_palette_trees) > MAX_CACHED_TREES:
+            _palette_trees.popitem(last=False)
+    return tree
+
+def map_to_nearest_colors(pixels, palette_lab, out, cancel_token=None):
+    """
+    Map RGB pixels to the index of their nearest palette color in CIELAB space.
+
+    Pixels are converted and matched in chunks of PIXEL_CHUNK_SIZE with
+    float32 working buffers borrowed from the worker's buffer pool, so the
+    memory used does not depend on the image size. Palettes of
+    KD_TREE_MIN_COLORS or more are searched through a k-d tree, so the cost
+    per pixel grows with the logarithm of the palette size rather than
+    linearly.
+
+    Args:
+        pixels: A (N, 3) uint8 array of RGB pixels.
+        palette_lab: A (K, 3) array of the CIELAB values of the palette.
+        out: A (N,) integer array receiving the palette indices.
+        cancel_token: Optional job_control.CancelToken checked between chunks.
+
+    Returns:
+        out.
+    """
+    palette_lab = np.asarray(palette_lab, dtype=np.float32)
+    if len(palette_lab) >= KD_TREE_MIN_COLORS:
+        return _map_with_tree(pixels, get_palette_tree(palette_lab), out, cancel_token)
+    
+    # Squared distances are |x|^2 - 2 x.p + |p|^2; |x|^2 does not change the argmin
+    palette_lab_t = np.ascontiguousarray(palette_lab.T * -2)
+    palette_norms = (palette_lab ** 2).sum(axis=1)
+    
+    chunk_size = max(1, min(PIXEL_CHUNK_SIZE, len(pixels)))
+    with memory_budget.borrow((chunk_size, 3), np.float32) as lab, \
+            memory_budget.borrow((chunk_size, 3), np.float32) as scratch, \
+            memory_budget.borrow((chunk_size, len(palette_lab)), np.float32) as distances:
+        for start in range(0, len(pixels), chunk_size):
+            _check_cancelled(cancel_token)
+            chunk = pixels[start:start + chunk_size]
+            n = len(chunk)
+            rgb_to_lab(chunk, lab[:n], scratch[:n])
+            np.matmul(lab[:n], palette_lab_t, out=distances[:n])
+            distances[:n] += palette_norms
+            out[start:start + n] = np.argmin(distances[:n], axis=1)
+    return out
+
+def _map_with_tree(pixels, tree, out, cancel_token=None):
+    """Map RGB pixels to their nearest palette color through the palette's k-d tree, see map_to_nearest_colors."""
+    chunk_size = max(1, min(PIXEL_CHUNK_SIZE, len(pixels)))
+    with memory_budget.borrow((chunk_size, 3), np.float32) as lab, \
+            memory_budget.borrow((chunk_size, 3), np.float32) as scratch:
+        for start in range(0, len(pixels), chunk_size):
+            _check_cancelled(cancel_token)
+            chunk = pixels[start:start + chunk_size]
+            n = len(chunk)
+            rgb_to_lab(chunk, lab[:n], scratch[:n])
+            _, out[start:start + n] = tree.query(lab[:n], k=1)
+    return out
+
+def ordered_dither_to_palette(image, palette, cancel_token=None):
+    """
+    Map an image to a palette with ordered (Bayer) dithering.
+
+    Used instead of Pillow's Floyd-Steinberg quantize for palettes larger
+    than Pillow supports. The dither amplitude is the spacing of a uniform
+    color grid with as many colors as the palette.
+
+    Args:
+        image: A PIL Image in RGB mode.
+        palette: A palette_bundle.PaletteArrays tuple.
+        cancel_token: Optional job_control.CancelToken.
+
+    Returns:
+        A (H, W) uint16 array of palette indices.
+    """
+    width, height = image.size
+    spread = 255.0 / np.cbrt(len(palette.rgb))
+    with memory_budget.reserve(width * height * (3 * 2 + 3 + 2), "Dithered image"):
+        rows, columns = np.ogrid[:height, :width]
+        thresholds = (BAYER_MATRIX[rows % 4, columns % 4] * spread).astype(np.float32)[..., None]
+        dithered = np.clip(np.asarray(image, dtype=np.float32) + thresholds, 0, 255).astype(np.uint8)
+        indices = map_to_nearest_colors(dithered.reshape(-1, 3), palette.lab, np.empty(width * height, dtype=np.uint16), cancel_token)
+    return indices.reshape(height, width)
+
+def _pack_rgb(pixels):
+    """Pack (N, 3) uint8 RGB pixels into (N,) uint32 values."""
+    pixels = np.asarray(pixels, dtype=np.uint8)
+    return (pixels[:, 0].astype(np.uint32) << 16) | (pixels[:, 1].astype(np.uint32) << 8) | pixels[:, 2]
+
+def find_unique_colors(pixels, max_ratio=UNIQUE_COLORS_MAX_RATIO, min_colors=1):
+    """
+    Find the distinct colors of pixels, when quantizing them instead pays off.
+
+    Downscaled photos have far fewer distinct colors than pixels, and pixel
+    art a few dozen. The share of distinct colors is first estimated on a
+    sample, so images of mostly distinct colors skip the full pass. The path
+    taken is recorded with the request's stage outcomes (see
+    stage_cache.track). The caller's memory reservation must cover 12 bytes
+    per pixel.
+
+    Args:
+        pixels: A (N, 3) uint8 array of RGB pixels.
+        max_ratio: The largest share of distinct colors worth the detour.
+        min_colors: The smallest number of distinct colors the caller can use.
+
+    Returns:
+        A UniqueColors tuple of the (U, 3) distinct colors, the (N,) index of
+        each pixel's color and the (U,) pixel count of each color, or None if
+        the pixels should be quantized directly.
+    """
+    step = max(1, len(pixels) // UNIQUE_COLORS_SAMPLE_SIZE)
+    sample = _pack_rgb(pixels[::step])
+    sample_ratio = len(np.unique(sample)) / max(len(sample), 1)
+    if sample_ratio > max_ratio:
+        stage_cache.record_detail('quantize', {'path': 'direct', 'unique_ratio': round(sample_ratio, 4)})
+        return None
+    
+    packed, inverse, counts = np.unique(_pack_rgb(pixels), return_inverse=True, return_counts=True)
+    ratio = len(packed) / len(pixels)
+    if len(packed) < min_colors:
+        stage_cache.record_detail('quantize', {'path': 'direct', 'unique_ratio': round(ratio, 4)})
+        return None
+    
+    stage_cache.record_detail('quantize', {'path': 'unique', 'unique_ratio': round(ratio, 4)})
+    colors = np.empty((len(packed), 3), dtype=np.uint8)
+    colors[:, 0] = packed >> 16
+    colors[:, 1] = (packed >> 8) & 0xFF
+    colors[:, 2] = packed & 0xFF
+    return UniqueColors(colors=colors, inverse=inverse.reshape(-1), counts=counts)
+
+def quantize_to_palette_cielab(image, palette_path, cancel_token=None):
     """Quantize an image to a color palette using CIELAB color space."""
     try:
-        # Read the palette colors
-        with open(palette_path, 'r') as f:
-            palette_colors = [hex_to_rgb(line.strip()) for line in f if line.strip()]
-        
-        # Convert the image to a numpy array
-        img_array = np.array(image)
-        
-        # Reshape the array to a list of pixels
-        pixels = img_array.reshape(-1, 3)
-        
-        # Convert to CIELAB color space
-        lab_pixels = color.rgb2lab(pixels / 255.0)
-        lab_palette = color.rgb2lab(np.array(palette_colors) / 255.0)
-        
-        # For each pixel, find the closest palette color in CIELAB space
-        result = np.zeros_like(pixels)
-        for i, pixel in enumerate(lab_pixels):
-            # Calculate the Euclidean distance to each palette color
-            distances = np.sqrt(np.sum((lab_palette - pixel) ** 2, axis=1))
-            # Find the index of the closest palette color
-            closest_index = np.argmin(distances)
-            # Use the RGB value from the palette
-            result[i] = palette_colors[closest_index]
+        # Load the palette colors and their precomputed CIELAB values
+        palette = load_palette(palette_path)
         
-        # Reshape back to an image
-        result = result.reshape(img_array.shape)
+        # Reshape the image to a list of pixels
+        pixels = np.asarray(image).reshape(-1, 3)
         
-        # Create a new PIL image from the result
-        return Image.fromarray(result.astype('uint8'))
+        # Find the closest palette color of each pixel in CIELAB space,
+        # matching each distinct color once when there are few of them
+        index_dtype = np.uint8 if len(palette.rgb) <= 256 else np.uint16
+        with memory_budget.reserve(len(pixels) * (np.dtype(index_dtype).itemsize + 3 + 12), "Quantized image"):
+            unique = find_unique_colors(pixels)
+            if unique is not None:
+                unique_indices = map_to_nearest_colors(unique.colors, palette.lab, np.empty(len(unique.colors), dtype=index_dtype), cancel_token)
+                indices = unique_indices[unique.inverse]
+            else:
+                indices = map_to_nearest_colors(pixels, palette.lab, np.empty(len(pixels), dtype=index_dtype), cancel_token)
+            
+            # Use the RGB value of the closest palette color
+            result = np.asarray(palette.rgb)[indices].reshape(image.height, image.width, 3)
+            
+            # Create a new PIL image from the result
+            return Image.fromarray(result)
     except Exception as e:
         logging.error(f"Error quantizing image with CIELAB: {str(e)}")
         raise
 
-def quantize_with_edge_emphasis(image, palette_path):
+def make_palette_image(palette_colors):
+    """
+    Create a 'P' mode PIL image carrying a palette, for use with Image.quantize.
+
+    Args:
+        palette_colors: A (N, 3) array of RGB colors.
+
+    Returns:
+        A 1x1 PIL Image whose palette holds the colors.
+    """
+    # Create a flat list of RGB values for PIL
+    flat_palette = np.asarray(palette_colors, dtype=np.uint8).flatten().tolist()
+    
+    # Ensure the palette has 256 entries (required by PIL)
+    while len(flat_palette) < PIL_MAX_PALETTE_COLORS * 3:
+        flat_palette.extend(flat_palette[:3])
+    flat_palette = flat_palette[:PIL_MAX_PALETTE_COLORS * 3]
+    
+    palette_img = Image.new('P', (1, 1))
+    palette_img.putpalette(flat_palette)
+    return palette_img
+
+def build_palette_lut(palette_colors, palette_lab):
+    """
+    Build a lookup table mapping quantized RGB values to the nearest palette color.
+
+    The RGB cube is divided into LUT_LEVELS^3 cells and the center of each
+    cell is matched to the nearest palette color in CIELAB space, so mapping
+    an image afterwards costs one table lookup per pixel.
+
+    Args:
+        palette_colors: A (N, 3) array of RGB colors.
+        palette_lab: A (N, 3) array of the CIELAB values of the colors.
+
+    Returns:
+        A (LUT_LEVELS, LUT_LEVELS, LUT_LEVELS) array of palette indices.
+    """
+    step = 256 // LUT_LEVELS
+    levels = np.arange(LUT_LEVELS, dtype=np.uint8) * step + step // 2
+    grid = np.stack(np.meshgrid(levels, levels, levels, indexing='ij'), axis=-1).reshape(-1, 3)
+
+    index_dtype = np.uint8 if len(palette_colors) <= 256 else np.uint16
+    lut = map_to_nearest_colors(grid, palette_lab, np.empty(len(grid), dtype=index_dtype))
+
+    return lut.reshape(LUT_LEVELS, LUT_LEVELS, LUT_LEVELS)
+
+def get_palette_lut(palette_path):
+    """
+    Get the (cached) lookup table of a palette file.
+
+    Args:
+        palette_path: The path to the palette file.
+
+    Returns:
+        The lookup table built by build_palette_lut.
+    """
+    key = (os.path.realpath(palette_path), os.path.getmtime(palette_path))
+    lut = _palette_luts.get(key)
+    if lut is None:
+        palette = load_palette(palette_path)
+        lut = build_palette_lut(palette.rgb, palette.lab)
+        if len(_palette_luts) >= MAX_CACHED_LUTS:
+            _palette_luts.clear()
+        _palette_luts[key] = lut
+    return lut
+
+def apply_palette_lut(img_array, lut):
+    """
+    Map an RGB image array to palette indices through a lookup table.
+
+    Args:
+        img_array: A (H, W, 3) uint8 array.
+        lut: A lookup table built by build_palette_lut.
+
+    Returns:
+        A (H, W) array of palette indices.
+    """
+    shift = 8 - (LUT_LEVELS.bit_length() - 1)
+    cells = np.asarray(img_array, dtype=np.uint8) >> shift
+    return lut[cells[..., 0], cells[..., 1], cells[..., 2]]
+
+def quantize_with_edge_emphasis(image, palette_path, cancel_token=None):
     """Quantize an image to a color palette with edge emphasis."""
     try:
+        _check_cancelled(cancel_token)
+        
         # Enhance contrast to emphasize edges
         enhanced_img = enhance_contrast(image)
         
-        # Read the palette colors
-        with open(palette_path, 'r') as f:
-            palette_colors = [hex_to_rgb(line.strip()) for line in f if line.strip()]
-        
-        # Create a flat list of RGB values for PIL
-        flat_palette = [component for color in palette_colors for component in color]
-        
-        # Ensure the palette has 256 entries (required by PIL)
-        while len(flat_palette) < 256 * 3:
-            flat_palette.extend(flat_palette[:3])
-        flat_palette = flat_palette[:256 * 3]
+        palette = load_palette(palette_path)
+        if len(palette.rgb) > PIL_MAX_PALETTE_COLORS:
+            # Pillow's quantize would drop the colors past 256
+            indices = ordered_dither_to_palette(enhanced_img, palette, cancel_token)
+            return Image.fromarray(np.asarray(palette.rgb)[indices])
         
         # Create a new palette image
-        palette_img = Image.new('P', (1, 1))
-        palette_img.putpalette(flat_palette)
+        palette_img = make_palette_image(palette.rgb)
         
         # Convert the image to the palette
         quantized_img = enhanced_img.quantize(palette=palette_img, dither=Image.FLOYDSTEINBERG)
@@ -145,44 +705,165 @@ def quantize_with_edge_emphasis(image, palette_path):
         logging.error(f"Error quantizing image with edge emphasis: {str(e)}")
         raise
 
-def quantize_kmeans(image, palette_path):
+def _find_kmeans_samples(pixels, n_colors):
+    """Get the distinct colors to cluster instead of the pixels, or None (see find_unique_colors)."""
+    if pixels.dtype != np.uint8:
+        return None
+    # With fewer distinct colors than clusters, k-means runs on the pixels as before
+    return find_unique_colors(pixels, KMEANS_UNIQUE_COLORS_MAX_RATIO, min_colors=n_colors)
+
+def fit_kmeans(pixels, n_colors, init_centers=None, cancel_token=None):
+    """
+    Cluster pixels with k-means.
+
+    When there are few distinct colors, the distinct colors are clustered
+    instead, weighted by their pixel counts (the same objective on fewer
+    samples), and the labels scattered back to the pixels.
+
+    Args:
+        pixels: A (N, 3) array of RGB pixels.
+        n_colors: The number of clusters.
+        init_centers: Optional (n_colors, 3) array of cluster centers to warm
+                      start from, e.g. the centers of the previous video frame.
+        cancel_token: Optional job_control.CancelToken checked between restarts.
+
+    Returns:
+        A (cluster_centers, labels) tuple. Results of full fits are cached per
+        pixel content and number of clusters and must not be modified.
+    """
+    if init_centers is not None and len(init_centers) == n_colors:
+        # A single run from known centers converges in a few iterations
+        kmeans = KMeans(n_clusters=n_colors, init=np.asarray(init_centers, dtype=np.float64), n_init=1)
+        unique = _find_kmeans_samples(pixels, n_colors)
+        if unique is None:
+            kmeans.fit(pixels)
+            return kmeans.cluster_centers_, kmeans.labels_
+        kmeans.fit(unique.colors, sample_weight=unique.counts)
+        return kmeans.cluster_centers_, kmeans.labels_[unique.inverse]
+    
+    # The clustering does not depend on the palette, so swapping the palette
+    # of an image only needs to remap the cached cluster centers
+    pixels = np.ascontiguousarray(pixels)
+    digest = hashlib.blake2b(pixels.tobytes(), digest_size=16).digest()
+    key = (digest, pixels.shape, n_colors)
+    
+    with _kmeans_cache_lock:
+        cached = _kmeans_cache.get(key)
+        if cached is not None:
+            _kmeans_cache.move_to_end(key)
+            return cached
+    
+    unique = _find_kmeans_samples(pixels, n_colors)
+    samples, weights = (pixels, None) if unique is None else (unique.colors, unique.counts)
+    
+    # Run the restarts one by one (like n_init does) so a cancelled or
+    # overdue job stops between them, and keep the best clustering
+    seeds = np.random.RandomState(42).randint(np.iinfo(np.int32).max, size=KMEANS_RESTARTS)
+    kmeans = None
+    for seed in seeds:
+        _check_cancelled(cancel_token)
+        candidate = KMeans(n_clusters=n_colors, random_state=seed, n_init=1)
+        candidate.fit(samples, sample_weight=weights)
+        if kmeans is None or candidate.inertia_ < kmeans.inertia_:
+            kmeans = candidate
+    
+    # Labels fit in a byte since n_colors is at most 16
+    cluster_centers = kmeans.cluster_centers_
+    labels = kmeans.labels_ if unique is None else kmeans.labels_[unique.inverse]
+    labels = labels.astype(np.uint8 if n_colors <= 256 else np.int32)
+    cluster_centers.flags.writeable = False
+    labels.flags.writeable = False
+    
+    with _kmeans_cache_lock:
+        _kmeans_cache[key] = (cluster_centers, labels)
+        while len(_kmeans_cache) > MAX_CACHED_KMEANS:
+            _kmeans_cache.popitem(last=False)
+    
+    return cluster_centers, labels
+
+def map_clusters_to_palette(cluster_centers, palette_colors):
+    """
+    Map each cluster center to the closest palette color.
+
+    Args:
+        cluster_centers: A (K, 3) array of cluster centers.
+        palette_colors: A (N, 3) array of RGB palette colors.
+
+    Returns:
+        A (K, 3) uint8 array with the palette color of each cluster.
+    """
+    # Calculate the Euclidean distance of each center to each palette color
+    distances = np.sqrt(np.sum((palette_colors[None, :, :] - cluster_centers[:, None, :]) ** 2, axis=2))
+    # Map each cluster to the closest palette color
+    return np.asarray(palette_colors, dtype=np.uint8)[np.argmin(distances, axis=1)]
+
+def map_clusters_by_brightness(cluster_centers, palette_colors, luma_order):
+    """
+    Map cluster centers to palette colors with the same brightness rank.
+
+    Args:
+        cluster_centers: A (K, 3) array of cluster centers.
+        palette_colors: A (N, 3) array of RGB palette colors.
+        luma_order: Indices sorting palette_colors by luminance.
+
+    Returns:
+        A (K, 3) uint8 array with the palette color of each cluster.
+    """
+    # Palette colors sorted by brightness (luminance), precomputed with the palette
+    sorted_palette = np.asarray(palette_colors, dtype=np.uint8)[luma_order]
+    
+    # Sort cluster centers by brightness
+    cluster_brightness = [0.299 * r + 0.587 * g + 0.114 * b for r, g, b in cluster_centers]
+    sorted_cluster_indices = np.argsort(cluster_brightness)
+    
+    # Map clusters to palette colors based on brightness order
+    cluster_to_palette = np.zeros((len(cluster_centers), 3), dtype=np.uint8)
+    for i, cluster_idx in enumerate(sorted_cluster_indices):
+        # Map to a palette color with similar brightness position
+        palette_idx = min(i, len(sorted_palette) - 1)
+        cluster_to_palette[cluster_idx] = sorted_palette[palette_idx]
+    
+    return cluster_to_palette
+
+def quantize_kmeans_array(img_array, palette_path, brightness=False, init_centers=None, cancel_token=None):
+    """
+    Quantize an RGB array with k-means and map the clusters to a palette.
+
+    Args:
+        img_array: A (H, W, 3) uint8 array.
+        palette_path: The path to the palette file.
+        brightness: Map clusters by brightness rank instead of closest color.
+        init_centers: Optional cluster centers to warm start k-means from.
+        cancel_token: Optional job_control.CancelToken.
+
+    Returns:
+        A (result_array, cluster_centers) tuple.
+    """
+    palette = load_palette(palette_path)
+    
+    # Reshape the array to a list of pixels
+    pixels = img_array.reshape(-1, 3)
+    
+    # Apply k-means clustering
+    n_colors = min(16, len(palette.rgb))  # Limit to 16 colors or palette size
+    # K-means works on float64 pixels and keeps a distance per pixel and cluster
+    with memory_budget.reserve(len(pixels) * (3 * 8 + 4 + n_colors * 8), "K-means clustering"):
+        cluster_centers, labels = fit_kmeans(pixels, n_colors, init_centers, cancel_token)
+    
+    if brightness:
+        cluster_to_palette = map_clusters_by_brightness(cluster_centers, palette.rgb, palette.luma_order)
+    else:
+        cluster_to_palette = map_clusters_to_palette(cluster_centers, palette.rgb)
+    
+    # Replace each pixel with its corresponding palette color
+    result = cluster_to_palette[labels].reshape(img_array.shape)
+    
+    return result, cluster_centers
+
+def quantize_kmeans(image, palette_path, cancel_token=None):
     """Quantizes an image using k-means clustering and closest palette color matching."""
     try:
-        # Read the palette colors
-        with open(palette_path, 'r') as f:
-            palette_colors = [hex_to_rgb(line.strip()) for line in f if line.strip()]
-        
-        # Convert the image to a numpy array
-        img_array = np.array(image)
-        original_shape = img_array.shape
-        
-        # Reshape the array to a list of pixels
-        pixels = img_array.reshape(-1, 3)
-        
-        # Apply k-means clustering
-        n_colors = min(16, len(palette_colors))  # Limit to 16 colors or palette size
-        kmeans = KMeans(n_clusters=n_colors, random_state=42, n_init=10)
-        kmeans.fit(pixels)
-        
-        # Get the cluster centers and labels
-        cluster_centers = kmeans.cluster_centers_
-        labels = kmeans.labels_
-        
-        # For each cluster center, find the closest palette color
-        cluster_to_palette = {}
-        for i, center in enumerate(cluster_centers):
-            # Calculate the Euclidean distance to each palette color
-            distances = np.sqrt(np.sum((np.array(palette_colors) - center) ** 2, axis=1))
-            # Find the index of the closest palette color
-            closest_index = np.argmin(distances)
-            # Map this cluster to the palette color
-            cluster_to_palette[i] = palette_colors[closest_index]
-        
-        # Replace each pixel with its corresponding palette color
-        result = np.array([cluster_to_palette[label] for label in labels], dtype=np.uint8)
-        
-        # Reshape back to an image
-        result = result.reshape(original_shape)
+        result, _ = quantize_kmeans_array(np.array(image), palette_path, cancel_token=cancel_token)
         
         # Create a new PIL image from the result
         return Image.fromarray(result)
@@ -190,50 +871,10 @@ def quantize_kmeans(image, palette_path):
         logging.error(f"Error quantizing image with k-means: {str(e)}")
         raise
 
-def quantize_kmeans_brightness(image, palette_path):
+def quantize_kmeans_brightness(image, palette_path, cancel_token=None):
     """Quantizes an image using k-means and brightness-based palette mapping."""
     try:
-        # Read the palette colors
-        with open(palette_path, 'r') as f:
-            palette_colors = [hex_to_rgb(line.strip()) for line in f if line.strip()]
-        
-        # Convert the image to a numpy array
-        img_array = np.array(image)
-        original_shape = img_array.shape
-        
-        # Reshape the array to a list of pixels
-        pixels = img_array.reshape(-1, 3)
-        
-        # Apply k-means clustering
-        n_colors = min(16, len(palette_colors))  # Limit to 16 colors or palette size
-        kmeans = KMeans(n_clusters=n_colors, random_state=42, n_init=10)
-        kmeans.fit(pixels)
-        
-        # Get the cluster centers and labels
-        cluster_centers = kmeans.cluster_centers_
-        labels = kmeans.labels_
-        
-        # Sort palette colors by brightness (luminance)
-        palette_brightness = [0.299 * r + 0.587 * g + 0.114 * b for r, g, b in palette_colors]
-        sorted_palette_indices = np.argsort(palette_brightness)
-        sorted_palette = [palette_colors[i] for i in sorted_palette_indices]
-        
-        # Sort cluster centers by brightness
-        cluster_brightness = [0.299 * r + 0.587 * g + 0.114 * b for r, g, b in cluster_centers]
-        sorted_cluster_indices = np.argsort(cluster_brightness)
-        
-        # Map clusters to palette colors based on brightness order
-        cluster_to_palette = {}
-        for i, cluster_idx in enumerate(sorted_cluster_indices):
-            # Map to a palette color with similar brightness position
-            palette_idx = min(i, len(sorted_palette) - 1)
-            cluster_to_palette[cluster_idx] = sorted_palette[palette_idx]
-        
-        # Replace each pixel with its corresponding palette color
-        result = np.array([cluster_to_palette[label] for label in labels], dtype=np.uint8)
-        
-        # Reshape back to an image
-        result = result.reshape(original_shape)
+        result, _ = quantize_kmeans_array(np.array(image), palette_path, brightness=True, cancel_token=cancel_token)
         
         # Create a new PIL image from the result
         return Image.fromarray(result)
@@ -241,6 +882,212 @@ def quantize_kmeans_brightness(image, palette_path):
         logging.error(f"Error quantizing image with k-means brightness: {str(e)}")
         raise
 
+def compute_luma(pixels):
+    """Compute the integer luminance (0-255) of (N, 3) uint8 RGB pixels."""
+    pixels = np.asarray(pixels, dtype=np.uint8)
+    luma = pixels[:, 0].astype(np.uint16) * LUMA_WEIGHTS[0]
+    luma += pixels[:, 1].astype(np.uint16) * LUMA_WEIGHTS[1]
+    luma += pixels[:, 2].astype(np.uint16) * LUMA_WEIGHTS[2]
+    luma += 128
+    return (luma >> 8).astype(np.uint8)
+
+def build_tone_map_lut(luma, n_colors):
+    """
+    Equalize the luminance histogram of an image onto palette brightness ranks.
+
+    Each luminance level is assigned the rank at the middle of its share of
+    the cumulative histogram, so every rank covers about the same number
+    of pixels, like the brightness-ordered clusters of k-means would.
+
+    Args:
+        luma: A (N,) uint8 array of pixel luminances.
+        n_colors: The number of palette colors.
+
+    Returns:
+        A (256,) array with the brightness rank of each luminance level.
+    """
+    counts = np.bincount(luma, minlength=256)
+    cdf = np.cumsum(counts) - counts / 2
+    ranks = (cdf * (n_colors / max(len(luma), 1))).astype(np.intp)
+    return np.minimum(ranks, n_colors - 1)
+
+def _chroma(pixels, luma):
+    """Get the blue and red differences to the luminance of (N, 3) RGB pixels, as two (N,) int32 arrays."""
+    luma = luma.astype(np.int32)
+    return pixels[:, 2] - luma, pixels[:, 0] - luma
+
+def _tone_map_candidates(palette):
+    """
+    Find the palette colors the hue-aware tone mapping chooses between at each brightness rank.
+
+    Args:
+        palette: A palette_bundle.PaletteArrays tuple.
+
+    Returns:
+        A (N, 2 * TONE_MAP_HUE_NEIGHBORS + 1) array of palette indices per
+        brightness rank; neighbors too far in luminance repeat the color of the rank.
+    """
+    luma_order = np.asarray(palette.luma_order, dtype=np.intp)
+    sorted_luma = compute_luma(palette.rgb)[luma_order].astype(np.int16)
+    ranks = np.arange(len(luma_order))[:, None]
+    neighbors = np.clip(ranks + np.arange(-TONE_MAP_HUE_NEIGHBORS, TONE_MAP_HUE_NEIGHBORS + 1), 0, len(luma_order) - 1)
+    close = np.abs(sorted_luma[neighbors] - sorted_luma[ranks]) <= TONE_MAP_HUE_TOLERANCE
+    return luma_order[np.where(close, neighbors, ranks)]
+
+def tone_map_indices(pixels, palette, hue_aware=False, cancel_token=None, ranks=None):
+    """
+    Map RGB pixels to palette indices by luminance rank.
+
+    The luminance histogram is equalized onto the palette sorted from dark
+    to light (see build_tone_map_lut), and every pixel looked up through the
+    resulting 256-entry table: one pass over the pixels, no clustering.
+    With hue_aware, each pixel picks among the palette colors of nearby rank
+    and similar luminance the one closest in chroma, comparing one candidate
+    at a time over all pixels, between cancellation checks.
+
+    Args:
+        pixels: A (N, 3) uint8 array of RGB pixels.
+        palette: A palette_bundle.PaletteArrays tuple.
+        hue_aware: Break ties between colors of similar luminance by hue.
+        cancel_token: Optional job_control.CancelToken.
+        ranks: Optional table from build_tone_map_lut to use instead of
+               equalizing the histogram of the pixels.
+
+    Returns:
+        A (N,) array of palette indices (uint16 for palettes of more than 256 colors).
+    """
+    index_dtype = np.uint8 if len(palette.rgb) <= 256 else np.uint16
+    luma = compute_luma(pixels)
+    if ranks is None:
+        ranks = build_tone_map_lut(luma, len(palette.rgb))
+    
+    if not hue_aware:
+        lut = np.asarray(palette.luma_order)[ranks].astype(index_dtype)
+        return lut[luma]
+    
+    # The candidates and their chroma per luminance level, so pixels only index 256-entry tables
+    candidates = _tone_map_candidates(palette)[ranks].astype(index_dtype)
+    palette_rgb = np.asarray(palette.rgb, dtype=np.uint8)
+    palette_blue, palette_red = _chroma(palette_rgb, compute_luma(palette_rgb))
+    candidate_blue = palette_blue[candidates]
+    candidate_red = palette_red[candidates]
+    
+    blue, red = _chroma(pixels, luma)
+    indices = candidates[luma, TONE_MAP_HUE_NEIGHBORS]
+    best = np.full(len(pixels), np.iinfo(np.int32).max, dtype=np.int32)
+    distances = np.empty(len(pixels), dtype=np.int32)
+    scratch = np.empty(len(pixels), dtype=np.int32)
+    for k in range(candidates.shape[1]):
+        _check_cancelled(cancel_token)
+        np.subtract(candidate_blue[:, k][luma], blue, out=distances)
+        np.square(distances, out=distances)
+        np.subtract(candidate_red[:, k][luma], red, out=scratch)
+        np.square(scratch, out=scratch)
+        distances += scratch
+        closer = distances < best
+        np.copyto(best, distances, where=closer)
+        np.copyto(indices, candidates[:, k][luma], where=closer)
+    return indices
+
+def quantize_tone_map(image, palette_path, hue_aware=False, cancel_token=None):
+    """Quantizes an image by mapping its equalized luminance to the palette sorted by brightness."""
+    try:
+        palette = load_palette(palette_path)
+        pixels = np.asarray(image).reshape(-1, 3)
+        
+        # Luminance, its 16-bit intermediate, the indices and the result, and
+        # the chroma and distance arrays of the hue-aware mapping
+        with memory_budget.reserve(len(pixels) * (1 + 2 + 2 + 3 + (6 * 4 if hue_aware else 0)), "Tone-mapped image"):
+            indices = tone_map_indices(pixels, palette, hue_aware, cancel_token)
+            result = np.asarray(palette.rgb)[indices].reshape(image.height, image.width, 3)
+            
+            # Create a new PIL image from the result
+            return Image.fromarray(result)
+    except Exception as e:
+        logging.error(f"Error quantizing image with tone mapping: {str(e)}")
+        raise
+
+def extract_palette(image, n_colors=16, snap_palette_path=None):
+    """
+    Extract an N-color palette from an image.
+
+    The colors are found with Pillow's median cut, which takes a few
+    milliseconds on a downscaled image. With snap_palette_path, every color
+    is replaced by the nearest (CIELAB) color of that library palette that
+    is not taken yet, most frequent colors first.
+
+    Args:
+        image: A downscaled RGB PIL image.
+        n_colors: The maximum number of colors to extract.
+        snap_palette_path: Optional path to a palette to snap the colors to.
+
+    Returns:
+        A (K, 3) uint8 array of RGB colors, most frequent first.
+    """
+    try:
+        quantized = image.quantize(colors=n_colors, method=Image.Quantize.MEDIANCUT, dither=Image.Dither.NONE)
+        counts = np.bincount(np.asarray(quantized).ravel(), minlength=256)
+        used = np.flatnonzero(counts)
+        used = used[np.argsort(-counts[used], kind='stable')]
+        colors = np.array(quantized.getpalette()[:256 * 3], dtype=np.uint8).reshape(-1, 3)[used]
+        
+        if snap_palette_path:
+            colors = snap_to_palette(colors, snap_palette_path)
+        
+        return colors
+    except Exception as e:
+        logging.error(f"Error extracting palette: {str(e)}")
+        raise
+
+def snap_to_palette(colors, palette_path):
+    """
+    Replace colors by distinct nearby colors of a library palette.
+
+    Args:
+        colors: A (K, 3) uint8 array of RGB colors, most important first.
+        palette_path: The path to the library palette file.
+
+    Returns:
+        A (min(K, N), 3) uint8 array of palette colors.
+    """
+    palette = load_palette(palette_path)
+    colors_lab = color.rgb2lab(np.asarray(colors)[np.newaxis] / 255.0)[0]
+    distances = ((colors_lab[:, None, :] - np.asarray(palette.lab, dtype=np.float64)[None, :, :]) ** 2).sum(axis=2)
+    
+    # Each palette color is used at most once, so the snapped palette keeps its size
+    available = np.ones(len(palette.rgb), dtype=bool)
+    snapped = []
+    for row in distances[:len(palette.rgb)]:
+        index = np.argmin(np.where(available, row, np.inf))
+        available[index] = False
+        snapped.append(palette.rgb[index])
+    return np.array(snapped, dtype=np.uint8)
+
+def quantize_image(image, palette_path, quantization_mode="contrast", cancel_token=None):
+    """
+    Quantize an image with the selected quantization mode.
+
+    Args:
+        image: A downscaled RGB PIL image.
+        palette_path: The path to the palette file. For the "auto" mode this
+                      is the palette extracted from the image itself.
+        quantization_mode: One of the modes in Config.QUANTIZATION_MODES.
+        cancel_token: Optional job_control.CancelToken checked while quantizing.
+
+    Returns:
+        The quantized RGB PIL image.
+    """
+    if quantization_mode in ("natural", "auto"):
+        return quantize_to_palette_cielab(image, palette_path, cancel_token)
+    elif quantization_mode == "kmeans":
+        return quantize_kmeans(image, palette_path, cancel_token)
+    elif quantization_mode == "kmeans_brightness":
+        return quantize_kmeans_brightness(image, palette_path, cancel_token)
+    elif quantization_mode in TONE_MAP_MODES:
+        return quantize_tone_map(image, palette_path, quantization_mode == "tone_map_hue", cancel_token)
+    else:  # Default to "contrast"
+        return quantize_with_edge_emphasis(image, palette_path, cancel_token)
+
 def upscale_image(image, scale_factor):
     """Upscales an image by repeating pixels."""
     if scale_factor <= 1:
@@ -279,41 +1126,494 @@ def verify_colors(image, palette_rgb):
         logging.error(f"Error verifying colors: {str(e)}")
         return False
 
+def get_animation_format(image_path):
+    """
+    Get the output format for an animated image.
+
+    Args:
+        image_path: The path to the image file.
+
+    Returns:
+        'WEBP' or 'GIF' for images with more than one frame, None otherwise.
+    """
+    with Image.open(image_path) as img:
+        if not getattr(img, 'is_animated', False) or getattr(img, 'n_frames', 1) < 2:
+            return None
+        return 'WEBP' if img.format == 'WEBP' else 'GIF'
+
+def _iter_animation_frames(img, max_resolution, downscale_method="lanczos", crop=None):
+    """
+    Stream the downscaled RGB frames of an animation.
+
+    Identical consecutive frames are merged into one frame whose duration is
+    the sum of theirs, so only one downscaled frame is held at a time.
+    With crop, every frame is cropped to the same normalized rectangle first.
+
+    Yields:
+        (frame, duration) tuples, where frame is a downscaled RGB PIL image.
+    """
+    pending = None
+    pending_bytes = None
+    pending_duration = 0
+    box = crop_box(img.size, crop) if crop else None
+    for frame in ImageSequence.Iterator(img):
+        duration = frame.info.get('duration', img.info.get('duration', 100))
+        frame = frame.convert('RGB')
+        if box:
+            frame = frame.crop(box)
+        small = resize_to_fit(frame, max_resolution, method=downscale_method)
+        small_bytes = small.tobytes()
+        
+        if pending is not None and small_bytes == pending_bytes:
+            pending_duration += duration
+            continue
+        
+        if pending is not None:
+            yield pending, pending_duration
+        pending, pending_bytes, pending_duration = small, small_bytes, duration
+    
+    if pending is not None:
+        yield pending, pending_duration
+
+def map_bounded(executor, fn, items, window):
+    """Apply fn to items in an executor, in order, with at most `window` tasks in flight."""
+    in_flight = deque()
+    for item in items:
+        in_flight.append(executor.submit(fn, item))
+        if len(in_flight) >= window:
+            yield in_flight.popleft().result()
+    while in_flight:
+        yield in_flight.popleft().result()
+
+def _make_frame_quantizer(palette_path, quantization_mode, reference_frame=None):
+    """
+    Create a function mapping an RGB frame to a plane of palette indices.
+
+    The palette image or lookup table is built once and shared by all frames.
+    The k-means modes use the CIELAB lookup table, since clustering every
+    frame separately would be slow and make colors flicker between frames.
+    For the same reason, the tone mapping modes equalize the histogram of
+    the reference frame once and map every frame through that table.
+
+    Args:
+        palette_path: The path to the palette file.
+        quantization_mode: The selected quantization mode.
+        reference_frame: The RGB PIL image whose luminance histogram the
+                         tone mapping modes equalize (usually the first frame).
+
+    Returns:
+        A function taking a RGB PIL image and returning a (H, W) index array
+        (uint16 for palettes of more than 256 colors).
+    """
+    palette = load_palette(palette_path)
+    
+    if quantization_mode == "contrast" and len(palette.rgb) > PIL_MAX_PALETTE_COLORS:
+        def quantize_frame(frame):
+            return ordered_dither_to_palette(enhance_contrast(frame), palette)
+    elif quantization_mode == "contrast":
+        palette_img = make_palette_image(palette.rgb)
+        n_colors = len(palette.rgb)
+        
+        def quantize_frame(frame):
+            quantized = enhance_contrast(frame).quantize(palette=palette_img, dither=Image.FLOYDSTEINBERG)
+            indices = np.asarray(quantized)
+            # Padding entries of the PIL palette repeat the first color
+            return np.where(indices < n_colors, indices, 0).astype(np.uint8)
+    elif quantization_mode in TONE_MAP_MODES:
+        hue_aware = quantization_mode == "tone_map_hue"
+        ranks = None
+        if reference_frame is not None:
+            ranks = build_tone_map_lut(compute_luma(np.asarray(reference_frame).reshape(-1, 3)), len(palette.rgb))
+        
+        def quantize_frame(frame):
+            indices = tone_map_indices(np.asarray(frame).reshape(-1, 3), palette, hue_aware, ranks=ranks)
+            return indices.reshape(frame.height, frame.width)
+    else:
+        lut = get_palette_lut(palette_path)
+        
+        def quantize_frame(frame):
+            return apply_palette_lut(np.asarray(frame), lut)
+    
+    return quantize_frame
+
+class _GifStreamWriter:
+    """
+    Write an animated GIF one frame at a time.
+
+    Pillow's GIF writer keeps every frame until the whole animation is
+    saved; this writer only keeps the palette indices of the previous frame,
+    and writes the rectangle that changed since, upscaled when it is written.
+    """
+    def __init__(self, fp, palette, upscale_factor, loop):
+        self.fp = fp
+        self.palette_rgb = np.asarray(palette.rgb)
+        # Frames of larger palettes are reduced to 256 colors each, with their own color table
+        self.indexed = len(palette.rgb) <= PIL_MAX_PALETTE_COLORS
+        self.flat_palette = self.palette_rgb.flatten().tolist()
+        self.upscale_factor = max(upscale_factor, 1)
+        self.loop = loop
+        self.previous = None
+
+    def _frame_image(self, indices):
+        """Get the upscaled P image of a (part of a) frame."""
+        if self.indexed:
+            frame = Image.fromarray(indices, 'P')
+            frame.putpalette(self.flat_palette)
+        else:
+            frame = Image.fromarray(self.palette_rgb[indices]).convert('P', palette=Image.Palette.ADAPTIVE)
+        return upscale_image(frame, self.upscale_factor)
+
+    def write(self, indices, duration):
+        """Write a frame of palette indices, shown for duration milliseconds."""
+        top, left = 0, 0
+        changed = indices
+        if self.previous is not None:
+            difference = indices != self.previous
+            rows = np.flatnonzero(difference.any(axis=1))
+            columns = np.flatnonzero(difference.any(axis=0))
+            top, left = rows[0], columns[0]
+            changed = indices[top:rows[-1] + 1, left:columns[-1] + 1]
+        
+        frame = self._frame_image(changed)
+        if self.previous is None:
+            header, _ = GifImagePlugin.getheader(frame, info={'loop': self.loop})
+            self.fp.write(b''.join(header))
+        offset = (int(left) * self.upscale_factor, int(top) * self.upscale_factor)
+        for data in GifImagePlugin.getdata(frame, offset, duration=duration, include_color_table=not self.indexed):
+            self.fp.write(data)
+        self.previous = indices
+
+    def close(self):
+        """Write the GIF trailer."""
+        self.fp.write(b';')
+
+def process_animation(
+    image_path,
+    palette_path,
+    output_path,
+    max_resolution=(512, 512),
+    quantization_mode="contrast",
+    upscale_factor=1,
+    output_format="GIF",
+    cancel_token=None,
+    downscale_method="lanczos",
+    crop=None
+):
+    """
+    Process every frame of an animated GIF/WebP and save an animated result.
+
+    Frames are decoded and downscaled one at a time and quantized in parallel
+    by a bounded thread pool, so memory does not grow with the size of the
+    source frames. GIF frames are written as they are quantized; WebP
+    frames (Pillow encodes an animated WebP from all frames at once) are
+    kept as palette indices at their downscaled size and upscaled when
+    saved. The upscaled output is limited to ANIMATION_MAX_OUTPUT_PIXELS
+    over all frames. The output keeps the original frame durations.
+
+    Args:
+        image_path: The path to the animated image.
+        palette_path: The path to the palette file.
+        output_path: Where to save the animation.
+        max_resolution: The maximum width and height of the frames.
+        quantization_mode: The selected quantization mode.
+        upscale_factor: The pixel upscale factor.
+        output_format: 'GIF' or 'WEBP'.
+        cancel_token: Optional job_control.CancelToken checked between frames.
+        downscale_method: One of DOWNSCALE_METHODS.
+        crop: Optional (x, y, width, height) rectangle, as fractions of the
+              frame size, to keep.
+
+    Returns:
+        The number of frames written.
+    """
+    tmp_path = f"{output_path}.tmp"
+    try:
+        palette = load_palette(palette_path)
+        scale = max(upscale_factor, 1)
+        
+        frames = []
+        durations = []
+        frame_count = 0
+        output_pixels = 0
+        # The last distinct frame, written once the next one shows its duration is final
+        pending = None
+        
+        with Image.open(image_path) as img, open(tmp_path, 'wb') as fp:
+            loop = img.info.get('loop', 0)
+            gif_writer = _GifStreamWriter(fp, palette, upscale_factor, loop) if output_format == 'GIF' else None
+            
+            # Peek at the first frame, whose histogram the tone mapping modes use for every frame
+            source_frames = _iter_animation_frames(img, max_resolution, downscale_method, crop)
+            first_frame = next(source_frames, None)
+            if first_frame is not None:
+                source_frames = itertools.chain([first_frame], source_frames)
+            quantize_frame = _make_frame_quantizer(
+                palette_path, quantization_mode, first_frame[0] if first_frame is not None else None
+            )
+            
+            def emit(indices, duration):
+                """Write a frame, or keep it for the WebP encoder."""
+                if gif_writer:
+                    gif_writer.write(indices, duration)
+                else:
+                    memory_budget.charge(indices.nbytes, "Animation frames")
+                    frames.append(indices)
+                    durations.append(duration)
+            
+            with ThreadPoolExecutor(max_workers=ANIMATION_WORKERS) as executor:
+                results = map_bounded(
+                    executor,
+                    lambda item: (quantize_frame(item[0]), item[1]),
+                    source_frames,
+                    ANIMATION_WORKERS * 2
+                )
+                
+                for indices, duration in results:
+                    _check_cancelled(cancel_token)
+                    
+                    # Frames that differ only before quantization look identical afterwards
+                    if pending is not None and np.array_equal(indices, pending[0]):
+                        pending[1] += duration
+                        continue
+                    
+                    output_pixels += indices.size * scale ** 2
+                    if output_pixels > ANIMATION_MAX_OUTPUT_PIXELS:
+                        raise memory_budget.MemoryBudgetExceeded(
+                            f"The animation exceeds {ANIMATION_MAX_OUTPUT_PIXELS // 2**20} megapixels over all its "
+                            f"upscaled frames; choose a lower resolution or upscale factor"
+                        )
+                    if pending is not None:
+                        emit(*pending)
+                    pending = [indices, duration]
+                    frame_count += 1
+            emit(*pending)
+            
+            if gif_writer:
+                gif_writer.close()
+            else:
+                # Upscaled here, as the WebP encoder takes every frame at once
+                indexed = len(palette.rgb) <= PIL_MAX_PALETTE_COLORS
+                flat_palette = np.asarray(palette.rgb).flatten().tolist()
+                with memory_budget.reserve(output_pixels * (1 if indexed else 3), "Animation frames"):
+                    images = []
+                    for indices in frames:
+                        if indexed:
+                            frame = Image.fromarray(indices, 'P')
+                            frame.putpalette(flat_palette)
+                        else:
+                            frame = Image.fromarray(np.asarray(palette.rgb)[indices])
+                        images.append(upscale_image(frame, upscale_factor))
+                    images[0].save(
+                        fp,
+                        format=output_format,
+                        save_all=True,
+                        append_images=images[1:],
+                        duration=durations,
+                        loop=loop,
+                        lossless=True
+                    )
+        
+        os.replace(tmp_path, output_path)
+        return frame_count
+    except Exception as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        logging.error(f"Error processing animation: {str(e)}")
+        raise
+
+def quantize_preview(source, palette_path, preview_size=PREVIEW_SIZE):
+    """
+    Quickly quantize a small preview of an image.
+
+    The preview is shrunk from the already decoded source and mapped through
+    the cached palette lookup table, so it costs a few milliseconds whatever
+    quantization mode the full result uses.
+
+    Args:
+        source: The decoded source PIL image (see load_source_image).
+        palette_path: The path to the palette file.
+        preview_size: The maximum width and height of the preview.
+
+    Returns:
+        The quantized preview as an RGB PIL image.
+    """
+    small = resize_to_fit(source, (preview_size, preview_size), reducing_gap=2.0)
+    indices = apply_palette_lut(np.asarray(small), get_palette_lut(palette_path))
+    return Image.fromarray(load_palette(palette_path).rgb[indices])
+
+def as_source_image(source):
+    """
+    Get a decoded source image as a PIL image.
+
+    Sources shared by the serving process (see shared_arrays.py) are mapped
+    from their file rather than copied through the pool's pipe; shared
+    images are used in place, as RGBX images backed by the mapping.
+
+    Args:
+        source: A PIL image, an RGB array or a shared_arrays.SharedArray.
+
+    Returns:
+        An RGB (or, for shared images, RGBX) PIL Image object.
+    """
+    if isinstance(source, shared_arrays.SharedArray):
+        if len(source.shape) == 3 and source.shape[2] == 4:
+            return shared_arrays.open_image(source)
+        source = shared_arrays.open_array(source)
+    if isinstance(source, np.ndarray):
+        memory_budget.charge(source.shape[0] * source.shape[1] * 4, "Mapping the image")
+        return Image.fromarray(source, 'RGB')
+    return source
+
+def _run_stage(stage, key, compute):
+    """Run a pipeline stage, through the stage cache when it has a key."""
+    with profiling.stage(stage):
+        if key is None:
+            return compute()
+        return stage_cache.get_or_compute(stage, key, compute)
+
+def process_source_image(
+    source,
+    palette_path,
+    output_dir,
+    max_resolution=(512, 512),
+    quantization_mode="contrast",
+    upscale_factor=1,
+    cancel_token=None,
+    downscale_method="lanczos",
+    region=None,
+    source_key=None
+):
+    """
+    Process an already decoded image and save the result.
+
+    With region, only that part of the downscaled image is quantized and
+    pasted back onto it; the rest keeps its downscaled original colors.
+
+    With source_key, the downscaled, quantized and upscaled images are
+    memoized in the stage cache, keyed by the parameters each stage depends
+    on; e.g. a request that only changes the upscale factor reuses the
+    quantized image and only upscales it.
+
+    Args:
+        source: The decoded source PIL image (see load_source_image), or
+                its pixels as an array or shared_arrays.SharedArray (see
+                as_source_image); only read if the downscaled image is not cached.
+        palette_path: The path to the palette file.
+        output_dir: The directory to save the result in.
+        max_resolution: The maximum width and height of the pixelated image.
+        quantization_mode: The selected quantization mode.
+        upscale_factor: The pixel upscale factor.
+        cancel_token: Optional job_control.CancelToken.
+        downscale_method: One of DOWNSCALE_METHODS.
+        region: Optional (x, y, width, height) rectangle, as fractions of
+                the image size, to pixelate.
+        source_key: Optional hashable key identifying the decoded source
+                    (see stage_cache.file_digest); enables the stage cache.
+
+    Returns:
+        The filename of the processed image in output_dir.
+    """
+    # Generate a unique filename for the processed image
+    filename = f"{str(uuid.uuid4())}.png"
+    output_path = os.path.join(output_dir, filename)
+    
+    # Each stage key extends the key of the stage it consumes
+    if source_key is not None:
+        downscaled_key = (source_key, _resolution_tuple(max_resolution), downscale_method)
+        palette_digest = stage_cache.array_digest(load_palette(palette_path).rgb)
+        quantized_key = downscaled_key + (palette_digest, quantization_mode, region)
+        upscaled_key = quantized_key + (upscale_factor,)
+    
+    # Downscale the image
+    def downscale():
+        small = resize_to_fit(as_source_image(source), max_resolution, method=downscale_method)
+        if small.mode != 'RGB':
+            small = small.convert('RGB')
+        memory_budget.charge(small.width * small.height * 3, "Downscaling the image")
+        return small
+    
+    img = _run_stage('downscaled', downscaled_key if source_key is not None else None, downscale)
+    _check_cancelled(cancel_token)
+    
+    # Apply the selected quantization mode
+    def quantize():
+        if region:
+            # The downscaled image may be shared through the stage cache
+            composite = img.copy()
+            box = crop_box(composite.size, region)
+            composite.paste(quantize_image(composite.crop(box), palette_path, quantization_mode, cancel_token), box[:2])
+            return composite
+        return quantize_image(img, palette_path, quantization_mode, cancel_token)
+    
+    img = _run_stage('quantized', quantized_key if source_key is not None else None, quantize)
+    _check_cancelled(cancel_token)
+    
+    # Upscale the image if requested
+    if upscale_factor > 1:
+        def upscale():
+            memory_budget.charge(img.width * img.height * 3 * upscale_factor ** 2, "Upscaling the image")
+            return upscale_image(img, upscale_factor)
+        
+        img = _run_stage('upscaled', upscaled_key if source_key is not None else None, upscale)
+    
+    # Save the processed image
+    img.save(output_path)
+    
+    return filename
+
 def process_image(
     image_path, 
     palette_path, 
     output_dir, 
     max_resolution=(512, 512), 
     quantization_mode="contrast", 
-    upscale_factor=1
+    upscale_factor=1,
+    cancel_token=None,
+    downscale_method="lanczos",
+    crop=None,
+    region=None
 ):
-    """Process an image with the specified parameters and save the result."""
+    """
+    Process an image with the specified parameters and save the result.
+
+    A job_control.CancelToken can be passed to abort processing cooperatively;
+    job_control.ProcessingCancelled is raised when it triggers. crop keeps
+    only part of the image (applied while decoding), region pixelates only
+    part of it (still images only); both are normalized rectangles.
+    """
     try:
-        # Generate a unique filename for the processed image
-        filename = f"{str(uuid.uuid4())}.png"
-        output_path = os.path.join(output_dir, filename)
-        
-        # Downscale the image
-        img = downscale_image(image_path, max_resolution)
-        
-        # Apply the selected quantization mode
-        if quantization_mode == "natural":
-            img = quantize_to_palette_cielab(img, palette_path)
-        elif quantization_mode == "kmeans":
-            img = quantize_kmeans(img, palette_path)
-        elif quantization_mode == "kmeans_brightness":
-            img = quantize_kmeans_brightness(img, palette_path)
-        else:  # Default to "contrast"
-            img = quantize_with_edge_emphasis(img, palette_path)
-        
-        # Upscale the image if requested
-        if upscale_factor > 1:
-            img = upscale_image(img, upscale_factor)
-        
-        # Save the processed image
-        img.save(output_path)
-        
-        return filename
+        # Animated images keep all of their frames
+        animation_format = get_animation_format(image_path)
+        if animation_format and region:
+            raise ValueError("Pixelating a region is not supported for animations")
+        if animation_format:
+            filename = f"{str(uuid.uuid4())}.{animation_format.lower()}"
+            output_path = os.path.join(output_dir, filename)
+            process_animation(
+                image_path,
+                palette_path,
+                output_path,
+                max_resolution,
+                quantization_mode,
+                upscale_factor,
+                animation_format,
+                cancel_token,
+                downscale_method,
+                crop
+            )
+            return filename
+        
+        return process_source_image(
+            load_source_image(image_path, crop, decode_size(max_resolution, downscale_method)),
+            palette_path,
+            output_dir,
+            max_resolution,
+            quantization_mode,
+            upscale_factor,
+            cancel_token,
+            downscale_method,
+            region
+        )
     except Exception as e:
         logging.error(f"Error processing image: {str(e)}")
         raise
\ No newline at end of file
@@ -1,12 +1,23 @@
 import os
 from app import app
 from palette_manager import load_palettes_from_folder
+import palette_bundle
 
 def main():
     """Import palettes from the palettes folder into memory."""
     try:
         # Get the palettes directory from configuration
         palettes_dir = app.config['UPLOADED_PALETTES_DEST']
+        bundle_path = app.config['PALETTE_BUNDLE_PATH']
+        
+        # Compile the built-in palettes into a single bundle if they changed
+        if palette_bundle.is_stale(palettes_dir, bundle_path):
+            compiled = palette_bundle.compile_bundle(palettes_dir, bundle_path)
+            print(f"Compiled {compiled} palettes into {bundle_path}")
+        
+        # Map the bundle so quantizers never reopen built-in palette files
+        bundled = palette_bundle.load_bundle(bundle_path, palettes_dir)
+        print(f"Loaded palette bundle with {bundled} palettes")
         
         # Load all palettes from the directory
         count = load_palettes_from_folder(palettes_dir)
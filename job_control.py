@@ -0,0 +1,191 @@
+import os
+import re
+import time
+import logging
+import threading
+
+# Request ids are generated by the client, so only accept safe file names
+_REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9-]{1,64}$')
+# Suffix of the files registering a running job and the session that owns it
+JOB_FILE_SUFFIX = '.job'
+# Seconds after which job files and cancel flags left by a crashed worker are
+# removed (longer than any processing deadline)
+FLAG_TTL = 10 * 60
+# Seconds between two sweeps for such files
+FLAG_PRUNE_INTERVAL = 60
+_last_pruned = 0.0
+
+# In-process registry of running jobs (request_id -> CancelToken)
+_active_jobs = {}
+_active_jobs_lock = threading.Lock()
+
+class ProcessingCancelled(Exception):
+    """Raised when a processing job was cancelled by the user."""
+    pass
+
+class ProcessingTimeout(ProcessingCancelled):
+    """Raised when a processing job ran past its deadline."""
+    pass
+
+class CancelToken:
+    """
+    A cooperative cancellation token for a processing job.
+
+    Processing stages call check() between tiles and iterations. A job is
+    cancelled either through cancel() in this process or through a flag
+    file, so a cancel request served by another worker process still stops it.
+    """
+    def __init__(self, request_id=None, timeout=None, flag_dir=None, session_id=None):
+        self.request_id = request_id
+        self.session_id = session_id
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self._event = threading.Event()
+        self._flag_path = os.path.join(flag_dir, request_id) if flag_dir and request_id else None
+
+    def cancel(self):
+        """Request cancellation of the job."""
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        """Whether cancellation was requested."""
+        if self._event.is_set():
+            return True
+        if self._flag_path and os.path.exists(self._flag_path):
+            self._event.set()
+            return True
+        return False
+
+    def check(self):
+        """
+        Abort the job if it was cancelled or ran past its deadline.
+
+        Raises:
+            ProcessingCancelled: If cancellation was requested.
+            ProcessingTimeout: If the deadline has passed.
+        """
+        if self.cancelled:
+            raise ProcessingCancelled(f"Processing of request {self.request_id} was cancelled")
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise ProcessingTimeout(f"Processing of request {self.request_id} exceeded its time limit")
+
+def is_valid_request_id(request_id):
+    """Check whether a client-supplied request id is acceptable."""
+    return bool(request_id) and bool(_REQUEST_ID_PATTERN.match(request_id))
+
+def _remove_file(path):
+    """Remove a job file or cancel flag, if it exists."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logging.error(f"Error removing {path}: {str(e)}")
+
+def prune_stale_flags(flag_dir):
+    """Remove the job files and cancel flags older than FLAG_TTL, at most every FLAG_PRUNE_INTERVAL."""
+    global _last_pruned
+    now = time.time()
+    if now - _last_pruned < FLAG_PRUNE_INTERVAL or not os.path.isdir(flag_dir):
+        return
+    _last_pruned = now
+    for filename in os.listdir(flag_dir):
+        path = os.path.join(flag_dir, filename)
+        try:
+            if now - os.path.getmtime(path) > FLAG_TTL:
+                _remove_file(path)
+        except FileNotFoundError:
+            pass
+
+def start_job(request_id, timeout=None, flag_dir=None, session_id=None):
+    """
+    Register a running job and create its cancel token.
+
+    The job is also registered in flag_dir with the session that owns it,
+    so a cancel request served by another worker process can check that
+    the job exists and belongs to the caller.
+
+    Args:
+        request_id: The id the client uses to address the job.
+        timeout: The maximum processing time in seconds, or None.
+        flag_dir: The directory holding cancel flags shared between workers.
+        session_id: The session that started the job.
+
+    Returns:
+        The CancelToken of the job.
+    """
+    token = CancelToken(request_id, timeout, flag_dir, session_id)
+    with _active_jobs_lock:
+        _active_jobs[request_id] = token
+
+    if flag_dir:
+        prune_stale_flags(flag_dir)
+        # A flag left for an earlier job with the same id must not cancel this one
+        _remove_file(os.path.join(flag_dir, request_id))
+        try:
+            with open(os.path.join(flag_dir, f"{request_id}{JOB_FILE_SUFFIX}"), 'w') as f:
+                f.write(session_id or '')
+        except Exception as e:
+            logging.error(f"Error registering job {request_id}: {str(e)}")
+    return token
+
+def finish_job(request_id, flag_dir=None):
+    """
+    Unregister a job once it completed, failed or was cancelled.
+
+    Args:
+        request_id: The id of the job.
+        flag_dir: The directory holding cancel flags shared between workers.
+    """
+    with _active_jobs_lock:
+        _active_jobs.pop(request_id, None)
+
+    if flag_dir:
+        _remove_file(os.path.join(flag_dir, request_id))
+        _remove_file(os.path.join(flag_dir, f"{request_id}{JOB_FILE_SUFFIX}"))
+
+def _job_owner(request_id, flag_dir):
+    """Get the session owning a job registered in flag_dir, or None if it is not running."""
+    try:
+        with open(os.path.join(flag_dir, f"{request_id}{JOB_FILE_SUFFIX}")) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def cancel_job(request_id, session_id, flag_dir=None):
+    """
+    Cancel a job of a session by its request id.
+
+    The job is cancelled directly when it runs in this process. A flag file
+    is written as well, so a job running in another worker process stops
+    at its next check. Jobs that are not running, or belong to another
+    session, are left alone and no flag is written.
+
+    Args:
+        request_id: The id of the job.
+        session_id: The session of the cancel request.
+        flag_dir: The directory holding cancel flags shared between workers.
+
+    Returns:
+        True if a running job of the session was cancelled.
+    """
+    if not session_id:
+        return False
+
+    with _active_jobs_lock:
+        token = _active_jobs.get(request_id)
+    if token is not None:
+        if token.session_id != session_id:
+            return False
+        token.cancel()
+    elif not flag_dir or _job_owner(request_id, flag_dir) != session_id:
+        return False
+
+    if flag_dir:
+        try:
+            with open(os.path.join(flag_dir, request_id), 'w'):
+                pass
+        except Exception as e:
+            logging.error(f"Error writing cancel flag: {str(e)}")
+
+    return True
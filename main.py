@@ -1,4 +1,6 @@
 from app import app
+import warmup
 
 if __name__ == "__main__":
+    warmup.start(app.config)
     app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
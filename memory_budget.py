@@ -0,0 +1,165 @@
+import logging
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+# Maximum total size of the idle buffers kept by a worker's buffer pool
+BUFFER_POOL_MAX_BYTES = 32 * 1024 * 1024
+
+# The budget of the request handled by the current thread
+_local = threading.local()
+
+class MemoryBudgetExceeded(Exception):
+    """Raised when a request would use more memory than its budget allows."""
+    pass
+
+class MemoryBudget:
+    """
+    Accounts for the large arrays a request allocates.
+
+    Processing stages charge the size of their decoded images and working
+    buffers before allocating them, so a request that would exceed its
+    budget fails early instead of pushing the worker out of memory.
+    """
+    def __init__(self, limit_bytes):
+        self.limit_bytes = limit_bytes
+        self.current_bytes = 0
+        self.peak_bytes = 0
+
+    def charge(self, nbytes, label):
+        """
+        Charge an allocation to the budget.
+
+        Raises:
+            MemoryBudgetExceeded: If the allocation does not fit in the budget.
+        """
+        if self.limit_bytes and self.current_bytes + nbytes > self.limit_bytes:
+            raise MemoryBudgetExceeded(
+                f"{label} needs {nbytes / 2**20:.1f} MB, which exceeds the memory budget of "
+                f"{self.limit_bytes / 2**20:.0f} MB per request"
+            )
+        self.current_bytes += nbytes
+        self.peak_bytes = max(self.peak_bytes, self.current_bytes)
+
+    def release(self, nbytes):
+        """Return a released allocation to the budget."""
+        self.current_bytes = max(0, self.current_bytes - nbytes)
+
+    def report(self):
+        """Get the peak and limit of the budget, in megabytes."""
+        return {
+            'peak_mb': round(self.peak_bytes / 2**20, 2),
+            'budget_mb': round(self.limit_bytes / 2**20, 2)
+        }
+
+class BufferPool:
+    """
+    A pool of reusable numpy buffers.
+
+    Chunked processing stages borrow their working buffers here instead of
+    allocating new ones for every request. Idle buffers are kept up to
+    max_bytes in total.
+    """
+    def __init__(self, max_bytes=BUFFER_POOL_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._free = {}  # (shape, dtype) -> list of idle buffers
+        self._free_bytes = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, shape, dtype):
+        """Take an idle buffer of the given shape and dtype, or allocate one."""
+        key = (tuple(shape), np.dtype(dtype).str)
+        with self._lock:
+            buffers = self._free.get(key)
+            if buffers:
+                buffer = buffers.pop()
+                self._free_bytes -= buffer.nbytes
+                return buffer
+        return np.empty(shape, dtype=dtype)
+
+    def release(self, buffer):
+        """Return a buffer to the pool."""
+        key = (buffer.shape, buffer.dtype.str)
+        with self._lock:
+            if self._free_bytes + buffer.nbytes > self.max_bytes:
+                return
+            self._free.setdefault(key, []).append(buffer)
+            self._free_bytes += buffer.nbytes
+
+    def clear(self):
+        """Drop all idle buffers."""
+        with self._lock:
+            self._free.clear()
+            self._free_bytes = 0
+
+# Buffer pool shared by the threads of this worker process
+_pool = BufferPool()
+
+@contextmanager
+def track(limit_bytes):
+    """
+    Track the memory of the request handled by the current thread.
+
+    Args:
+        limit_bytes: The memory budget of the request (0 for no limit).
+
+    Yields:
+        The MemoryBudget of the request.
+    """
+    previous = getattr(_local, 'budget', None)
+    budget = MemoryBudget(limit_bytes)
+    _local.budget = budget
+    try:
+        yield budget
+    finally:
+        _local.budget = previous
+        if budget.peak_bytes:
+            logging.debug(f"Request memory peak: {budget.peak_bytes / 2**20:.1f} MB")
+
+def current():
+    """Get the MemoryBudget of the request handled by the current thread, or None."""
+    return getattr(_local, 'budget', None)
+
+def charge(nbytes, label):
+    """
+    Charge an allocation that lasts until the end of the request.
+
+    Does nothing when the current thread is not tracking a request.
+
+    Raises:
+        MemoryBudgetExceeded: If the allocation does not fit in the budget.
+    """
+    budget = getattr(_local, 'budget', None)
+    if budget is not None:
+        budget.charge(nbytes, label)
+
+@contextmanager
+def reserve(nbytes, label):
+    """Charge a temporary allocation for the duration of a with block."""
+    budget = getattr(_local, 'budget', None)
+    if budget is not None:
+        budget.charge(nbytes, label)
+    try:
+        yield
+    finally:
+        if budget is not None:
+            budget.release(nbytes)
+
+@contextmanager
+def borrow(shape, dtype, label="Working buffer"):
+    """
+    Borrow a buffer from the worker's pool, charging it to the request budget.
+
+    The buffer is uninitialized and must not be used after the with block.
+
+    Yields:
+        A numpy array of the given shape and dtype.
+    """
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    with reserve(nbytes, label):
+        buffer = _pool.acquire(shape, dtype)
+        try:
+            yield buffer
+        finally:
+            _pool.release(buffer)
@@ -1,4 +1,4 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from app import db
 
 class Palette(db.Model):
@@ -28,12 +28,12 @@ class ProcessedImage(db.Model):
     """Model for tracking processed images."""
     id = db.Column(db.Integer, primary_key=True)
     original_filename = db.Column(db.String(255), nullable=False)
-    processed_filename = db.Column(db.String(255), nullable=False, unique=True)
+    processed_filename = db.Column(db.String(255), nullable=False, unique=True, index=True)
     palette_id = db.Column(db.Integer, db.ForeignKey('palette.id'), nullable=False)
     quantization_mode = db.Column(db.String(50), nullable=False)
     max_resolution = db.Column(db.String(20), nullable=False)
     upscale_factor = db.Column(db.Integer, default=1)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     
     # Define the relationship to the Palette model
     palette = db.relationship('Palette', backref=db.backref('processed_images', lazy=True))
@@ -53,4 +53,22 @@ class ProcessedImage(db.Model):
             'upscale_factor': self.upscale_factor,
             'created_at': self.created_at.isoformat() if self.created_at else None,
             'palette': self.palette.name if self.palette else None
-        }
\ No newline at end of file
+        }
+
+    @classmethod
+    def purge_expired(cls, max_age_seconds):
+        """
+        Delete all records older than the given age in a single statement.
+
+        Args:
+            max_age_seconds: The maximum age of a record in seconds.
+
+        Returns:
+            The number of deleted records.
+        """
+        cutoff = datetime.utcnow() - timedelta(seconds=max_age_seconds)
+        result = db.session.execute(
+            db.delete(cls).where(cls.created_at < cutoff)
+        )
+        db.session.commit()
+        return result.rowcount
\ No newline at end of file
@@ -0,0 +1,255 @@
+import os
+import sys
+import logging
+import threading
+from collections import namedtuple, OrderedDict
+
+import numpy as np
+from skimage import color
+
+# One record per palette color. Records of the same palette are contiguous,
+# so the palette column doubles as the offsets table of the bundle.
+BUNDLE_DTYPE = np.dtype([
+    ('palette', 'S64'),       # Palette filename
+    ('rgb', 'u1', (3,)),      # sRGB color
+    ('lab', '<f4', (3,)),     # CIELAB color
+    ('luma_order', '<u2'),    # Index of the n-th darkest color of the palette
+])
+
+PaletteArrays = namedtuple('PaletteArrays', ['rgb', 'lab', 'luma_order'])
+
+# Memory-mapped bundle shared by every worker process
+_bundle = None
+# Mapping of palette filename -> (start, count) into _bundle
+_offsets = {}
+# Directory the bundled palettes were compiled from
+_bundle_dir = None
+# Maximum number of compiled palettes outside the bundle kept in memory
+MAX_COMPILED_PALETTES = 4096
+# LRU cache of compiled palettes outside the bundle (imported or generated):
+# real path -> (modification time, PaletteArrays)
+_compiled = OrderedDict()
+_compiled_lock = threading.Lock()
+
+def is_builtin_palette(filename):
+    """Check whether a palette file is a built-in palette (not a temporary upload)."""
+    # Temporary palettes get a '_<uuid>' suffix, see palette_manager.add_palette
+    return filename.endswith('.hex') and '_' not in filename
+
+def parse_hex_palette(palette_path):
+    """
+    Read a .hex palette file into an array of RGB colors.
+
+    Args:
+        palette_path: The path to the palette file.
+
+    Returns:
+        A (N, 3) uint8 array of RGB colors.
+    """
+    with open(palette_path, 'r') as f:
+        lines = [line.strip().lstrip('#') for line in f if line.strip()]
+    return np.frombuffer(bytes.fromhex(''.join(line[:6] for line in lines)), dtype=np.uint8).reshape(-1, 3)
+
+def compute_palette_arrays(rgb):
+    """
+    Compute the derived arrays used by the quantizers for a palette.
+
+    Args:
+        rgb: A (N, 3) uint8 array of RGB colors.
+
+    Returns:
+        A PaletteArrays tuple.
+    """
+    rgb = np.asarray(rgb, dtype=np.uint8).reshape(-1, 3)
+    lab = color.rgb2lab(rgb / 255.0).astype(np.float32)
+    r, g, b = rgb.astype(np.float64).T
+    luma_order = np.argsort(0.299 * r + 0.587 * g + 0.114 * b).astype(np.uint16)
+    return PaletteArrays(rgb=rgb, lab=lab, luma_order=luma_order)
+
+def compile_palette(palette_path, rgb):
+    """
+    Compute the arrays of a palette outside the bundle and cache them.
+
+    Args:
+        palette_path: The path of the (already written) palette file.
+        rgb: A (N, 3) uint8 array of its RGB colors.
+
+    Returns:
+        A PaletteArrays tuple of read-only arrays.
+    """
+    arrays = compute_palette_arrays(rgb)
+    for array in arrays:
+        array.flags.writeable = False
+    key = os.path.realpath(palette_path)
+    with _compiled_lock:
+        _compiled[key] = (os.path.getmtime(palette_path), arrays)
+        _compiled.move_to_end(key)
+        while len(_compiled) > MAX_COMPILED_PALETTES:
+            _compiled.popitem(last=False)
+    return arrays
+
+def forget_palette(palette_path):
+    """Drop the cached arrays of a palette outside the bundle, e.g. when it is deleted."""
+    with _compiled_lock:
+        _compiled.pop(os.path.realpath(palette_path), None)
+
+def _get_compiled(palette_path):
+    """Get the cached arrays of a palette outside the bundle, if still current."""
+    key = os.path.realpath(palette_path)
+    with _compiled_lock:
+        entry = _compiled.get(key)
+        if entry is not None:
+            _compiled.move_to_end(key)
+    if entry is None:
+        return None
+    try:
+        if os.path.getmtime(palette_path) != entry[0]:
+            return None
+    except OSError:
+        return None
+    return entry[1]
+
+def compile_bundle(palettes_dir, bundle_path):
+    """
+    Compile all built-in palettes of a directory into a single bundle file.
+
+    Args:
+        palettes_dir: The directory containing the .hex palette files.
+        bundle_path: Where to write the bundle (.npy).
+
+    Returns:
+        The number of palettes in the bundle.
+    """
+    filenames = sorted(f for f in os.listdir(palettes_dir) if is_builtin_palette(f))
+
+    records = []
+    for filename in filenames:
+        try:
+            arrays = compute_palette_arrays(parse_hex_palette(os.path.join(palettes_dir, filename)))
+        except Exception as e:
+            logging.error(f"Skipping palette {filename} in bundle: {str(e)}")
+            continue
+
+        palette_records = np.zeros(len(arrays.rgb), dtype=BUNDLE_DTYPE)
+        palette_records['palette'] = filename.encode()
+        palette_records['rgb'] = arrays.rgb
+        palette_records['lab'] = arrays.lab
+        palette_records['luma_order'] = arrays.luma_order
+        records.append(palette_records)
+
+    bundle = np.concatenate(records) if records else np.zeros(0, dtype=BUNDLE_DTYPE)
+
+    # Write to a temporary file first so concurrently starting workers
+    # never map a partially written bundle
+    tmp_path = f"{bundle_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, bundle)
+    os.replace(tmp_path, bundle_path)
+
+    return len(records)
+
+def _read_offsets(bundle):
+    """Build the filename -> (start, count) table of a bundle."""
+    names, starts, counts = np.unique(bundle['palette'], return_index=True, return_counts=True)
+    return {name.decode(): (int(start), int(count)) for name, start, count in zip(names, starts, counts)}
+
+def is_stale(palettes_dir, bundle_path):
+    """
+    Check whether the bundle is missing or out of date with the palette files.
+
+    Args:
+        palettes_dir: The directory containing the .hex palette files.
+        bundle_path: The path of the bundle file.
+
+    Returns:
+        True if the bundle needs to be (re)compiled.
+    """
+    if not os.path.exists(bundle_path):
+        return True
+
+    try:
+        filenames = [f for f in os.listdir(palettes_dir) if is_builtin_palette(f)]
+        bundle_mtime = os.path.getmtime(bundle_path)
+        if any(os.path.getmtime(os.path.join(palettes_dir, f)) > bundle_mtime for f in filenames):
+            return True
+
+        bundled = _read_offsets(np.load(bundle_path, mmap_mode='r'))
+        return set(bundled) != set(filenames)
+    except Exception as e:
+        logging.error(f"Error checking palette bundle: {str(e)}")
+        return True
+
+def load_bundle(bundle_path, palettes_dir):
+    """
+    Memory-map a compiled bundle so palette lookups skip the .hex files.
+
+    Args:
+        bundle_path: The path of the bundle file.
+        palettes_dir: The directory the bundle was compiled from.
+
+    Returns:
+        The number of palettes in the bundle.
+    """
+    global _bundle, _offsets, _bundle_dir
+
+    bundle = np.load(bundle_path, mmap_mode='r')
+    if bundle.dtype != BUNDLE_DTYPE:
+        raise ValueError(f"Unexpected palette bundle format in {bundle_path}")
+
+    _offsets = _read_offsets(bundle)
+    _bundle = bundle
+    _bundle_dir = os.path.realpath(palettes_dir)
+    return len(_offsets)
+
+def get_palette_arrays(palette_path):
+    """
+    Look up a palette in the loaded bundle.
+
+    Args:
+        palette_path: The path to the palette file.
+
+    Returns:
+        A PaletteArrays tuple of read-only views, or None if the palette
+        is not part of the bundle.
+    """
+    if _bundle is None or os.path.realpath(os.path.dirname(palette_path)) != _bundle_dir:
+        return None
+
+    entry = _offsets.get(os.path.basename(palette_path))
+    if entry is None:
+        return None
+
+    start, count = entry
+    records = _bundle[start:start + count]
+    return PaletteArrays(rgb=records['rgb'], lab=records['lab'], luma_order=records['luma_order'])
+
+def load_palette_arrays(palette_path):
+    """
+    Get the arrays of any palette: from the bundle, from the compiled
+    palettes, or by parsing (and compiling) its .hex file.
+
+    Args:
+        palette_path: The path to the palette file.
+
+    Returns:
+        A PaletteArrays tuple of read-only arrays.
+    """
+    arrays = get_palette_arrays(palette_path)
+    if arrays is None:
+        arrays = _get_compiled(palette_path)
+    if arrays is None:
+        arrays = compile_palette(palette_path, parse_hex_palette(palette_path))
+    return arrays
+
+def main():
+    """Compile the built-in palettes into a bundle from the command line."""
+    from config import get_config
+
+    palettes_dir = sys.argv[1] if len(sys.argv) > 1 else get_config().UPLOADED_PALETTES_DEST
+    bundle_path = sys.argv[2] if len(sys.argv) > 2 else get_config().PALETTE_BUNDLE_PATH
+
+    count = compile_bundle(palettes_dir, bundle_path)
+    print(f"Compiled {count} palettes from {palettes_dir} into {bundle_path}")
+
+if __name__ == '__main__':
+    main()
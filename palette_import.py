@@ -0,0 +1,355 @@
+import io
+import os
+import re
+import struct
+import zipfile
+import logging
+from collections import namedtuple
+
+import numpy as np
+from PIL import Image
+from skimage import color
+
+# Palette file formats that can be imported, and archives of them
+PALETTE_FORMATS = ('.hex', '.txt', '.gpl', '.pal', '.ase', '.png', '.gif')
+ARCHIVE_FORMATS = ('.zip',)
+# Default maximum number of (distinct) colors of an imported palette
+MAX_PALETTE_COLORS = 4096
+# Swatch images larger than this are not palettes
+MAX_SWATCH_PIXELS = 1024 * 1024
+# Default limits of an imported archive
+MAX_ARCHIVE_ENTRIES = 500
+MAX_ARCHIVE_BYTES = 64 * 1024 * 1024
+
+ParsedPalette = namedtuple('ParsedPalette', ['name', 'rgb', 'duplicates'])
+
+# A color line of a .hex/.txt palette: RRGGBB, or AARRGGBB (Paint.NET)
+_hex_line = re.compile(r'^[ \t]*(?:#|0x)?((?:[0-9a-fA-F]{2})?[0-9a-fA-F]{6})[ \t]*$', re.MULTILINE)
+# A color line of a GIMP palette: R G B, optionally followed by a name
+_gpl_line = re.compile(r'^[ \t]*(\d+)[ \t]+(\d+)[ \t]+(\d+)(?:[ \t].*)?$', re.MULTILINE)
+
+# Adobe Swatch Exchange block types
+_ASE_COLOR_ENTRY = 0x0001
+_ASE_GROUP_START = 0xC001
+
+class InvalidPaletteError(ValueError):
+    """Raised when an imported file is not a valid palette."""
+
+def _decode_text(data):
+    """Decode a text palette, tolerating a byte order mark and Latin-1 names, with '\n' line ends."""
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        text = data.decode('latin-1')
+    # The line patterns are anchored on '\n' only (CRLF files are common on Windows)
+    return text.replace('\r\n', '\n').replace('\r', '\n')
+
+def _content_lines(text, comment_prefixes):
+    """Get the (line number, line) pairs of a text palette that are not blank or comments."""
+    return [
+        (number, line.strip())
+        for number, line in enumerate(text.splitlines(), 1)
+        if line.strip() and not line.strip().startswith(comment_prefixes)
+    ]
+
+def _check_all_matched(lines, pattern, matched):
+    """Raise an InvalidPaletteError, naming the first line that is not a color, unless every line matched."""
+    if matched == len(lines):
+        return
+    for number, line in lines:
+        if not pattern.match(line):
+            raise InvalidPaletteError(f"Line {number} is not a color: {line[:40]!r}")
+    raise InvalidPaletteError(f"Palette has {len(lines)} lines but {matched} colors")
+
+def _rgb_from_components(components):
+    """Convert (N, 3) integer color components to RGB, checking their range."""
+    components = np.asarray(components, dtype=np.int64).reshape(-1, 3)
+    if components.size and (components.min() < 0 or components.max() > 255):
+        raise InvalidPaletteError("Color components must be between 0 and 255")
+    return components.astype(np.uint8)
+
+def parse_hex(data):
+    """
+    Parse a .hex (Lospec) or .txt (Paint.NET) palette: one hex color per line.
+
+    Lines starting with ';' or '//' are comments; 8-digit colors are
+    AARRGGBB and their alpha is ignored.
+
+    Args:
+        data: The file content, as bytes.
+
+    Returns:
+        A (N, 3) uint8 array of RGB colors.
+    """
+    text = _decode_text(data)
+    lines = _content_lines(text, (';', '//'))
+    colors = _hex_line.findall(text)
+    _check_all_matched(lines, _hex_line, len(colors))
+    return np.frombuffer(bytes.fromhex(''.join(hex_color[-6:] for hex_color in colors)), dtype=np.uint8).reshape(-1, 3)
+
+def parse_gpl(data):
+    """
+    Parse a GIMP palette (.gpl).
+
+    Args:
+        data: The file content, as bytes.
+
+    Returns:
+        A (name, (N, 3) uint8 array of RGB colors) tuple; the name is None if
+        the file does not declare one.
+    """
+    text = _decode_text(data)
+    if not text.lstrip().startswith('GIMP Palette'):
+        raise InvalidPaletteError("Not a GIMP palette: missing 'GIMP Palette' header")
+
+    name_match = re.search(r'^Name:[ \t]*(.+?)[ \t]*$', text, re.MULTILINE)
+    lines = [
+        (number, line) for number, line in _content_lines(text, ('#',))
+        if not line.startswith(('GIMP Palette', 'Name:', 'Columns:'))
+    ]
+    colors = _gpl_line.findall(text)
+    _check_all_matched(lines, _gpl_line, len(colors))
+    return (name_match.group(1) if name_match else None), _rgb_from_components(colors)
+
+def parse_pal(data):
+    """
+    Parse a JASC (Paint Shop Pro) or Microsoft RIFF palette (.pal).
+
+    Args:
+        data: The file content, as bytes.
+
+    Returns:
+        A (N, 3) uint8 array of RGB colors.
+    """
+    if data[:4] == b'RIFF':
+        if data[8:12] != b'PAL ':
+            raise InvalidPaletteError("Not a RIFF palette")
+        offset = 12
+        # Walk the chunks up to the 'data' chunk of the colors
+        try:
+            while offset + 8 <= len(data):
+                chunk_id, chunk_size = struct.unpack_from('<4sI', data, offset)
+                if chunk_id == b'data':
+                    _, count = struct.unpack_from('<HH', data, offset + 8)
+                    if offset + 12 + count * 4 > len(data):
+                        raise InvalidPaletteError(f"RIFF palette declares {count} colors but is truncated")
+                    entries = np.frombuffer(data, dtype=np.uint8, count=count * 4, offset=offset + 12)
+                    return entries.reshape(-1, 4)[:, :3].copy()
+                offset += 8 + chunk_size + (chunk_size & 1)
+        except InvalidPaletteError:
+            raise
+        except (struct.error, ValueError) as e:
+            raise InvalidPaletteError(f"Truncated RIFF palette: {str(e)}")
+        raise InvalidPaletteError("RIFF palette has no color data")
+
+    lines = _content_lines(_decode_text(data), ('#',))
+    if len(lines) < 3 or lines[0][1] != 'JASC-PAL':
+        raise InvalidPaletteError("Not a JASC palette: missing 'JASC-PAL' header")
+    if not lines[2][1].isdigit():
+        raise InvalidPaletteError(f"Line {lines[2][0]} is not a color count: {lines[2][1][:40]!r}")
+    count = int(lines[2][1])
+    rows = [line.split() for _, line in lines[3:3 + count]]
+    if len(rows) < count:
+        raise InvalidPaletteError(f"Palette declares {count} colors but has {len(rows)}")
+    for (number, line), row in zip(lines[3:], rows):
+        # Some editors append an alpha component
+        if len(row) not in (3, 4) or not all(value.isdigit() for value in row):
+            raise InvalidPaletteError(f"Line {number} is not a color: {line[:40]!r}")
+    return _rgb_from_components([row[:3] for row in rows])
+
+def parse_ase(data):
+    """
+    Parse an Adobe Swatch Exchange file (.ase).
+
+    RGB, CMYK, LAB and gray swatches are converted to sRGB; groups are
+    flattened in file order.
+
+    Args:
+        data: The file content, as bytes.
+
+    Returns:
+        A (name, (N, 3) uint8 array of RGB colors) tuple; the name is that of
+        the first group, or None.
+    """
+    if data[:4] != b'ASEF' or len(data) < 12:
+        raise InvalidPaletteError("Not an Adobe Swatch Exchange file: missing 'ASEF' header")
+
+    (block_count,) = struct.unpack_from('>I', data, 8)
+    offset = 12
+    group_name = None
+    models = []
+    values = []
+    try:
+        for _ in range(block_count):
+            block_type, block_length = struct.unpack_from('>HI', data, offset)
+            block = data[offset + 6:offset + 6 + block_length]
+            offset += 6 + block_length
+            if block_type not in (_ASE_COLOR_ENTRY, _ASE_GROUP_START):
+                continue
+            (name_length,) = struct.unpack_from('>H', block, 0)
+            name_end = 2 + name_length * 2
+            if block_type == _ASE_GROUP_START:
+                if group_name is None:
+                    group_name = block[2:name_end].decode('utf-16-be').rstrip('\x00') or None
+                continue
+            model = block[name_end:name_end + 4]
+            n_values = {b'RGB ': 3, b'LAB ': 3, b'CMYK': 4, b'Gray': 1}.get(model)
+            if n_values is None:
+                raise InvalidPaletteError(f"Unsupported swatch color model {model!r}")
+            models.append(model)
+            values.append(struct.unpack_from(f'>{n_values}f', block, name_end + 4) + (0.0,) * (4 - n_values))
+    except struct.error:
+        raise InvalidPaletteError("Truncated Adobe Swatch Exchange file")
+    except UnicodeDecodeError:
+        raise InvalidPaletteError("Adobe Swatch Exchange file has an invalid group name")
+
+    # Convert each color model at once
+    models = np.array(models, dtype='S4')
+    values = np.array(values, dtype=np.float64).reshape(-1, 4)
+    rgb = np.zeros((len(values), 3), dtype=np.float64)
+    is_rgb = models == b'RGB '
+    rgb[is_rgb] = values[is_rgb, :3]
+    is_cmyk = models == b'CMYK'
+    rgb[is_cmyk] = (1 - values[is_cmyk, :3]) * (1 - values[is_cmyk, 3:4])
+    is_gray = models == b'Gray'
+    rgb[is_gray] = values[is_gray, :1]
+    is_lab = models == b'LAB '
+    if is_lab.any():
+        # L is stored as a fraction of 100
+        lab = values[is_lab, :3] * np.array([100.0, 1.0, 1.0])
+        rgb[is_lab] = color.lab2rgb(lab[np.newaxis])[0]
+    return group_name, (np.clip(rgb, 0, 1) * 255 + 0.5).astype(np.uint8)
+
+def parse_swatch_image(data):
+    """
+    Read the colors of a swatch image (.png, .gif), e.g. a Lospec palette image.
+
+    Colors are taken in reading order (row by row); transparent pixels are
+    ignored.
+
+    Args:
+        data: The file content, as bytes.
+
+    Returns:
+        A (N, 3) uint8 array of RGB colors, possibly with duplicates.
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            if img.width * img.height > MAX_SWATCH_PIXELS:
+                raise InvalidPaletteError(f"Swatch image is too large ({img.width}x{img.height})")
+            pixels = np.asarray(img.convert('RGBA')).reshape(-1, 4)
+    except InvalidPaletteError:
+        raise
+    except Exception as e:
+        raise InvalidPaletteError(f"Unreadable swatch image: {str(e)}")
+    return pixels[pixels[:, 3] > 0, :3]
+
+def dedupe_colors(rgb):
+    """
+    Remove repeated colors, keeping the first occurrence of each.
+
+    Args:
+        rgb: A (N, 3) uint8 array of RGB colors.
+
+    Returns:
+        A (M, 3) uint8 array of the distinct colors, in their original order.
+    """
+    rgb = np.asarray(rgb, dtype=np.uint8).reshape(-1, 3)
+    packed = (rgb[:, 0].astype(np.uint32) << 16) | (rgb[:, 1].astype(np.uint32) << 8) | rgb[:, 2]
+    _, first = np.unique(packed, return_index=True)
+    return rgb[np.sort(first)]
+
+def to_hex_colors(rgb):
+    """Convert a (N, 3) array of RGB colors to 'rrggbb' strings."""
+    hex_string = np.ascontiguousarray(rgb, dtype=np.uint8).tobytes().hex()
+    return [hex_string[i:i + 6] for i in range(0, len(hex_string), 6)]
+
+def parse_palette(filename, data, max_colors=MAX_PALETTE_COLORS):
+    """
+    Parse, validate and dedupe a palette file of any supported format.
+
+    Args:
+        filename: The file name; its extension selects the format.
+        data: The file content, as bytes.
+        max_colors: The maximum number of distinct colors.
+
+    Returns:
+        A ParsedPalette of the palette name (declared by the file, or the
+        file name), its distinct colors and the number of duplicates removed.
+
+    Raises:
+        InvalidPaletteError: If the file is not a valid palette.
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    name = None
+    if ext in ('.hex', '.txt'):
+        rgb = parse_hex(data)
+    elif ext == '.gpl':
+        name, rgb = parse_gpl(data)
+    elif ext == '.pal':
+        rgb = parse_pal(data)
+    elif ext == '.ase':
+        name, rgb = parse_ase(data)
+    elif ext in ('.png', '.gif'):
+        rgb = parse_swatch_image(data)
+    else:
+        raise InvalidPaletteError(f"Unsupported palette format '{ext}'")
+
+    colors = dedupe_colors(rgb)
+    if len(colors) == 0:
+        raise InvalidPaletteError("Palette has no colors")
+    if len(colors) > max_colors:
+        raise InvalidPaletteError(f"Palette has {len(colors)} colors, the maximum is {max_colors}")
+
+    name = name or os.path.splitext(os.path.basename(filename))[0]
+    return ParsedPalette(name=name, rgb=colors, duplicates=len(rgb) - len(colors))
+
+def iter_archive(data, max_entries=MAX_ARCHIVE_ENTRIES, max_bytes=MAX_ARCHIVE_BYTES, max_colors=MAX_PALETTE_COLORS):
+    """
+    Parse the palettes of a zip archive.
+
+    Folders, hidden files and macOS metadata are skipped; nested archives
+    are not opened.
+
+    Args:
+        data: The archive content, as bytes.
+        max_entries: The maximum number of palette files.
+        max_bytes: The maximum total uncompressed size of the palette files.
+        max_colors: The maximum number of distinct colors per palette.
+
+    Yields:
+        (entry name, ParsedPalette or InvalidPaletteError) tuples, in archive order.
+
+    Raises:
+        InvalidPaletteError: If the archive is unreadable or over a limit.
+    """
+    try:
+        archive = zipfile.ZipFile(io.BytesIO(data))
+    except zipfile.BadZipFile as e:
+        raise InvalidPaletteError(f"Unreadable zip archive: {str(e)}")
+
+    with archive:
+        entries = [
+            info for info in archive.infolist()
+            if not info.is_dir()
+            and not info.filename.startswith('__MACOSX/')
+            and not os.path.basename(info.filename).startswith('.')
+        ]
+        if len(entries) > max_entries:
+            raise InvalidPaletteError(f"Archive has {len(entries)} files, the maximum is {max_entries}")
+        # Check the declared sizes before decompressing anything (zip bombs)
+        total_bytes = sum(info.file_size for info in entries)
+        if total_bytes > max_bytes:
+            raise InvalidPaletteError(f"Archive expands to {total_bytes / 2**20:.1f} MB, the maximum is {max_bytes / 2**20:.0f} MB")
+
+        for info in entries:
+            if not info.filename.lower().endswith(PALETTE_FORMATS):
+                yield info.filename, InvalidPaletteError("Not a palette file")
+                continue
+            try:
+                yield info.filename, parse_palette(info.filename, archive.read(info), max_colors)
+            except InvalidPaletteError as e:
+                yield info.filename, e
+            except Exception as e:
+                logging.error(f"Error reading palette {info.filename} from archive: {str(e)}")
+                yield info.filename, InvalidPaletteError("Unreadable palette file")
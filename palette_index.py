@@ -0,0 +1,255 @@
+import os
+import logging
+import threading
+
+import numpy as np
+from PIL import Image
+from skimage import color
+from scipy.spatial import cKDTree
+
+import palette_bundle
+
+# Number of quantiles stored per projection direction
+EMBEDDING_QUANTILES = 16
+# Palettes reranked with the exact Chamfer distance after the embedding pass
+RERANK_CANDIDATES = 32
+# Weight of palette colors missing from the query (coverage) in the score
+COVERAGE_WEIGHT = 0.25
+# Colors extracted from an image to describe it
+DOMINANT_COLORS = 16
+# Colors of a reference palette compared against the others (larger palettes are sampled)
+MAX_QUERY_COLORS = 256
+
+# Fixed projection directions in Lab: the three axes plus random directions.
+# Quantiles of the colors projected on each direction form a sliced
+# Wasserstein embedding: the mean absolute difference between two embeddings
+# approximates the Earth Mover's Distance between the color distributions.
+_directions = np.vstack([np.eye(3), np.random.RandomState(0).normal(size=(9, 3))])
+_directions = (_directions / np.linalg.norm(_directions, axis=1, keepdims=True)).astype(np.float32)
+_quantile_levels = (np.arange(EMBEDDING_QUANTILES) + 0.5) / EMBEDDING_QUANTILES
+
+# Index state, shared by all requests of a worker
+_ids = []  # Palette ids, one per embedding row
+_embeddings = np.zeros((0, len(_directions) * EMBEDDING_QUANTILES), dtype=np.float32)
+_lab_sets = {}  # palette_id -> (N, 3) Lab colors
+_index_lock = threading.Lock()
+
+def compute_embedding(lab, weights=None):
+    """
+    Compute the sliced Wasserstein embedding of a weighted set of Lab colors.
+
+    Args:
+        lab: A (N, 3) array of Lab colors.
+        weights: Optional (N,) weights of the colors (default: uniform).
+
+    Returns:
+        A 1-D float32 embedding vector.
+    """
+    lab = np.asarray(lab, dtype=np.float32).reshape(-1, 3)
+    weights = np.ones(len(lab)) if weights is None else np.asarray(weights, dtype=np.float64)
+
+    projections = lab @ _directions.T
+    embedding = np.empty((len(_directions), EMBEDDING_QUANTILES), dtype=np.float32)
+    for i in range(len(_directions)):
+        order = np.argsort(projections[:, i])
+        sorted_weights = weights[order]
+        # Weighted quantiles: interpolate on the midpoints of the weight CDF
+        cdf = (np.cumsum(sorted_weights) - sorted_weights / 2) / sorted_weights.sum()
+        embedding[i] = np.interp(_quantile_levels, cdf, projections[order, i])
+    return embedding.ravel()
+
+def _palette_lab(palette_path):
+    """Get the Lab colors of a palette, from the bundle or compiled palettes when possible."""
+    return np.asarray(palette_bundle.load_palette_arrays(palette_path).lab, dtype=np.float32)
+
+def build_index(palettes, palettes_dir):
+    """
+    Build the similarity index of a list of palettes.
+
+    Args:
+        palettes: The InMemoryPalette objects to index.
+        palettes_dir: The directory containing the palette files.
+
+    Returns:
+        The number of indexed palettes.
+    """
+    global _ids, _embeddings, _lab_sets
+
+    ids = []
+    embeddings = []
+    lab_sets = {}
+    for palette in palettes:
+        try:
+            lab = _palette_lab(os.path.join(palettes_dir, palette.filename))
+        except Exception as e:
+            logging.error(f"Skipping palette {palette.filename} in similarity index: {str(e)}")
+            continue
+        ids.append(str(palette.id))
+        embeddings.append(compute_embedding(lab))
+        lab_sets[str(palette.id)] = lab
+
+    with _index_lock:
+        _ids = ids
+        _embeddings = np.vstack(embeddings) if embeddings else _embeddings[:0]
+        _lab_sets = lab_sets
+    return len(ids)
+
+def add_palette(palette_id, palette_path):
+    """
+    Add a palette to the index, or replace its entry.
+
+    Args:
+        palette_id: The id of the palette.
+        palette_path: The path to the palette file.
+    """
+    global _ids, _embeddings, _lab_sets
+
+    palette_id = str(palette_id)
+    lab = _palette_lab(palette_path)
+    embedding = compute_embedding(lab)
+
+    # Updates replace the index state instead of mutating it, so searches
+    # running concurrently keep a consistent snapshot
+    with _index_lock:
+        if palette_id in _lab_sets:
+            embeddings = _embeddings.copy()
+            embeddings[_ids.index(palette_id)] = embedding
+            _embeddings = embeddings
+        else:
+            _ids = _ids + [palette_id]
+            _embeddings = np.vstack([_embeddings, embedding])
+        _lab_sets = dict(_lab_sets, **{palette_id: lab})
+
+def remove_palette(palette_id):
+    """
+    Remove a palette from the index.
+
+    Args:
+        palette_id: The id of the palette.
+    """
+    global _ids, _embeddings, _lab_sets
+
+    palette_id = str(palette_id)
+    with _index_lock:
+        if palette_id not in _lab_sets:
+            return
+        row = _ids.index(palette_id)
+        _ids = _ids[:row] + _ids[row + 1:]
+        _embeddings = np.delete(_embeddings, row, axis=0)
+        _lab_sets = {key: lab for key, lab in _lab_sets.items() if key != palette_id}
+
+def extract_dominant_colors(image, n_colors=DOMINANT_COLORS):
+    """
+    Extract the dominant colors of an image.
+
+    Args:
+        image: A PIL Image in RGB mode.
+        n_colors: The maximum number of colors to extract.
+
+    Returns:
+        A ((K, 3) uint8 RGB colors, (K,) pixel fractions) tuple.
+    """
+    small = image.copy()
+    small.thumbnail((64, 64), Image.BILINEAR)
+    quantized = small.quantize(colors=n_colors, method=Image.Quantize.FASTOCTREE)
+
+    palette = np.array(quantized.getpalette()[:3 * 256], dtype=np.uint8).reshape(-1, 3)
+    counts, indices = zip(*quantized.getcolors())
+    counts = np.array(counts, dtype=np.float64)
+    return palette[list(indices)], counts / counts.sum()
+
+def _chamfer_score(query_lab, weights, query_tree, palette_lab):
+    """
+    Score how well a palette reproduces the query colors (lower is better).
+
+    The score is the weighted mean distance from each query color to its
+    nearest palette color, plus a small penalty for palette colors far from
+    every query color. Nearest colors are found with k-d trees, so memory
+    grows with the number of colors rather than with their product.
+
+    Args:
+        query_lab: A (Q, 3) array of query Lab colors.
+        weights: The (Q,) weights of the query colors, summing to 1.
+        query_tree: A cKDTree of the query colors (all of them, when
+                    query_lab is a sample).
+        palette_lab: A (P, 3) array of the palette's Lab colors.
+    """
+    query_distances, _ = cKDTree(palette_lab).query(query_lab)
+    palette_distances, _ = query_tree.query(palette_lab)
+    fidelity = float(np.dot(weights, query_distances))
+    coverage = float(palette_distances.mean())
+    return fidelity + COVERAGE_WEIGHT * coverage
+
+def _search(query_lab, weights, limit, candidate_ids, exclude_id=None, coverage_lab=None):
+    """
+    Rank indexed palettes against a query: embedding pass, then Chamfer rerank.
+
+    coverage_lab optionally gives all the query colors when query_lab is a
+    sample of them.
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    weights = weights / weights.sum()
+    query_embedding = compute_embedding(query_lab, weights)
+
+    with _index_lock:
+        ids = _ids
+        embeddings = _embeddings
+        lab_sets = _lab_sets
+
+    allowed = np.array([
+        palette_id != exclude_id and (candidate_ids is None or palette_id in candidate_ids)
+        for palette_id in ids
+    ], dtype=bool)
+    if not allowed.any():
+        return []
+
+    rows = np.flatnonzero(allowed)
+    approximate = np.abs(embeddings[rows] - query_embedding).mean(axis=1)
+    shortlist = rows[np.argsort(approximate)[:max(limit, RERANK_CANDIDATES)]]
+
+    query_tree = cKDTree(query_lab if coverage_lab is None else coverage_lab)
+    scored = [(ids[row], _chamfer_score(query_lab, weights, query_tree, lab_sets[ids[row]])) for row in shortlist]
+    scored.sort(key=lambda item: item[1])
+    return scored[:limit]
+
+def suggest_for_image(image, limit=10, candidate_ids=None):
+    """
+    Find the palettes that best match an image's dominant colors.
+
+    Args:
+        image: A PIL Image in RGB mode.
+        limit: The maximum number of palettes to return.
+        candidate_ids: Optional set of palette ids to search (default: all).
+
+    Returns:
+        A list of (palette_id, score) tuples, best match first.
+    """
+    rgb, weights = extract_dominant_colors(image)
+    query_lab = color.rgb2lab(rgb[np.newaxis] / 255.0)[0].astype(np.float32)
+    return _search(query_lab, weights, limit, candidate_ids)
+
+def suggest_for_palette(palette_id, limit=10, candidate_ids=None):
+    """
+    Find the palettes most similar to an indexed palette.
+
+    Args:
+        palette_id: The id of the reference palette.
+        limit: The maximum number of palettes to return.
+        candidate_ids: Optional set of palette ids to search (default: all).
+
+    Returns:
+        A list of (palette_id, score) tuples, best match first, or None if
+        the palette is not indexed.
+    """
+    query_lab = _lab_sets.get(str(palette_id))
+    if query_lab is None:
+        return None
+    coverage_lab = query_lab
+    if len(query_lab) > MAX_QUERY_COLORS:
+        # A fixed sample, so the same palette always gets the same suggestions
+        sample = np.random.RandomState(0).choice(len(query_lab), MAX_QUERY_COLORS, replace=False)
+        query_lab = query_lab[np.sort(sample)]
+    return _search(
+        query_lab, np.ones(len(query_lab)), limit, candidate_ids,
+        exclude_id=str(palette_id), coverage_lab=coverage_lab
+    )
@@ -1,14 +1,27 @@
 import os
 import uuid
 import shutil
+import itertools
+import threading
 import logging
+import numpy as np
 from werkzeug.utils import secure_filename
 from flask import session
+import palette_bundle
+import palette_index
+
+# Number of colors previewed next to a palette's name in the palette list
+SWATCH_COLORS = 5
 
 # In-memory storage for palettes
 _palettes = []
 # Session-based palettes (mapping session_id -> palette_ids)
 _session_palettes = {}
+# Palette ids are never reused, so a removed temporary palette's id cannot
+# name another palette (in the similarity index, for example)
+_palette_ids = itertools.count(1)
+# Guards the palette list and session palettes against the worker's request threads
+_palettes_lock = threading.RLock()
 
 # Function to clean up a session's palettes
 def cleanup_session_palettes(session_id, palettes_dir=None):
@@ -20,39 +33,34 @@ def cleanup_session_palettes(session_id, palettes_dir=None):
         session_id: The ID of the session to clean up.
         palettes_dir: The directory where palette files are stored.
     """
-    if session_id not in _session_palettes:
-        return  # Nothing to clean up
-    
-    # Get all palette IDs for this session
-    palette_ids = _session_palettes[session_id]
+    # Take the session's palettes out of the list first, so no other
+    # request finds a palette whose file is being removed
+    with _palettes_lock:
+        # Get all palette IDs for this session
+        palette_ids = _session_palettes.pop(session_id, None)
+        if palette_ids is None:
+            return  # Nothing to clean up
+        palettes_to_remove = [
+            palette for palette in _palettes
+            if palette.is_temp and str(palette.id) in palette_ids
+        ]
+        for palette in palettes_to_remove:
+            _palettes.remove(palette)
     
-    # For each palette ID, remove the palette from _palettes
-    # and delete the file if it exists
-    palettes_to_remove = []
-    
-    for palette_id in palette_ids:
-        # Find the palette object
-        for palette in _palettes:
-            if str(palette.id) == str(palette_id) and palette.is_temp:
-                palettes_to_remove.append(palette)
-                
-                # Delete the palette file if we know where it is
-                if palettes_dir and palette.filename:
-                    try:
-                        filepath = os.path.join(palettes_dir, palette.filename)
-                        if os.path.exists(filepath):
-                            os.remove(filepath)
-                            logging.debug(f"Removed temporary palette file: {filepath}")
-                    except Exception as e:
-                        logging.error(f"Error removing palette file: {str(e)}")
-    
-    # Remove the palettes from the _palettes list
+    # Remove the palettes from the similarity index and delete their files
     for palette in palettes_to_remove:
-        _palettes.remove(palette)
+        palette_index.remove_palette(palette.id)
+        if palettes_dir and palette.filename:
+            try:
+                filepath = os.path.join(palettes_dir, palette.filename)
+                palette_bundle.forget_palette(filepath)
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+                    logging.debug(f"Removed temporary palette file: {filepath}")
+            except Exception as e:
+                logging.error(f"Error removing palette file: {str(e)}")
         logging.debug(f"Removed temporary palette: {palette.name}")
     
-    # Clear the session's palette IDs
-    del _session_palettes[session_id]
     logging.debug(f"Cleaned up palette session data for session: {session_id}")
 
 class InMemoryPalette:
@@ -63,6 +71,19 @@ class InMemoryPalette:
         self.filename = filename
         self.description = description
         self.is_temp = is_temp  # True for user-uploaded palettes in session
+        # Precomputed for the palette list (see describe_palette)
+        self.size = 0
+        self.swatch = []
+
+    def to_summary(self):
+        """Get the compact entry of the palette in the palette list."""
+        return {
+            'id': self.id,
+            'name': self.name,
+            'size': self.size,
+            'swatch': self.swatch,
+            'is_temp': self.is_temp
+        }
 
     def to_dict(self):
         """Convert the palette to a dictionary for JSON serialization."""
@@ -79,12 +100,12 @@ def load_palettes_from_folder(palettes_dir):
     Load all palettes from the palettes folder.
     This should be called on application startup.
     """
-    global _palettes
-    _palettes = []  # Clear the palettes
+    global _palettes, _palette_ids
     
     try:
-        # Get all .hex files in the palettes directory
-        palette_files = []
+        # Build the new list aside and swap it in, so requests never see it half loaded
+        palettes = []
+        palette_ids = itertools.count(1)
         
         for filename in os.listdir(palettes_dir):
             if filename.endswith('.hex'):
@@ -94,7 +115,7 @@ def load_palettes_from_folder(palettes_dir):
                 name = name.replace('_', ' ')
                 
                 # Add the palette to the list
-                palette_id = str(len(_palettes) + 1)  # Simple ID scheme
+                palette_id = str(next(palette_ids))  # Simple ID scheme
                 palette = InMemoryPalette(
                     id=palette_id,
                     name=name,
@@ -102,13 +123,24 @@ def load_palettes_from_folder(palettes_dir):
                     description=f"{name} palette",
                     is_temp=False
                 )
-                _palettes.append(palette)
+                palettes.append(palette)
         
         # Sort palettes by name
-        _palettes.sort(key=lambda x: x.name.lower())
+        palettes.sort(key=lambda x: x.name.lower())
+        
+        # Precompute the palette list entries, so listing never reads the files
+        for palette in palettes:
+            describe_palette(palette, os.path.join(palettes_dir, palette.filename))
+        
+        # Index the palettes for similarity search
+        palette_index.build_index(palettes, palettes_dir)
         
-        print(f"Successfully loaded {len(_palettes)} palettes from {palettes_dir}")
-        return len(_palettes)
+        with _palettes_lock:
+            _palettes = palettes
+            _palette_ids = palette_ids
+        
+        print(f"Successfully loaded {len(palettes)} palettes from {palettes_dir}")
+        return len(palettes)
     except Exception as e:
         print(f"Error loading palettes from folder: {str(e)}")
         return 0
@@ -123,17 +155,51 @@ def get_all_palettes():
     # Get current session ID
     session_id = session.get('session_id')
     
-    # If no session, return only permanent palettes
-    if not session_id:
-        return [p for p in _palettes if not p.is_temp]
-    
-    # Get the list of palette IDs associated with this session
-    session_palette_ids = _session_palettes.get(session_id, [])
-    
-    # Return all permanent palettes and only temporary palettes 
-    # that belong to the current session
-    return [p for p in _palettes if not p.is_temp or 
-            (p.is_temp and str(p.id) in session_palette_ids)]
+    with _palettes_lock:
+        # If no session, return only permanent palettes
+        if not session_id:
+            return [p for p in _palettes if not p.is_temp]
+        
+        # Get the list of palette IDs associated with this session
+        session_palette_ids = _session_palettes.get(session_id, [])
+        
+        # Return all permanent palettes and only temporary palettes 
+        # that belong to the current session
+        return [p for p in _palettes if not p.is_temp or 
+                (p.is_temp and str(p.id) in session_palette_ids)]
+
+def search_palettes(palettes, query=None, min_colors=None, max_colors=None):
+    """
+    Filter palettes by name and number of colors.
+
+    Args:
+        palettes: The InMemoryPalette objects to filter (see get_all_palettes).
+        query: Optional text the palette name must contain, ignoring case.
+        min_colors: Optional minimum number of colors.
+        max_colors: Optional maximum number of colors.
+
+    Returns:
+        The matching palettes, in their original order.
+    """
+    query = query.strip().lower() if query else None
+    return [
+        p for p in palettes
+        if (not query or query in p.name.lower())
+        and (min_colors is None or p.size >= min_colors)
+        and (max_colors is None or p.size <= max_colors)
+    ]
+
+def get_default_palette():
+    """
+    Get the palette selected by default in the UI.
+
+    Does not need a request context, unlike get_all_palettes.
+
+    Returns:
+        The first permanent InMemoryPalette by name, or None if none are loaded.
+    """
+    with _palettes_lock:
+        return next((p for p in _palettes if not p.is_temp), None)
 
 def get_palette_by_id(palette_id):
     """
@@ -147,11 +213,9 @@ def get_palette_by_id(palette_id):
         doesn't belong to the current session.
     """
     # Find the palette by ID first
-    found_palette = None
-    for palette in _palettes:
-        if str(palette.id) == str(palette_id):
-            found_palette = palette
-            break
+    with _palettes_lock:
+        found_palette = next((p for p in _palettes if str(p.id) == str(palette_id)), None)
+        session_palette_ids = list(_session_palettes.get(session.get('session_id'), []))
             
     if not found_palette:
         return None
@@ -161,12 +225,10 @@ def get_palette_by_id(palette_id):
         return found_palette
         
     # For temporary palettes, check session ownership
-    session_id = session.get('session_id')
-    if not session_id:
+    if not session.get('session_id'):
         return None  # No session, no temporary palettes
         
     # Check if this temporary palette belongs to the current session
-    session_palette_ids = _session_palettes.get(session_id, [])
     if str(found_palette.id) in session_palette_ids:
         return found_palette
         
@@ -183,11 +245,27 @@ def get_palette_colors(palette_path):
     Returns:
         A list of hexadecimal color codes.
     """
-    with open(palette_path, 'r') as f:
-        colors = [line.strip() for line in f if line.strip()]
-    return colors
+    # Served from the memory-mapped bundle or the compiled palettes
+    arrays = palette_bundle.load_palette_arrays(palette_path)
+    return [f"{r:02x}{g:02x}{b:02x}" for r, g, b in arrays.rgb.tolist()]
+
+def describe_palette(palette, palette_path):
+    """
+    Precompute the number of colors and the swatch of a palette.
+
+    Args:
+        palette: The InMemoryPalette to describe.
+        palette_path: The path to the palette file.
+    """
+    try:
+        colors = get_palette_colors(palette_path)
+    except Exception as e:
+        logging.error(f"Error describing palette {palette.filename}: {str(e)}")
+        return
+    palette.size = len(colors)
+    palette.swatch = colors[:SWATCH_COLORS]
 
-def add_palette(name, palette_file, description="", is_temp=True, palettes_dir=None):
+def add_palette(name, palette_file=None, description="", is_temp=True, palettes_dir=None, colors=None):
     """
     Add a new palette to the in-memory storage and save the palette file.
     If the palette is temporary, it is associated with the current session.
@@ -198,46 +276,63 @@ def add_palette(name, palette_file, description="", is_temp=True, palettes_dir=N
         description: An optional description of the palette.
         is_temp: Whether this palette is temporary (user-uploaded).
         palettes_dir: The directory where palette files should be saved.
+        colors: A list of 'rrggbb' color codes, used instead of palette_file
+                for imported and generated palettes.
 
     Returns:
         The newly created InMemoryPalette object, or None if the operation failed.
     """
     try:
         # Create a unique filename to avoid conflicts
-        original_filename = secure_filename(palette_file.filename)
+        original_filename = secure_filename(palette_file.filename if palette_file else f"{name}.hex")
         base, ext = os.path.splitext(original_filename)
         unique_filename = f"{base}_{uuid.uuid4().hex[:8]}{ext}"
         
-        # Generate a unique ID
-        palette_id = str(len(_palettes) + 1)
-        
-        # Create a new palette record
-        palette = InMemoryPalette(
-            id=palette_id,
-            name=name,
-            filename=unique_filename,
-            description=description,
-            is_temp=is_temp
-        )
-        
-        # Add the palette to the in-memory storage
-        _palettes.append(palette)
-        
-        # If it's a temporary palette, associate it with the current session
-        if is_temp:
-            session_id = session.get('session_id')
-            if session_id:
-                if session_id not in _session_palettes:
-                    _session_palettes[session_id] = []
-                _session_palettes[session_id].append(palette_id)
-                logging.debug(f"Added palette {palette_id} to session {session_id}")
-            else:
-                logging.warning("Temporary palette created but no session ID found")
+        with _palettes_lock:
+            # Generate a unique ID
+            palette_id = str(next(_palette_ids))
+            
+            # Create a new palette record
+            palette = InMemoryPalette(
+                id=palette_id,
+                name=name,
+                filename=unique_filename,
+                description=description,
+                is_temp=is_temp
+            )
+            
+            # Add the palette to the in-memory storage
+            _palettes.append(palette)
+            
+            # If it's a temporary palette, associate it with the current session
+            if is_temp:
+                session_id = session.get('session_id')
+                if session_id:
+                    if session_id not in _session_palettes:
+                        _session_palettes[session_id] = []
+                    _session_palettes[session_id].append(palette_id)
+                    logging.debug(f"Added palette {palette_id} to session {session_id}")
+                else:
+                    logging.warning("Temporary palette created but no session ID found")
         
         # Save the palette file
         if palettes_dir:
             filepath = os.path.join(palettes_dir, unique_filename)
-            palette_file.save(filepath)
+            if palette_file:
+                palette_file.save(filepath)
+            else:
+                with open(filepath, 'w') as f:
+                    f.write('\n'.join(colors) + '\n')
+                # Compile the quantizer arrays now rather than on first use
+                rgb = np.frombuffer(bytes.fromhex(''.join(colors)), dtype=np.uint8).reshape(-1, 3)
+                palette_bundle.compile_palette(filepath, rgb)
+            describe_palette(palette, filepath)
+            
+            # Make the palette searchable right away
+            try:
+                palette_index.add_palette(palette_id, filepath)
+            except Exception as e:
+                logging.error(f"Error indexing palette {name}: {str(e)}")
         
         return palette
     except Exception as e:
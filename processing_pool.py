@@ -0,0 +1,112 @@
+import os
+import time
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import palette_bundle
+import memory_budget
+import job_control
+import stage_cache
+from image_processor import process_image, process_source_image
+
+# The process pool CPU-bound processing is offloaded to, if enabled
+_executor = None
+
+def _init_worker(bundle_path, palettes_dir):
+    """Map the palette bundle in a new pool process."""
+    try:
+        palette_bundle.load_bundle(bundle_path, palettes_dir)
+    except Exception as e:
+        logging.error(f"Error loading the palette bundle in a pool process: {str(e)}")
+
+def _worker_pid(_):
+    """Get the pid of a pool process."""
+    return os.getpid()
+
+def start(app_config, max_workers=None):
+    """
+    Start the process pool.
+
+    Processes are spawned rather than forked, since the serving process
+    already runs threads (and possibly OpenMP) that must not be forked.
+    They are spawned with single-threaded BLAS and OpenMP, unless
+    OMP_NUM_THREADS etc. are already set.
+
+    Args:
+        app_config: The Flask app configuration.
+        max_workers: The number of processes (default: the number of cores).
+    """
+    global _executor
+    if _executor is not None:
+        return
+    max_workers = max_workers or os.cpu_count() or 1
+    # Each pool process computes on one core. BLAS and OpenMP size their
+    # thread pools when NumPy, SciPy and scikit-learn are imported, which
+    # happens before the initializer runs, so the processes must inherit
+    # these variables when they are spawned.
+    for variable in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+        os.environ.setdefault(variable, '1')
+    _executor = ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_worker,
+        initargs=(app_config['PALETTE_BUNDLE_PATH'], app_config['UPLOADED_PALETTES_DEST'])
+    )
+    # Spawn (and import the processing modules in) every process now rather
+    # than on the first requests
+    pids = set(_executor.map(_worker_pid, range(max_workers)))
+    logging.info(f"Started {len(pids)} processing pool processes")
+
+def shutdown():
+    """Stop the process pool, waiting for running jobs."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+
+def is_enabled():
+    """Check whether processing is offloaded to the pool."""
+    return _executor is not None
+
+def _run_job(function, args, kwargs, request_id, remaining_time, flag_dir, budget_bytes):
+    """
+    Run a processing function in a pool process.
+
+    The cancel token and memory budget of the request are recreated here:
+    cancellation reaches the process through the request's flag file.
+
+    Returns:
+        A (result, peak_bytes, stage outcomes) tuple.
+    """
+    cancel_token = job_control.CancelToken(request_id, remaining_time, flag_dir) if request_id else None
+    with memory_budget.track(budget_bytes) as budget, stage_cache.track() as outcomes:
+        result = function(*args, cancel_token=cancel_token, **kwargs)
+    return result, budget.peak_bytes, outcomes
+
+def _submit(function, args, kwargs, cancel_token, flag_dir):
+    """Run a processing function in the pool and wait for its result."""
+    remaining_time = None
+    if cancel_token is not None and cancel_token.deadline is not None:
+        remaining_time = max(cancel_token.deadline - time.monotonic(), 0.001)
+    request_id = cancel_token.request_id if cancel_token is not None else None
+
+    # The pool process gets what is left of the request's memory budget
+    budget = memory_budget.current()
+    budget_bytes = max(budget.limit_bytes - budget.current_bytes, 1) if budget and budget.limit_bytes else 0
+
+    future = _executor.submit(_run_job, function, args, kwargs, request_id, remaining_time, flag_dir, budget_bytes)
+    result, peak_bytes, outcomes = future.result()
+    stage_cache.merge(outcomes)
+
+    if budget is not None:
+        budget.peak_bytes = max(budget.peak_bytes, budget.current_bytes + peak_bytes)
+    return result
+
+def process_source_image_in_pool(source, *args, cancel_token=None, flag_dir=None, **kwargs):
+    """Run image_processor.process_source_image in the pool, see its arguments."""
+    return _submit(process_source_image, (source,) + args, kwargs, cancel_token, flag_dir)
+
+def process_image_in_pool(image_path, *args, cancel_token=None, flag_dir=None, **kwargs):
+    """Run image_processor.process_image in the pool, see its arguments."""
+    return _submit(process_image, (image_path,) + args, kwargs, cancel_token, flag_dir)
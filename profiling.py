@@ -0,0 +1,230 @@
+import io
+import os
+import hmac
+import json
+import time
+import uuid
+import pstats
+import cProfile
+import logging
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+# Header (or query argument) carrying the admin token of profiled requests
+# and profile downloads
+TOKEN_HEADER = 'X-Profile-Token'
+TOKEN_QUERY_ARG = 'profile_token'
+# Number of entries kept in the summary of a profile
+TOP_FUNCTIONS = 40
+TOP_ALLOCATIONS = 25
+
+# Only one request per worker process is profiled at a time: cProfile and
+# tracemalloc are process-wide and slow down every thread while they run
+_profile_lock = threading.Lock()
+_last_started = 0.0
+# The profile of the request handled by the current thread, if any
+_local = threading.local()
+
+def request_token(request):
+    """Get the profiling token sent with a request, or None."""
+    return request.headers.get(TOKEN_HEADER) or request.args.get(TOKEN_QUERY_ARG)
+
+def is_authorized(token, admin_token):
+    """Check a profiling token against the configured admin token (profiling is disabled without one)."""
+    return bool(token and admin_token) and hmac.compare_digest(token.encode(), admin_token.encode())
+
+def is_valid_profile_id(profile_id):
+    """Check that a profile id is a bare hex id (never a path)."""
+    return len(profile_id) == 32 and all(c in '0123456789abcdef' for c in profile_id)
+
+class RequestProfile:
+    """
+    The profile of one request: cProfile statistics, stage timings and
+    tracemalloc allocation statistics.
+
+    Attributes:
+        id: The profile id, or None if the request was not profiled.
+        skipped: Why the request was not profiled ('busy' or 'rate_limited'), or None.
+    """
+    def __init__(self, label, skipped=None):
+        self.id = None if skipped else uuid.uuid4().hex
+        self.label = label
+        self.skipped = skipped
+        self.stages = {}
+        self.status = 'ok'
+        self._profiler = None
+        self._started = None
+        self._started_tracemalloc = False
+
+    def record_stage(self, name, seconds):
+        """Add the time spent in a stage (stages of animation frames add up)."""
+        self.stages[name] = round(self.stages.get(name, 0.0) + seconds, 6)
+
+    def to_dict(self):
+        """Get the reference returned with the request's result."""
+        if self.skipped:
+            return {'skipped': self.skipped}
+        return {'id': self.id}
+
+    def _start(self, tracemalloc_frames):
+        """Start tracing allocations and profiling the current thread."""
+        self._started_tracemalloc = not tracemalloc.is_tracing()
+        if self._started_tracemalloc:
+            tracemalloc.start(tracemalloc_frames)
+        tracemalloc.reset_peak()
+        self._profiler = cProfile.Profile()
+        self._started = time.perf_counter()
+        self._profiler.enable()
+
+    def _stop(self, profiles_dir):
+        """Stop profiling and write the profile (.prof for pstats/snakeviz, .json summary)."""
+        self._profiler.disable()
+        wall_seconds = time.perf_counter() - self._started
+        snapshot = tracemalloc.take_snapshot()
+        current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+
+        os.makedirs(profiles_dir, exist_ok=True)
+        self._profiler.dump_stats(os.path.join(profiles_dir, f"{self.id}.prof"))
+
+        stats = pstats.Stats(self._profiler, stream=io.StringIO())
+        functions = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:TOP_FUNCTIONS]
+        allocations = snapshot.filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__)
+        ]).statistics('lineno')[:TOP_ALLOCATIONS]
+
+        summary = {
+            'id': self.id,
+            'label': self.label,
+            'status': self.status,
+            'created': time.time(),
+            'pid': os.getpid(),
+            'wall_seconds': round(wall_seconds, 6),
+            'stages': self.stages,
+            'memory': {
+                'peak_mb': round(peak_bytes / 2**20, 2),
+                'retained_mb': round(current_bytes / 2**20, 2),
+                'top_allocations': [
+                    {
+                        'location': f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                        'size_kb': round(stat.size / 1024, 1),
+                        'count': stat.count
+                    }
+                    for stat in allocations
+                ]
+            },
+            'functions': [
+                {
+                    'function': f"{filename}:{lineno}({name})",
+                    'calls': calls,
+                    'total_seconds': round(total_time, 6),
+                    'cumulative_seconds': round(cumulative_time, 6)
+                }
+                for (filename, lineno, name), (_, calls, total_time, cumulative_time, _) in functions
+            ]
+        }
+        tmp_path = os.path.join(profiles_dir, f"{self.id}.json.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(summary, f)
+        os.replace(tmp_path, os.path.join(profiles_dir, f"{self.id}.json"))
+
+@contextmanager
+def profile(app_config, label):
+    """
+    Profile the request handled by the current thread.
+
+    At most one request per worker process is profiled at a time, and not
+    more often than PROFILING_MIN_INTERVAL; other requests run unprofiled
+    and the yielded profile says why. Only PROFILING_MAX_STORED profiles
+    are kept on disk.
+
+    Args:
+        app_config: The Flask app configuration.
+        label: A description of the request, e.g. its file and mode.
+
+    Yields:
+        A RequestProfile, written to PROFILES_DEST when the block exits.
+    """
+    global _last_started
+
+    if not _profile_lock.acquire(blocking=False):
+        yield RequestProfile(label, skipped='busy')
+        return
+
+    try:
+        now = time.monotonic()
+        if _last_started and now - _last_started < app_config['PROFILING_MIN_INTERVAL']:
+            yield RequestProfile(label, skipped='rate_limited')
+            return
+        _last_started = now
+
+        request_profile = RequestProfile(label)
+        request_profile._start(app_config['PROFILING_TRACEMALLOC_FRAMES'])
+        _local.profile = request_profile
+        try:
+            yield request_profile
+        except BaseException as e:
+            request_profile.status = type(e).__name__
+            raise
+        finally:
+            _local.profile = None
+            try:
+                request_profile._stop(app_config['PROFILES_DEST'])
+                prune_profiles(app_config['PROFILES_DEST'], app_config['PROFILING_MAX_STORED'])
+            except Exception as e:
+                logging.error(f"Error saving profile {request_profile.id}: {str(e)}")
+    finally:
+        _profile_lock.release()
+
+def is_active():
+    """Check whether the current thread's request is being profiled."""
+    return getattr(_local, 'profile', None) is not None
+
+@contextmanager
+def stage(name):
+    """Time a processing stage of the current thread's request, if it is profiled."""
+    request_profile = getattr(_local, 'profile', None)
+    if request_profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        request_profile.record_stage(name, time.perf_counter() - start)
+
+def list_profiles(profiles_dir):
+    """
+    List the stored profiles, newest first.
+
+    Returns:
+        A list of dicts with the id, label, status, creation time, wall time
+        and stage timings of each profile.
+    """
+    if not os.path.isdir(profiles_dir):
+        return []
+    profiles = []
+    for filename in os.listdir(profiles_dir):
+        if not filename.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(profiles_dir, filename)) as f:
+                summary = json.load(f)
+        except Exception as e:
+            logging.error(f"Error reading profile {filename}: {str(e)}")
+            continue
+        profiles.append({key: summary[key] for key in ('id', 'label', 'status', 'created', 'pid', 'wall_seconds', 'stages')})
+    profiles.sort(key=lambda summary: summary['created'], reverse=True)
+    return profiles
+
+def prune_profiles(profiles_dir, max_stored):
+    """Delete the oldest profiles beyond max_stored."""
+    for summary in list_profiles(profiles_dir)[max_stored:]:
+        for extension in ('.json', '.prof'):
+            try:
+                os.remove(os.path.join(profiles_dir, f"{summary['id']}{extension}"))
+            except FileNotFoundError:
+                pass
@@ -1,74 +1,130 @@
 import os
+import json
 import uuid
-from flask import render_template, request, jsonify, send_from_directory, url_for, redirect, flash, session
+import itertools
+import unicodedata
+from urllib.parse import quote
+from contextlib import nullcontext
+from flask import render_template, request, jsonify, send_from_directory, url_for, redirect, flash, session, Response, stream_with_context
 from werkzeug.utils import secure_filename
+from werkzeug.datastructures import Headers
 from app import db
 from models import ProcessedImage
-from image_processor import process_image
-from palette_manager import get_all_palettes, get_palette_by_id, get_palette_colors, add_palette
-from utils import allowed_file, parse_resolution
+from image_processor import process_image, process_source_image, load_source_image, decode_size, crop_box, load_palette, quantize_preview, get_animation_format, resize_to_fit, extract_palette
+from palette_manager import get_all_palettes, get_palette_by_id, get_palette_colors, add_palette, search_palettes
+from utils import allowed_file, parse_resolution, parse_crop, pil_image_to_base64
 import session_manager
+import job_control
+import admission
+import palette_index
+import memory_budget
+import exporter
+import palette_import
+import warmup
+import stage_cache
+import processing_pool
+import profiling
+import shared_arrays
 
 def register_routes(app):
     """Register all routes with the Flask app."""
     
     @app.route('/')
     def index():
-        """Render the main application page."""
+        """
+        Render the main application page.
+
+        Only the first page of the palette list is rendered, from the
+        precomputed palette summaries; the page loads the rest from /palettes.
+        """
         palettes = get_all_palettes()
+        page_size = app.config['PALETTES_PAGE_SIZE']
         
         # Get the configuration for the frontend
         quantization_modes = app.config['QUANTIZATION_MODES']
         resolution_presets = app.config['RESOLUTION_PRESETS']
         upscale_factors = app.config['UPSCALE_FACTORS']
         
-        # Get palette colors for each palette
-        palettes_with_colors = []
-        for palette in palettes:
-            palette_path = os.path.join(app.config['UPLOADED_PALETTES_DEST'], palette.filename)
-            try:
-                # Get up to 5 colors for the dropdown preview
-                colors = get_palette_colors(palette_path)[:5]
-                palette_data = palette.to_dict()
-                palette_data['colors'] = colors
-                palettes_with_colors.append(palette_data)
-            except Exception as e:
-                app.logger.error(f"Error loading palette colors for {palette.name}: {str(e)}")
-                # Still include the palette but without colors
-                palette_data = palette.to_dict()
-                palette_data['colors'] = []
-                palettes_with_colors.append(palette_data)
-        
         return render_template(
             'index.html',
-            palettes=palettes_with_colors,
+            palettes=[palette.to_summary() for palette in palettes[:page_size]],
+            palettes_total=len(palettes),
+            palettes_page_size=page_size,
             quantization_modes=quantization_modes,
             resolution_presets=resolution_presets,
-            upscale_factors=upscale_factors
+            downscale_methods=app.config['DOWNSCALE_METHODS'],
+            upscale_factors=upscale_factors,
+            auto_palette_sizes=app.config['AUTO_PALETTE_SIZES'],
+            default_auto_palette_size=app.config['DEFAULT_AUTO_PALETTE_SIZE']
         )
     
-    @app.route('/upload', methods=['POST'])
-    def upload_file():
-        """Handle image upload and processing."""
+    def parse_upload_request():
+        """
+        Validate an image upload request and save the uploaded file.
+
+        Returns:
+            A (upload, error_response) tuple. upload is a dict with the
+            request parameters when the request is valid, None otherwise.
+        """
         # Check if the post request has the file part
         if 'file' not in request.files:
-            return jsonify({'error': 'No file part'}), 400
+            return None, (jsonify({'error': 'No file part'}), 400)
             
         file = request.files['file']
         
         # Check if the user did not select a file
         if file.filename == '':
-            return jsonify({'error': 'No selected file'}), 400
+            return None, (jsonify({'error': 'No selected file'}), 400)
             
         # Check if the file is allowed
         if not allowed_file(file.filename, app.config['ALLOWED_EXTENSIONS']):
-            return jsonify({'error': 'File type not allowed'}), 400
+            return None, (jsonify({'error': 'File type not allowed'}), 400)
             
         # Get the parameters
         palette_id = request.form.get('palette', '1')
         quantization_mode = request.form.get('quantization_mode', app.config['DEFAULT_QUANTIZATION_MODE'])
+        if quantization_mode not in [mode['value'] for mode in app.config['QUANTIZATION_MODES']]:
+            return None, (jsonify({'error': 'Invalid quantization mode'}), 400)
         max_resolution = request.form.get('max_resolution', '512,512')
-        upscale_factor = int(request.form.get('upscale_factor', app.config['DEFAULT_UPSCALE_FACTOR']))
+        try:
+            resolution = [int(value) for value in max_resolution.split(',')]
+        except ValueError:
+            return None, (jsonify({'error': 'Invalid maximum resolution'}), 400)
+        if len(resolution) != 2 or min(resolution) < 1:
+            return None, (jsonify({'error': 'Invalid maximum resolution'}), 400)
+        try:
+            upscale_factor = int(request.form.get('upscale_factor', app.config['DEFAULT_UPSCALE_FACTOR']))
+        except ValueError:
+            return None, (jsonify({'error': 'Invalid upscale factor'}), 400)
+        if upscale_factor < 1:
+            return None, (jsonify({'error': 'Invalid upscale factor'}), 400)
+        
+        # Options of the auto palette mode
+        try:
+            palette_size = int(request.form.get('palette_size', app.config['DEFAULT_AUTO_PALETTE_SIZE']))
+        except ValueError:
+            return None, (jsonify({'error': 'Invalid palette size'}), 400)
+        if palette_size not in app.config['AUTO_PALETTE_SIZES']:
+            return None, (jsonify({'error': 'Invalid palette size'}), 400)
+        snap_to_palette = request.form.get('snap_to_palette') in ('1', 'true', 'on')
+        
+        downscale_method = request.form.get('downscale_method', app.config['DEFAULT_DOWNSCALE_METHOD'])
+        if downscale_method not in [method['value'] for method in app.config['DOWNSCALE_METHODS']]:
+            return None, (jsonify({'error': 'Invalid downscale method'}), 400)
+        
+        # Optional selection: crop to it, or pixelate only that region
+        try:
+            crop = parse_crop(request.form.get('crop', ''))
+        except ValueError as e:
+            return None, (jsonify({'error': f"Invalid crop: {str(e)}"}), 400)
+        crop_mode = request.form.get('crop_mode', 'crop')
+        if crop_mode not in ('crop', 'region'):
+            return None, (jsonify({'error': 'Invalid crop mode'}), 400)
+        
+        # The client-generated request id lets the job be cancelled while it runs
+        request_id = request.form.get('request_id') or str(uuid.uuid4())
+        if not job_control.is_valid_request_id(request_id):
+            return None, (jsonify({'error': 'Invalid request id'}), 400)
         
         # Debug log for the selected quantization mode
         app.logger.debug(f"Processing with quantization mode: {quantization_mode}")
@@ -76,85 +132,456 @@ def register_routes(app):
         # Get the palette
         palette = get_palette_by_id(palette_id)
         if not palette:
-            return jsonify({'error': 'Invalid palette selected'}), 400
+            return None, (jsonify({'error': 'Invalid palette selected'}), 400)
         
         # Generate session ID if not present
         if 'session_id' not in session:
             session['session_id'] = str(uuid.uuid4())
-            
-        session_id = session['session_id']
+        
+        # Reject the request before saving the file if the session or server is saturated
+        cost = admission.request_cost(app.config, quantization_mode, max_resolution)
+        try:
+            lease_id = admission.acquire(app.config, session['session_id'], cost, request.remote_addr)
+        except admission.AdmissionDenied as e:
+            return None, admission_denied_response(e)
             
         # Save the uploaded file to a temp location
         temp_filename = f"{str(uuid.uuid4())}.{file.filename.split('.')[-1]}"
         filepath = os.path.join(app.config['UPLOADED_PHOTOS_DEST'], temp_filename)
-        file.save(filepath)
+        try:
+            file.save(filepath)
+        except Exception:
+            admission.release(app.config, lease_id)
+            raise
+        
+        if crop and crop_mode == 'region' and get_animation_format(filepath):
+            remove_upload(filepath)
+            admission.release(app.config, lease_id)
+            return None, (jsonify({'error': 'Pixelating a region is not supported for animations'}), 400)
+        
+        return {
+            'original_filename': file.filename,
+            'filepath': filepath,
+            'palette': palette,
+            'palette_path': os.path.join(app.config['UPLOADED_PALETTES_DEST'], palette.filename),
+            'quantization_mode': quantization_mode,
+            'max_resolution': max_resolution,
+            'upscale_factor': upscale_factor,
+            'palette_size': palette_size,
+            'snap_to_palette': snap_to_palette,
+            'downscale_method': downscale_method,
+            'crop': crop if crop_mode == 'crop' else None,
+            'region': crop if crop_mode == 'region' else None,
+            'request_id': request_id,
+            'session_id': session['session_id'],
+            'lease_id': lease_id
+        }, None
+    
+    def admission_denied_response(error):
+        """Build the 429 response of a request rejected by admission control."""
+        app.logger.info(f"Request rejected by admission control: {error.reason}")
+        return (
+            jsonify({'error': f"{error.reason}. Please retry in {error.retry_after} seconds.", 'retry_after': error.retry_after}),
+            429,
+            {'Retry-After': str(error.retry_after)}
+        )
+    
+    def remove_upload(filepath):
+        """Remove a temporary uploaded file."""
+        try:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+        except Exception as e:
+            app.logger.error(f"Error removing temporary upload: {str(e)}")
+    
+    def start_processing_job(upload):
+        """Register the job of an upload, with the deadline of its quantization mode."""
+        deadline = app.config['PROCESSING_DEADLINES'].get(
+            upload['quantization_mode'], app.config['DEFAULT_PROCESSING_DEADLINE']
+        )
+        return job_control.start_job(upload['request_id'], deadline, app.config['CANCEL_FLAGS_DEST'], session.get('session_id'))
+    
+    def load_upload_source(upload):
+        """
+        Decode an upload once, cropped and at the reduced scale its downscale needs.
+
+        The decoded image is memoized by file content, so repeated jobs on the
+        same image (e.g. at other upscale factors) skip decoding; its stage key
+        is stored in upload['source_key'] for the later stages.
+        """
+        min_size = decode_size(upload['max_resolution'], upload['downscale_method'])
+        upload['source_key'] = (stage_cache.file_digest(upload['filepath']), upload['crop'], min_size)
+        with profiling.stage('decoded'):
+            return stage_cache.get_or_compute(
+                'decoded',
+                upload['source_key'],
+                lambda: load_source_image(upload['filepath'], upload['crop'], min_size)
+            )
+    
+    def register_auto_palette(upload, source):
+        """
+        Extract the palette of an image for the auto mode and register it as a session palette.
+
+        The upload then uses the extracted palette like any other palette,
+        and the user can reuse it with the other modes.
+        """
+        snap_palette_path = upload['palette_path'] if upload['snap_to_palette'] else None
+        image = resize_to_fit(source, upload['max_resolution'], method=upload['downscale_method'])
+        if upload['region']:
+            # Only the pixelated region uses the palette
+            image = image.crop(crop_box(image.size, upload['region']))
+        colors = extract_palette(image, upload['palette_size'], snap_palette_path)
+        hex_colors = [f"{r:02x}{g:02x}{b:02x}" for r, g, b in colors.tolist()]
+        
+        source_name = os.path.splitext(upload['original_filename'])[0]
+        description = f"Extracted from {upload['original_filename']}"
+        if snap_palette_path:
+            description += f", snapped to {upload['palette'].name}"
+        
+        palette = add_palette(
+            name=f"Auto {len(hex_colors)} - {source_name}",
+            description=description,
+            is_temp=True,
+            palettes_dir=app.config['UPLOADED_PALETTES_DEST'],
+            colors=hex_colors
+        )
+        if not palette:
+            raise RuntimeError("Failed to register the extracted palette")
+        
+        palette_path = os.path.join(app.config['UPLOADED_PALETTES_DEST'], palette.filename)
+        session_manager.add_temp_palette(upload['session_id'], palette_path)
+        
+        upload['palette'] = palette
+        upload['palette_path'] = palette_path
+        upload['auto_palette'] = {'id': palette.id, 'name': palette.name, 'colors': hex_colors}
+    
+    def process_upload(upload, source, cancel_token):
+        """
+        Process an upload, reusing its decoded source unless it is an animation.
+
+        When the process pool is enabled (see asgi.py), the CPU-bound work runs
+        there and this thread only waits for it, except for profiled requests.
+        The decoded source then reaches the pool as a shared array, kept for
+        the session's later requests on the same upload.
+        """
+        in_pool = processing_pool.is_enabled() and not profiling.is_active()
+        options = {
+            'max_resolution': upload['max_resolution'],
+            'quantization_mode': upload['quantization_mode'],
+            'upscale_factor': upload['upscale_factor'],
+            'downscale_method': upload['downscale_method']
+        }
+        
+        if get_animation_format(upload['filepath']):
+            # Animations are processed frame by frame from the file
+            args = (upload['filepath'], upload['palette_path'], app.config['PROCESSED_IMAGES_DEST'])
+            options['crop'] = upload['crop']
+            if in_pool:
+                return processing_pool.process_image_in_pool(
+                    *args, cancel_token=cancel_token, flag_dir=app.config['CANCEL_FLAGS_DEST'], **options
+                )
+            return process_image(*args, cancel_token=cancel_token, **options)
+        
+        args = (source, upload['palette_path'], app.config['PROCESSED_IMAGES_DEST'])
+        options['region'] = upload['region']
+        options['source_key'] = upload['source_key']
+        if in_pool:
+            with shared_arrays.share(
+                app.config['SHARED_ARRAYS_DEST'],
+                upload['session_id'],
+                upload['source_key'],
+                lambda: source,
+                app.config['SHARED_ARRAYS_MAX_BYTES'],
+                app.config['SHARED_ARRAYS_MAX_IDLE']
+            ) as shared_source:
+                return processing_pool.process_source_image_in_pool(
+                    shared_source, *args[1:], cancel_token=cancel_token, flag_dir=app.config['CANCEL_FLAGS_DEST'], **options
+                )
+        return process_source_image(*args, cancel_token=cancel_token, **options)
+    
+    def aborted_job_response(error):
+        """Build the (data, status) response of a cancelled or timed-out job."""
+        app.logger.info(str(error))
+        if isinstance(error, job_control.ProcessingTimeout):
+            return {'error': 'Processing took too long. Try a lower resolution or a faster mode.', 'timeout': True}, 504
+        return {'error': 'Processing was cancelled', 'cancelled': True}, 409
+    
+    def save_processed_result(upload, processed_filename):
+        """
+        Record a processed image in the session and database, and remove the upload.
+
+        Returns:
+            The result data returned to the client.
+        """
+        quantization_mode = upload['quantization_mode']
+        
+        # Track the processed file in the session
+        processed_filepath = os.path.join(app.config['PROCESSED_IMAGES_DEST'], processed_filename)
+        session_manager.add_processed_image(upload['session_id'], processed_filepath)
+        
+        # Save a temporary record for the download
+        processed_image = ProcessedImage(
+            original_filename=upload['original_filename'],  # Use original filename for display
+            processed_filename=processed_filename,
+            palette_id=int(upload['palette'].id),
+            quantization_mode=quantization_mode,
+            max_resolution=upload['max_resolution'],
+            upscale_factor=upload['upscale_factor']
+        )
+        db.session.add(processed_image)
+        db.session.commit()
+        
+        # Debug log for database update
+        app.logger.debug(f"Saved processed image record with mode: {quantization_mode}")
+        
+        # Remove the temporary uploaded file
+        remove_upload(upload['filepath'])
+        
+        # Return the processed image details
+        result = {
+            'success': True,
+            'processed_image_id': processed_image.id,
+            'processed_image_url': url_for('download_file', filename=processed_filename),
+            'export_url': url_for('export_file', filename=processed_filename),
+            'palette_name': upload['palette'].name,
+            'quantization_mode': quantization_mode
+        }
+        if 'auto_palette' in upload:
+            result['auto_palette'] = upload['auto_palette']
+        return result
+    
+    @app.route('/upload', methods=['POST'])
+    def upload_file():
+        """
+        Handle image upload and processing.
+
+        Requests carrying the admin token (profiling.TOKEN_HEADER) are run
+        under the profiler; the result then references the stored profile.
+        """
+        profile_token = profiling.request_token(request)
+        if profile_token and not profiling.is_authorized(profile_token, app.config['PROFILING_ADMIN_TOKEN']):
+            return jsonify({'error': 'Invalid profiling token'}), 403
+        
+        upload, error_response = parse_upload_request()
+        if error_response:
+            return error_response
+        
+        quantization_mode = upload['quantization_mode']
+        profile_label = f"{upload['original_filename']} {quantization_mode} {upload['request_id']}"
+        
+        # Abort processing if it is cancelled or runs past the deadline of the mode
+        cancel_token = start_processing_job(upload)
         
         try:
-            # Process the image
-            palette_path = os.path.join(app.config['UPLOADED_PALETTES_DEST'], palette.filename)
-            
             # Debug log for processing start
             app.logger.debug(f"Starting image processing with mode: {quantization_mode}")
             
-            processed_filename = process_image(
-                filepath,
-                palette_path,
-                app.config['PROCESSED_IMAGES_DEST'],
-                max_resolution,
-                quantization_mode,
-                upscale_factor
-            )
-            
-            # Debug log for processing completion
-            app.logger.debug(f"Completed image processing with mode: {quantization_mode}")
-            
-            # Track the processed file in the session
-            processed_filepath = os.path.join(app.config['PROCESSED_IMAGES_DEST'], processed_filename)
-            session_manager.add_processed_image(session_id, processed_filepath)
-            
-            # Save a temporary record for the download
-            processed_image = ProcessedImage(
-                original_filename=file.filename,  # Use original filename for display
-                processed_filename=processed_filename,
-                palette_id=int(palette.id),
-                quantization_mode=quantization_mode,
-                max_resolution=max_resolution,
-                upscale_factor=upscale_factor
-            )
-            db.session.add(processed_image)
-            db.session.commit()
-            
-            # Debug log for database update
-            app.logger.debug(f"Saved processed image record with mode: {quantization_mode}")
-            
-            # Remove the temporary uploaded file
-            try:
-                if os.path.exists(filepath):
-                    os.remove(filepath)
-            except Exception as e:
-                app.logger.error(f"Error removing temporary upload: {str(e)}")
-            
-            # Return the processed image details
-            result = {
-                'success': True,
-                'processed_image_id': processed_image.id,
-                'processed_image_url': url_for('download_file', filename=processed_filename),
-                'palette_name': palette.name,
-                'quantization_mode': quantization_mode
-            }
+            # Account for the large arrays of the request against its memory budget,
+            # and record which pipeline stages were reused from earlier jobs
+            with memory_budget.track(app.config['REQUEST_MEMORY_BUDGET']) as budget, stage_cache.track() as stages, \
+                    (profiling.profile(app.config, profile_label) if profile_token else nullcontext()) as profile:
+                # Decode once; the auto mode extracts its palette from the same source
+                source = load_upload_source(upload)
+                if quantization_mode == 'auto':
+                    with profiling.stage('auto_palette'):
+                        register_auto_palette(upload, source)
+                
+                # Process the image
+                with profiling.stage('process'):
+                    processed_filename = process_upload(upload, source, cancel_token)
+                
+                # Debug log for processing completion
+                app.logger.debug(f"Completed image processing with mode: {quantization_mode}")
+                
+                with profiling.stage('save'):
+                    result = save_processed_result(upload, processed_filename)
+            result['memory'] = budget.report()
+            result['stages'] = stages
+            if profile is not None:
+                result['profile'] = profile.to_dict()
+                if profile.id:
+                    result['profile']['url'] = url_for('get_profile', profile_id=profile.id)
             
             app.logger.debug(f"Returning result for mode: {quantization_mode}, data: {result}")
             return jsonify(result)
+        except job_control.ProcessingCancelled as e:
+            # Cleanup the uploaded file when the job was aborted
+            remove_upload(upload['filepath'])
+            data, status = aborted_job_response(e)
+            return jsonify(data), status
+        except memory_budget.MemoryBudgetExceeded as e:
+            remove_upload(upload['filepath'])
+            app.logger.info(str(e))
+            return jsonify({'error': str(e)}), 413
         except Exception as e:
             # Cleanup the uploaded file on error
-            try:
-                if os.path.exists(filepath):
-                    os.remove(filepath)
-            except:
-                pass
+            remove_upload(upload['filepath'])
                 
             app.logger.error(f"Error processing image with mode {quantization_mode}: {str(e)}")
             return jsonify({'error': str(e)}), 500
+        finally:
+            job_control.finish_job(upload['request_id'], app.config['CANCEL_FLAGS_DEST'])
+            admission.release(app.config, upload['lease_id'])
+    
+    @app.route('/upload/stream', methods=['POST'])
+    def upload_file_stream():
+        """
+        Handle image upload and processing as a stream of Server-Sent Events.
+
+        A 'preview' event with a small quantized preview is sent first, then a
+        'result' event with the same data as /upload (or an 'error' event).
+        """
+        upload, error_response = parse_upload_request()
+        if error_response:
+            return error_response
+        
+        def sse_event(event, data):
+            return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        
+        def generate():
+            quantization_mode = upload['quantization_mode']
+            cancel_token = start_processing_job(upload)
+            
+            try:
+                with memory_budget.track(app.config['REQUEST_MEMORY_BUDGET']) as budget, stage_cache.track() as stages:
+                    # Decode once; both the preview and the full result use this source
+                    source = load_upload_source(upload)
+                    if quantization_mode == 'auto':
+                        register_auto_palette(upload, source)
+                    
+                    preview = quantize_preview(source, upload['palette_path'])
+                    yield sse_event('preview', {
+                        'image': f"data:image/png;base64,{pil_image_to_base64(preview)}",
+                        'width': preview.width,
+                        'height': preview.height
+                    })
+                    
+                    processed_filename = process_upload(upload, source, cancel_token)
+                    result = save_processed_result(upload, processed_filename)
+                
+                result['memory'] = budget.report()
+                result['stages'] = stages
+                yield sse_event('result', result)
+            except job_control.ProcessingCancelled as e:
+                remove_upload(upload['filepath'])
+                data, status = aborted_job_response(e)
+                yield sse_event('error', dict(data, status=status))
+            except memory_budget.MemoryBudgetExceeded as e:
+                remove_upload(upload['filepath'])
+                app.logger.info(str(e))
+                yield sse_event('error', {'error': str(e), 'status': 413})
+            except Exception as e:
+                remove_upload(upload['filepath'])
+                app.logger.error(f"Error processing image with mode {quantization_mode}: {str(e)}")
+                yield sse_event('error', {'error': str(e), 'status': 500})
+            finally:
+                job_control.finish_job(upload['request_id'], app.config['CANCEL_FLAGS_DEST'])
+        
+        response = Response(
+            stream_with_context(generate()),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+        # Release the slot when the stream is closed, even if the client left before it started
+        response.call_on_close(lambda: admission.release(app.config, upload['lease_id']))
+        return response
+    
+    @app.route('/cancel/<request_id>', methods=['POST'])
+    def cancel_processing(request_id):
+        """Cancel an in-flight processing job by its request id."""
+        if not job_control.is_valid_request_id(request_id):
+            return jsonify({'error': 'Invalid request id'}), 400
+        
+        # Only jobs the caller's session started can be cancelled
+        if not job_control.cancel_job(request_id, session.get('session_id'), app.config['CANCEL_FLAGS_DEST']):
+            return jsonify({'error': 'No such job'}), 404
+        app.logger.debug(f"Cancel requested for {request_id}")
+        return jsonify({'success': True, 'request_id': request_id})
+    
+    @app.route('/admission/stats')
+    def admission_stats():
+        """Get the admission control counters and the current load of all workers."""
+        return jsonify(admission.get_stats(app.config))
+    
+    def format_download_name(processed_image, palette, extension):
+        """Format the download filename of a processed image."""
+        # Get original filename without extension
+        original_name = os.path.splitext(processed_image.original_filename)[0]
+        # A temporary palette is gone once its session is cleaned up
+        palette_name = palette.name.lower().replace(' ', '-') if palette else f"palette-{processed_image.palette_id}"
+        return f"{original_name}_{palette_name}_{processed_image.quantization_mode}{extension}"
+    
+    def attachment_headers(download_name):
+        """
+        Get the Content-Disposition header of a download, encoded the way
+        send_file encodes download_name: quoted, with an RFC 5987 filename*
+        and an ASCII fallback for non-ASCII names.
+        """
+        # Control characters cannot appear in a header value
+        download_name = ''.join(c for c in download_name if c.isprintable())
+        try:
+            download_name.encode('ascii')
+        except UnicodeEncodeError:
+            simple = unicodedata.normalize('NFKD', download_name).encode('ascii', 'ignore').decode('ascii')
+            names = {'filename': simple, 'filename*': f"UTF-8''{quote(download_name, safe='!#$&+-.^_`|~')}"}
+        else:
+            names = {'filename': download_name}
+        headers = Headers()
+        headers.set('Content-Disposition', 'attachment', **names)
+        return headers
+    
+    def profiling_denied_response():
+        """Get the error response of an admin request without a valid profiling token, or None."""
+        if not profiling.is_authorized(profiling.request_token(request), app.config['PROFILING_ADMIN_TOKEN']):
+            return jsonify({'error': 'Invalid profiling token'}), 403
+        return None
+    
+    @app.route('/admin/profiles')
+    def list_profiles():
+        """List the stored request profiles, newest first (admin only)."""
+        denied = profiling_denied_response()
+        if denied:
+            return denied
+        return jsonify(profiling.list_profiles(app.config['PROFILES_DEST']))
+    
+    @app.route('/admin/profiles/<profile_id>')
+    def get_profile(profile_id):
+        """
+        Get a stored request profile (admin only).
+
+        Returns the JSON summary (stage timings, top functions, allocation
+        statistics), or with ?format=prof the cProfile data for pstats,
+        snakeviz and similar viewers.
+        """
+        denied = profiling_denied_response()
+        if denied:
+            return denied
+        if not profiling.is_valid_profile_id(profile_id):
+            return jsonify({'error': 'Invalid profile id'}), 400
+        
+        extension = '.prof' if request.args.get('format') == 'prof' else '.json'
+        if not os.path.exists(os.path.join(app.config['PROFILES_DEST'], f"{profile_id}{extension}")):
+            return jsonify({'error': 'Profile not found'}), 404
+        return send_from_directory(
+            app.config['PROFILES_DEST'],
+            f"{profile_id}{extension}",
+            as_attachment=extension == '.prof',
+            mimetype='application/octet-stream' if extension == '.prof' else 'application/json'
+        )
+    
+    @app.route('/cache/stats')
+    def cache_stats():
+        """Get the hit rate of every pipeline stage in this worker's stage cache."""
+        return jsonify(stage_cache.get_stats())
+    
+    @app.route('/ready')
+    def readiness():
+        """Report whether this worker has finished warming up (503 until it has)."""
+        if not warmup.is_ready():
+            response = jsonify({'ready': False, 'pid': os.getpid()})
+            response.headers['Retry-After'] = '1'
+            return response, 503
+        return jsonify({'ready': True, 'pid': os.getpid(), 'warmup_ms': warmup.get_report()})
     
     @app.route('/download/<filename>')
     def download_file(filename):
@@ -164,13 +591,11 @@ def register_routes(app):
         if not processed_image:
             return jsonify({'error': 'File not found'}), 404
             
-        # Get original filename without extension
-        original_name = os.path.splitext(processed_image.original_filename)[0]
         # Get palette name from actual palette file
         palette = get_palette_by_id(processed_image.palette_id)
-        palette_name = palette.name.lower().replace(' ', '-')
-        # Format the download filename
-        download_filename = f"{original_name}_{palette_name}_{processed_image.quantization_mode}.png"
+        # Format the download filename, keeping the extension of the processed file
+        extension = os.path.splitext(filename)[1] or '.png'
+        download_filename = format_download_name(processed_image, palette, extension)
         
         return send_from_directory(
             app.config['PROCESSED_IMAGES_DEST'], 
@@ -179,6 +604,70 @@ def register_routes(app):
             download_name=download_filename
         )
     
+    @app.route('/export/<filename>')
+    def export_file(filename):
+        """
+        Export a processed image as palette indices.
+        
+        Query parameters:
+            format: png (indexed, 1/2/4/8-bit, sprite sheet for animations),
+                    gif, npy (raw index array) or json (Aseprite sprite sheet data).
+            native: 1 to undo the upscale factor and export one pixel per art pixel.
+            stream: 1 to stream the encoded file instead of buffering it.
+        """
+        export_format = request.args.get('format', 'png').lower()
+        if export_format not in exporter.EXPORT_FORMATS:
+            return jsonify({'error': f"Unknown export format. Choose one of: {', '.join(exporter.EXPORT_FORMATS)}"}), 400
+        native = request.args.get('native') == '1'
+        stream = request.args.get('stream') == '1'
+        
+        processed_image = ProcessedImage.query.filter_by(processed_filename=filename).first()
+        if not processed_image:
+            return jsonify({'error': 'File not found'}), 404
+        image_path = os.path.join(app.config['PROCESSED_IMAGES_DEST'], processed_image.processed_filename)
+        if not os.path.exists(image_path):
+            return jsonify({'error': 'File not found'}), 404
+        
+        palette = get_palette_by_id(processed_image.palette_id)
+        if not palette:
+            return jsonify({'error': 'The palette of this image is no longer available'}), 404
+        palette_path = os.path.join(app.config['UPLOADED_PALETTES_DEST'], palette.filename)
+        
+        try:
+            palette_rgb = load_palette(palette_path).rgb
+            if len(palette_rgb) > 256 and export_format in ('png', 'gif'):
+                return jsonify({'error': 'Indexed PNG and GIF exports support at most 256 palette colors'}), 400
+            
+            scale = (processed_image.upscale_factor or 1) if native else 1
+            frames = exporter.load_index_frames(image_path, palette_rgb, scale)
+        except Exception as e:
+            app.logger.error(f"Error exporting {filename}: {str(e)}")
+            return jsonify({'error': f"Error exporting image: {str(e)}"}), 500
+        
+        # The JSON sidecar describes the PNG sprite sheet exported with the same options
+        image_name = format_download_name(processed_image, palette, '.png')
+        download_filename = format_download_name(processed_image, palette, f".{export_format}")
+        headers = attachment_headers(download_filename)
+        mimetype = exporter.EXPORT_FORMATS[export_format]
+        
+        if stream:
+            chunks = exporter.stream_encode(frames, palette_rgb, export_format, image_name)
+            # Encode the first chunk before answering, so an encoder error is
+            # still a 500 rather than a truncated file after a 200
+            try:
+                first_chunk = next(chunks, b'')
+            except Exception as e:
+                app.logger.error(f"Error exporting {filename}: {str(e)}")
+                return jsonify({'error': f"Error exporting image: {str(e)}"}), 500
+            return Response(stream_with_context(itertools.chain([first_chunk], chunks)), mimetype=mimetype, headers=headers)
+        
+        try:
+            data = exporter.encode_to_bytes(frames, palette_rgb, export_format, image_name)
+        except Exception as e:
+            app.logger.error(f"Error exporting {filename}: {str(e)}")
+            return jsonify({'error': f"Error exporting image: {str(e)}"}), 500
+        return Response(data, mimetype=mimetype, headers=headers)
+    
     @app.route('/palette/<palette_id>')
     def get_palette(palette_id):
         """Get information about a specific palette."""
@@ -197,7 +686,7 @@ def register_routes(app):
         try:
             colors = get_palette_colors(palette_path)
             
-            return jsonify({
+            return conditional_json({
                 'id': palette.id,
                 'name': palette.name,
                 'colors': colors,
@@ -207,15 +696,172 @@ def register_routes(app):
             app.logger.error(f"Error retrieving palette colors: {str(e)}")
             return jsonify({'error': 'Error loading palette data'}), 500
     
+    def conditional_json(data):
+        """Build a JSON response with an ETag, answering 304 if the client has it."""
+        response = jsonify(data)
+        response.add_etag()
+        return response.make_conditional(request)
+    
+    def parse_count_arg(name, default=None, minimum=0, maximum=None):
+        """Parse an optional integer query argument, raising ValueError if invalid."""
+        value = request.args.get(name, '')
+        if value == '':
+            return default
+        value = int(value)
+        if value < minimum or (maximum is not None and value > maximum):
+            raise ValueError(f"{name} must be between {minimum} and {maximum}" if maximum is not None else f"{name} must be at least {minimum}")
+        return value
+    
     @app.route('/palettes')
     def get_palettes():
-        """Get all available palettes."""
-        palettes = get_all_palettes()
-        return jsonify([palette.to_dict() for palette in palettes])
+        """
+        List the available palettes, a page at a time.
+
+        Query arguments (all optional):
+            q: Text the palette name must contain, ignoring case.
+            min_colors, max_colors: Bounds on the number of colors.
+            page: The 1-based page number.
+            per_page: Palettes per page, up to PALETTES_MAX_PAGE_SIZE.
+
+        Entries are the compact palette summaries (id, name, size, a swatch
+        of the first colors); /palettes/colors returns the full colors.
+        """
+        try:
+            min_colors = parse_count_arg('min_colors')
+            max_colors = parse_count_arg('max_colors')
+            page = parse_count_arg('page', default=1, minimum=1)
+            per_page = parse_count_arg(
+                'per_page',
+                default=app.config['PALETTES_PAGE_SIZE'],
+                minimum=1,
+                maximum=app.config['PALETTES_MAX_PAGE_SIZE']
+            )
+        except ValueError as e:
+            return jsonify({'error': f'Invalid query: {str(e)}'}), 400
+        
+        query = request.args.get('q', '')
+        palettes = search_palettes(get_all_palettes(), query, min_colors, max_colors)
+        start = (page - 1) * per_page
+        
+        next_url = None
+        if start + per_page < len(palettes):
+            next_args = {key: value for key, value in request.args.items() if key != 'page'}
+            next_url = url_for('get_palettes', page=page + 1, **next_args)
+        
+        return conditional_json({
+            'palettes': [palette.to_summary() for palette in palettes[start:start + per_page]],
+            'total': len(palettes),
+            'page': page,
+            'per_page': per_page,
+            'next': next_url
+        })
+    
+    @app.route('/palettes/colors')
+    def get_palettes_colors():
+        """
+        Get the full colors of several palettes in one request.
+
+        Query arguments:
+            ids: Comma-separated palette ids, at most PALETTES_BATCH_MAX.
+
+        Returns the palettes in the requested order, and the ids that were
+        not found (or belong to another session) under 'missing'.
+        """
+        palette_ids = [palette_id for palette_id in request.args.get('ids', '').split(',') if palette_id]
+        if not palette_ids:
+            return jsonify({'error': 'No palette ids given'}), 400
+        if len(palette_ids) > app.config['PALETTES_BATCH_MAX']:
+            return jsonify({'error': f"At most {app.config['PALETTES_BATCH_MAX']} palettes per request"}), 400
+        
+        palettes = []
+        missing = []
+        for palette_id in dict.fromkeys(palette_ids):
+            palette = get_palette_by_id(palette_id)
+            if not palette:
+                missing.append(palette_id)
+                continue
+            palette_path = os.path.join(app.config['UPLOADED_PALETTES_DEST'], palette.filename)
+            try:
+                colors = get_palette_colors(palette_path)
+            except Exception as e:
+                app.logger.error(f"Error retrieving colors of palette {palette.name}: {str(e)}")
+                missing.append(palette_id)
+                continue
+            palettes.append({
+                'id': palette.id,
+                'name': palette.name,
+                'colors': colors,
+                'description': palette.description
+            })
+        
+        return conditional_json({'palettes': palettes, 'missing': missing})
+        
+    @app.route('/palettes/suggest', methods=['GET', 'POST'])
+    def suggest_palettes():
+        """
+        Suggest palettes similar to an uploaded image or to an existing palette.
+
+        POST an image as 'file' to rank palettes against its dominant colors,
+        or pass 'palette_id' to find palettes like that one.
+        """
+        try:
+            limit = max(1, min(int(request.values.get('limit', 10)), 50))
+        except ValueError:
+            return jsonify({'error': 'Invalid limit'}), 400
+        
+        # Only suggest palettes visible to this session
+        visible_palettes = {str(palette.id): palette for palette in get_all_palettes()}
+        
+        if 'session_id' not in session:
+            session['session_id'] = str(uuid.uuid4())
+        cost = app.config['ADMISSION_MODE_COSTS']['palette_suggest']
+        
+        if 'file' in request.files:
+            file = request.files['file']
+            if not allowed_file(file.filename, app.config['ALLOWED_EXTENSIONS']):
+                return jsonify({'error': 'File type not allowed'}), 400
+            
+            try:
+                with admission.admitted(app.config, session['session_id'], cost, request.remote_addr), \
+                        memory_budget.track(app.config['REQUEST_MEMORY_BUDGET']):
+                    matches = palette_index.suggest_for_image(
+                        load_source_image(file.stream), limit, set(visible_palettes)
+                    )
+            except admission.AdmissionDenied as e:
+                return admission_denied_response(e)
+            except memory_budget.MemoryBudgetExceeded as e:
+                return jsonify({'error': str(e)}), 413
+            except Exception as e:
+                app.logger.error(f"Error suggesting palettes: {str(e)}")
+                return jsonify({'error': 'Could not read the image'}), 400
+        elif request.values.get('palette_id'):
+            palette_id = request.values.get('palette_id')
+            if palette_id not in visible_palettes:
+                return jsonify({'error': 'Palette not found'}), 404
+            try:
+                with admission.admitted(app.config, session['session_id'], cost, request.remote_addr):
+                    matches = palette_index.suggest_for_palette(palette_id, limit, set(visible_palettes))
+            except admission.AdmissionDenied as e:
+                return admission_denied_response(e)
+            if matches is None:
+                return jsonify({'error': 'Palette is not indexed'}), 404
+        else:
+            return jsonify({'error': 'Provide an image file or a palette_id'}), 400
+        
+        return jsonify([
+            dict(visible_palettes[palette_id].to_dict(), score=round(score, 2))
+            for palette_id, score in matches
+        ])
         
     @app.route('/palette/import', methods=['POST'])
     def import_palette():
-        """Import a custom palette."""
+        """
+        Import a custom palette, or a zip archive of palettes.
+
+        Palettes are parsed, validated and deduplicated here (see
+        palette_import.py), saved as .hex files and compiled for the
+        quantizers right away.
+        """
         # Check if the post request has the file part
         if 'palette_file' not in request.files:
             return jsonify({'error': 'No file part'}), 400
@@ -226,42 +872,90 @@ def register_routes(app):
         if file.filename == '':
             return jsonify({'error': 'No selected file'}), 400
             
-        # Check if file has a valid extension (.hex or .txt)
-        if not file.filename.endswith(('.hex', '.txt')):
-            return jsonify({'error': 'Invalid file format. Please upload a .hex or .txt file.'}), 400
+        # Check if file has a supported extension
+        if not file.filename.lower().endswith(palette_import.PALETTE_FORMATS + palette_import.ARCHIVE_FORMATS):
+            formats = ', '.join(palette_import.PALETTE_FORMATS + palette_import.ARCHIVE_FORMATS)
+            return jsonify({'error': f'Invalid file format. Please upload a palette file ({formats}).'}), 400
             
         # Generate session ID if not present
         if 'session_id' not in session:
             session['session_id'] = str(uuid.uuid4())
             
         session_id = session['session_id']
-            
-        # Get palette name from form or use filename without extension
-        name = request.form.get('name', file.filename.rsplit('.', 1)[0])
-        description = request.form.get('description', f"Custom palette: {name}")
+        data = file.read()
+        max_colors = app.config['PALETTE_IMPORT_MAX_COLORS']
+        is_archive = file.filename.lower().endswith(palette_import.ARCHIVE_FORMATS)
         
-        # Add the palette to the in-memory storage (marked as temporary)
-        palette = add_palette(
-            name=name,
-            palette_file=file,
-            description=description,
-            is_temp=True,  # This marks it as a user-uploaded temp palette
-            palettes_dir=app.config['UPLOADED_PALETTES_DEST']
-        )
+        # Parse everything before registering anything, so an invalid file
+        # leaves no palette behind
+        try:
+            if is_archive:
+                entries = list(palette_import.iter_archive(
+                    data,
+                    max_entries=app.config['PALETTE_IMPORT_MAX_ARCHIVE_ENTRIES'],
+                    max_bytes=app.config['PALETTE_IMPORT_MAX_ARCHIVE_BYTES'],
+                    max_colors=max_colors
+                ))
+            else:
+                parsed = palette_import.parse_palette(file.filename, data, max_colors)
+                # Get palette name from form or use the name declared by the file
+                name = request.form.get('name') or parsed.name
+                entries = [(file.filename, parsed._replace(name=name))]
+        except palette_import.InvalidPaletteError as e:
+            return jsonify({'error': f'Invalid palette: {str(e)}'}), 400
         
-        if not palette:
-            return jsonify({'error': 'Failed to import palette'}), 500
-            
-        # Track the palette in the user's session
-        palette_path = os.path.join(app.config['UPLOADED_PALETTES_DEST'], palette.filename)
-        session_manager.add_temp_palette(session_id, palette_path)
+        parsed_palettes = [(filename, entry) for filename, entry in entries if isinstance(entry, palette_import.ParsedPalette)]
+        errors = [{'file': filename, 'error': str(entry)} for filename, entry in entries if not isinstance(entry, palette_import.ParsedPalette)]
+        if not parsed_palettes:
+            return jsonify({'error': 'No valid palette in the archive', 'errors': errors}), 400
+        
+        # Palette imports share the session's admission budget with uploads;
+        # archives cost one unit per PALETTE_IMPORT_ARCHIVE_BATCH palettes
+        cost = app.config['ADMISSION_MODE_COSTS']['palette_import']
+        cost *= -(-len(parsed_palettes) // app.config['PALETTE_IMPORT_ARCHIVE_BATCH'])
+        imported = []
+        try:
+            with admission.admitted(app.config, session_id, cost, request.remote_addr):
+                for filename, parsed in parsed_palettes:
+                    if is_archive:
+                        description = f"Imported from {file.filename}"
+                    else:
+                        description = request.form.get('description', f"Custom palette: {parsed.name}")
+                    
+                    # Add the palette to the in-memory storage (marked as temporary)
+                    palette = add_palette(
+                        name=parsed.name,
+                        description=description,
+                        is_temp=True,  # This marks it as a user-uploaded temp palette
+                        palettes_dir=app.config['UPLOADED_PALETTES_DEST'],
+                        colors=palette_import.to_hex_colors(parsed.rgb)
+                    )
+                    if not palette:
+                        errors.append({'file': filename, 'error': 'Failed to import palette'})
+                        continue
+                    
+                    # Track the palette in the user's session
+                    palette_path = os.path.join(app.config['UPLOADED_PALETTES_DEST'], palette.filename)
+                    session_manager.add_temp_palette(session_id, palette_path)
+                    imported.append({
+                        'id': palette.id,
+                        'name': palette.name,
+                        'description': palette.description,
+                        'colors': len(parsed.rgb),
+                        'swatch': palette.swatch,
+                        'duplicates_removed': parsed.duplicates
+                    })
+        except admission.AdmissionDenied as e:
+            return admission_denied_response(e)
+        
+        if not imported:
+            return jsonify({'error': 'Failed to import palette', 'errors': errors}), 500
+        
+        if is_archive:
+            return jsonify({'imported': imported, 'errors': errors})
             
         # Return the imported palette details
-        return jsonify({
-            'id': palette.id,
-            'name': palette.name,
-            'description': palette.description
-        })
+        return jsonify(imported[0])
     
     @app.errorhandler(404)
     def page_not_found(e):
@@ -1,29 +1,36 @@
 import os
 import shutil
+import threading
 from flask import session
 import logging
 
 # Keep track of temporary files for each session
 session_files = {}
+# Guards session_files against the worker's request threads
+_session_files_lock = threading.RLock()
 
 def init_session(session_id):
     """Initialize a new session for temporary file tracking."""
-    if session_id not in session_files:
-        session_files[session_id] = {
-            'processed_images': [],
-            'temp_palettes': []
-        }
-        logging.debug(f"Initialized new session: {session_id}")
+    with _session_files_lock:
+        if session_id not in session_files:
+            session_files[session_id] = {
+                'processed_images': [],
+                'temp_palettes': []
+            }
+            logging.debug(f"Initialized new session: {session_id}")
 
 def add_processed_image(session_id, filepath):
     """Add a processed image file to the session tracking."""
-    init_session(session_id)
-    session_files[session_id]['processed_images'].append(filepath)
-    logging.debug(f"Added processed image to session {session_id}: {filepath}")
+    with _session_files_lock:
+        init_session(session_id)
+        processed_images = session_files[session_id]['processed_images']
+        processed_images.append(filepath)
+        logging.debug(f"Added processed image to session {session_id}: {filepath}")
+        
+        # Remove previous processed images if there are more than one
+        old_image = processed_images.pop(0) if len(processed_images) > 1 else None
     
-    # Remove previous processed images if there are more than one
-    if len(session_files[session_id]['processed_images']) > 1:
-        old_image = session_files[session_id]['processed_images'].pop(0)
+    if old_image:
         try:
             if os.path.exists(old_image):
                 os.remove(old_image)
@@ -33,15 +40,28 @@ def add_processed_image(session_id, filepath):
 
 def add_temp_palette(session_id, filepath):
     """Add a temporary palette file to the session tracking."""
-    init_session(session_id)
-    session_files[session_id]['temp_palettes'].append(filepath)
+    with _session_files_lock:
+        init_session(session_id)
+        session_files[session_id]['temp_palettes'].append(filepath)
     logging.debug(f"Added temporary palette to session {session_id}: {filepath}")
 
 def cleanup_session(session_id):
     """Clean up all temporary files associated with a session."""
-    if session_id in session_files:
+    # Remove the decoded images shared with the processing pool (also kept
+    # for sessions without processed images)
+    try:
+        import shared_arrays
+        shared_arrays.release_session(session_id)
+    except Exception as e:
+        logging.error(f"Error releasing shared arrays: {str(e)}")
+    
+    # Stop tracking the session first, so its files are removed once
+    with _session_files_lock:
+        files = session_files.pop(session_id, None)
+    
+    if files is not None:
         # Remove all processed images
-        for filepath in session_files[session_id]['processed_images']:
+        for filepath in files['processed_images']:
             try:
                 if os.path.exists(filepath):
                     os.remove(filepath)
@@ -50,7 +70,7 @@ def cleanup_session(session_id):
                 logging.error(f"Error cleaning up processed image: {str(e)}")
                 
         # Remove all temporary palettes
-        for filepath in session_files[session_id]['temp_palettes']:
+        for filepath in files['temp_palettes']:
             try:
                 if os.path.exists(filepath):
                     os.remove(filepath)
@@ -70,13 +90,13 @@ def cleanup_session(session_id):
         except Exception as e:
             logging.error(f"Error cleaning up palette manager: {str(e)}")
                 
-        # Remove the session from tracking
-        del session_files[session_id]
         logging.debug(f"Cleaned up session: {session_id}")
 
 def cleanup_all_sessions():
     """Clean up all temporary files from all sessions."""
-    for session_id in list(session_files.keys()):
+    with _session_files_lock:
+        session_ids = list(session_files.keys())
+    for session_id in session_ids:
         cleanup_session(session_id)
     logging.debug("Cleaned up all sessions")
 
@@ -105,6 +125,21 @@ def cleanup_temp_directories(app_config):
                 except Exception as e:
                     logging.error(f"Error removing file {file_path}: {str(e)}")
         
+        # Clean stale cancel flags
+        cancel_flags_dir = app_config['CANCEL_FLAGS_DEST']
+        if os.path.exists(cancel_flags_dir):
+            for filename in os.listdir(cancel_flags_dir):
+                file_path = os.path.join(cancel_flags_dir, filename)
+                try:
+                    if os.path.isfile(file_path):
+                        os.remove(file_path)
+                except Exception as e:
+                    logging.error(f"Error removing file {file_path}: {str(e)}")
+        
+        # Clean shared arrays left by processes that no longer run
+        import shared_arrays
+        shared_arrays.cleanup_stale(app_config['SHARED_ARRAYS_DEST'])
+        
         # Only clean temporary palettes (not built-in ones)
         palettes_dir = app_config['UPLOADED_PALETTES_DEST']
         if os.path.exists(palettes_dir):
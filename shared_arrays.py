@@ -0,0 +1,240 @@
+import os
+import time
+import uuid
+import shutil
+import logging
+import threading
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+from PIL import Image
+
+# A picklable reference to an array stored in a memory-mapped .npy file
+SharedArray = namedtuple('SharedArray', ['path', 'shape', 'dtype'])
+# Bytes of an image copied into a shared file at a time
+STRIP_BYTES = 4 * 1024 * 1024
+
+# Arrays shared by this process, per session: (session_id, key) -> entry
+_arrays = OrderedDict()
+_bytes = 0
+_lock = threading.Lock()
+
+class _Entry:
+    """A shared array and the jobs currently using it."""
+    def __init__(self, handle, nbytes):
+        self.handle = handle
+        self.nbytes = nbytes
+        self.leases = 0
+        self.released = False  # Removed once the last lease ends
+        self.last_used = time.monotonic()
+
+def _write_image(shared, image):
+    """Copy an RGB PIL image into a (H, W, 4) array, a strip of rows at a time."""
+    width, height = image.size
+    rows = max(1, STRIP_BYTES // (width * 4))
+    for top in range(0, height, rows):
+        bottom = min(top + rows, height)
+        strip = image.crop((0, top, width, bottom)).tobytes('raw', 'RGBX')
+        shared[top:bottom] = np.frombuffer(strip, dtype=np.uint8).reshape(bottom - top, width, 4)
+
+def create(directory, source):
+    """
+    Copy an array or image into a new memory-mapped file, to be opened by other processes.
+
+    An RGB PIL image is stored as (H, W, 4) RGBX, PIL's own pixel layout, so
+    it is written without a full-size intermediate copy and readers can wrap
+    the mapping in an image without copying it (see open_image).
+
+    Files live in a subdirectory per process, so startup cleanup can tell
+    which files belong to processes that are gone (see cleanup_stale).
+
+    Args:
+        directory: The shared arrays directory, ideally on a tmpfs such as /dev/shm.
+        source: The array, or RGB PIL image, to share.
+
+    Returns:
+        A SharedArray handle.
+    """
+    if isinstance(source, Image.Image):
+        shape, dtype = (source.height, source.width, 4), np.dtype(np.uint8)
+    else:
+        source = np.asarray(source)
+        shape, dtype = source.shape, source.dtype
+    process_dir = os.path.join(directory, str(os.getpid()))
+    os.makedirs(process_dir, exist_ok=True)
+    path = os.path.join(process_dir, f"{uuid.uuid4().hex}.npy")
+
+    # Write to a temporary file first so a reader never maps a partial array
+    tmp_path = f"{path}.tmp"
+    shared = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=shape)
+    if isinstance(source, Image.Image):
+        _write_image(shared, source)
+    else:
+        shared[...] = source
+    shared.flush()
+    del shared
+    os.replace(tmp_path, path)
+    return SharedArray(path=path, shape=shape, dtype=dtype.str)
+
+def open_array(handle):
+    """
+    Map a shared array without copying it.
+
+    The mapping stays valid after the file is removed.
+
+    Args:
+        handle: A SharedArray.
+
+    Returns:
+        A read-only np.memmap of the array.
+    """
+    return np.load(handle.path, mmap_mode='r')
+
+def open_image(handle):
+    """
+    Map a shared image (see create) as a read-only RGBX PIL image, without copying it.
+
+    Args:
+        handle: A SharedArray of shape (H, W, 4).
+
+    Returns:
+        An RGBX PIL Image backed by the mapping.
+    """
+    array = open_array(handle)
+    height, width = array.shape[:2]
+    return Image.frombuffer('RGBX', (width, height), array, 'raw', 'RGBX', 0, 1)
+
+def _remove_file(handle):
+    """Remove the file of a shared array."""
+    try:
+        os.remove(handle.path)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logging.error(f"Error removing shared array {handle.path}: {str(e)}")
+
+def _evict(max_bytes, max_idle=None):
+    """
+    Remove the least recently used arrays no job is using, down to max_bytes,
+    and those unused for more than max_idle seconds. Called with _lock held.
+    """
+    global _bytes
+    now = time.monotonic()
+    for key in list(_arrays):
+        entry = _arrays[key]
+        idle = max_idle is not None and now - entry.last_used > max_idle
+        if _bytes <= max_bytes and not idle:
+            # Entries are in order of use: the rest were used more recently
+            break
+        if entry.leases:
+            continue
+        del _arrays[key]
+        _bytes -= entry.nbytes
+        _remove_file(entry.handle)
+
+@contextmanager
+def share(directory, session_id, key, compute_array, max_bytes, max_idle=None):
+    """
+    Share an array of a session with other processes for the duration of a job.
+
+    Arrays are kept per session and key after the job, so later jobs of
+    the session on the same data (e.g. the same upload at other settings)
+    reuse the file. They are removed with the session (see
+    release_session) or, when unused, once the process shares more than
+    max_bytes or after max_idle seconds, so the files of abandoned
+    sessions do not keep holding tmpfs memory.
+
+    Args:
+        directory: The shared arrays directory.
+        session_id: The session the array belongs to.
+        key: A hashable key of the array's content within the session.
+        compute_array: A function returning the array (or a PIL image), called if
+                       it is not shared yet.
+        max_bytes: The total size of the arrays shared by this process.
+        max_idle: Optional seconds after which an unused array is removed.
+
+    Yields:
+        A SharedArray handle, valid until the block exits.
+    """
+    global _bytes
+    with _lock:
+        _evict(max_bytes, max_idle)
+        entry = _arrays.get((session_id, key))
+        if entry is not None:
+            _arrays.move_to_end((session_id, key))
+            entry.leases += 1
+
+    if entry is None:
+        handle = create(directory, compute_array())
+        new_entry = _Entry(handle, int(np.prod(handle.shape)) * np.dtype(handle.dtype).itemsize)
+        new_entry.leases = 1
+        with _lock:
+            entry = _arrays.get((session_id, key))
+            if entry is not None:
+                # Another job shared the same array meanwhile
+                entry.leases += 1
+                _remove_file(new_entry.handle)
+            else:
+                entry = new_entry
+                _arrays[(session_id, key)] = entry
+                _bytes += entry.nbytes
+                _evict(max_bytes, max_idle)
+
+    try:
+        yield entry.handle
+    finally:
+        with _lock:
+            entry.leases -= 1
+            entry.last_used = time.monotonic()
+            remove = entry.released and not entry.leases
+        if remove:
+            _remove_file(entry.handle)
+
+def release_session(session_id):
+    """Remove the arrays shared for a session (those still used by a job go when the job ends)."""
+    global _bytes
+    with _lock:
+        keys = [key for key in _arrays if key[0] == session_id]
+        entries = [_arrays.pop(key) for key in keys]
+        for entry in entries:
+            _bytes -= entry.nbytes
+            entry.released = True
+        removable = [entry for entry in entries if not entry.leases]
+    for entry in removable:
+        _remove_file(entry.handle)
+    if entries:
+        logging.debug(f"Released {len(entries)} shared arrays of session {session_id}")
+
+def get_stats():
+    """Get the number and total size of the arrays shared by this process."""
+    with _lock:
+        return {
+            'arrays': len(_arrays),
+            'size_mb': round(_bytes / 2**20, 2),
+            'in_use': sum(1 for entry in _arrays.values() if entry.leases)
+        }
+
+def cleanup_stale(directory):
+    """Remove the shared arrays of processes that no longer run."""
+    if not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        if not name.isdigit():
+            continue
+        try:
+            os.kill(int(name), 0)
+            continue  # The process still runs
+        except ProcessLookupError:
+            pass
+        except PermissionError:
+            continue  # Runs under another user
+        shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+def release_all(directory):
+    """Remove every array shared by this process, e.g. on shutdown."""
+    global _bytes
+    with _lock:
+        _arrays.clear()
+        _bytes = 0
+    shutil.rmtree(os.path.join(directory, str(os.getpid())), ignore_errors=True)
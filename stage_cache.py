@@ -0,0 +1,163 @@
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+# Pipeline stages, in order; each stage's key extends the key of the previous one
+STAGES = ('decoded', 'downscaled', 'quantized', 'upscaled')
+# Maximum total size of the cached stage outputs of a worker
+STAGE_CACHE_MAX_BYTES = 128 * 1024 * 1024
+# Larger outputs (typically heavily upscaled images) are not cached
+STAGE_CACHE_MAX_ENTRY_BYTES = STAGE_CACHE_MAX_BYTES // 4
+
+# The stage outcomes of the request handled by the current thread
+_local = threading.local()
+
+def _nbytes(value):
+    """Get the approximate size of a cached PIL image or numpy array."""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    return value.width * value.height * len(value.getbands())
+
+def file_digest(path):
+    """Get a digest of a file's content, to key the stages of an upload."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def array_digest(array):
+    """Get a digest of an array's content, e.g. to key the colors of a palette."""
+    return hashlib.blake2b(np.ascontiguousarray(array).tobytes(), digest_size=16).hexdigest()
+
+class StageCache:
+    """
+    An LRU cache of processing stage outputs, bounded by their total size.
+
+    The pipeline is deterministic, so a stage whose inputs and parameters
+    were seen before returns the stored output instead of running again.
+    Cached outputs are shared and must not be modified.
+    """
+    def __init__(self, max_bytes=STAGE_CACHE_MAX_BYTES, max_entry_bytes=STAGE_CACHE_MAX_ENTRY_BYTES):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self._entries = OrderedDict()  # (stage, key) -> (value, nbytes)
+        self._bytes = 0
+        self._hits = dict.fromkeys(STAGES, 0)
+        self._misses = dict.fromkeys(STAGES, 0)
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, stage, key, compute):
+        """
+        Get the output of a stage, computing and caching it on a miss.
+
+        Args:
+            stage: One of STAGES.
+            key: A hashable key of everything the stage output depends on.
+            compute: A function computing the output (a PIL image or numpy array).
+
+        Returns:
+            The stage output.
+        """
+        with self._lock:
+            entry = self._entries.get((stage, key))
+            if entry is not None:
+                self._entries.move_to_end((stage, key))
+                self._hits[stage] += 1
+            else:
+                self._misses[stage] += 1
+        _record(stage, entry is not None)
+        if entry is not None:
+            return entry[0]
+
+        value = compute()
+        nbytes = _nbytes(value)
+        if nbytes > self.max_entry_bytes:
+            return value
+
+        with self._lock:
+            previous = self._entries.pop((stage, key), None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[(stage, key)] = (value, nbytes)
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self._bytes -= evicted_bytes
+        return value
+
+    def get_stats(self):
+        """Get the hit rate of every stage and the size of the cache."""
+        with self._lock:
+            stages = {}
+            for stage in STAGES:
+                lookups = self._hits[stage] + self._misses[stage]
+                stages[stage] = {
+                    'hits': self._hits[stage],
+                    'misses': self._misses[stage],
+                    'hit_rate': round(self._hits[stage] / lookups, 3) if lookups else None
+                }
+            return {
+                'stages': stages,
+                'entries': len(self._entries),
+                'size_mb': round(self._bytes / 2**20, 2),
+                'max_size_mb': round(self.max_bytes / 2**20, 2)
+            }
+
+    def clear(self):
+        """Drop all cached outputs."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+# Stage cache shared by the threads of this worker process
+_cache = StageCache()
+
+def _record(stage, hit):
+    """Record a stage outcome for the request handled by the current thread."""
+    outcomes = getattr(_local, 'outcomes', None)
+    if outcomes is not None:
+        outcomes[stage] = 'hit' if hit else 'miss'
+
+@contextmanager
+def track():
+    """
+    Record which stages of the current thread's request hit the cache.
+
+    Yields:
+        A dict of stage -> 'hit' or 'miss', filled as the stages run, plus
+        the details recorded with record_detail.
+    """
+    previous = getattr(_local, 'outcomes', None)
+    outcomes = {}
+    _local.outcomes = outcomes
+    try:
+        yield outcomes
+    finally:
+        _local.outcomes = previous
+        if outcomes:
+            logging.debug(f"Pipeline stages: {outcomes}")
+
+def record_detail(name, value):
+    """Record how the current thread's request ran a step (e.g. the quantization path) next to its stage outcomes."""
+    outcomes = getattr(_local, 'outcomes', None)
+    if outcomes is not None:
+        outcomes[name] = value
+
+def merge(outcomes):
+    """Add stage outcomes recorded elsewhere (e.g. in a pool process) to the current thread's request."""
+    current = getattr(_local, 'outcomes', None)
+    if current is not None:
+        current.update(outcomes)
+
+def get_or_compute(stage, key, compute):
+    """Get the output of a stage from the worker's cache, see StageCache.get_or_compute."""
+    return _cache.get_or_compute(stage, key, compute)
+
+def get_stats():
+    """Get the hit rates and size of the worker's stage cache."""
+    return _cache.get_stats()
@@ -2,6 +2,8 @@
 let paletteDialogOpened = false;
 let lastValidImageFile = null;
 let isProcessing = false; // Flag to track processing state
+let currentRequestId = null; // Id of the in-flight processing request
+let currentRequestController = null; // AbortController of the in-flight request
 
 // Clean up session when page is unloaded
 window.addEventListener('beforeunload', () => {
@@ -40,10 +42,24 @@ document.addEventListener('DOMContentLoaded', () => {
     const loadingModalElement = document.getElementById('loadingModal');
     const errorModalElement = document.getElementById('errorModal');
     const cancelButton = document.getElementById('cancelProcessingBtn');
+    const suggestButton = document.getElementById('suggest-palettes-button');
+    const autoPaletteOptions = document.getElementById('auto-palette-options');
+    const paletteSuggestions = document.getElementById('palette-suggestions');
+    const paletteSearch = document.getElementById('palette-search');
+    const paletteColors = new Map(); // Palette id -> full colors, fetched in batches from /palettes/colors
+    let paletteListVersion = 0; // Bumped when the palette list is replaced, to drop stale pages
+    const exportFormatSelect = document.getElementById('export-format');
+    const exportNativeCheckbox = document.getElementById('export-native');
+    const exportLink = document.getElementById('export-link');
+    let exportUrl = null; // Export endpoint of the current result
+    const cropOptions = document.getElementById('crop-options');
+    const clearCropButton = document.getElementById('clear-crop-button');
+    let cropRect = null; // Selected region as fractions of the image size {x, y, width, height}
 
     // Setup the palette select with color swatches
     if (paletteSelect) {
         setupPaletteSelectWithSwatches();
+        loadRemainingPalettes();
     }
 
     // Load initial palette swatches if a palette is selected
@@ -59,10 +75,31 @@ document.addEventListener('DOMContentLoaded', () => {
     // Set up the cancel processing button
     if (cancelButton) {
         cancelButton.addEventListener('click', () => {
+            cancelProcessing();
             hideLoadingModal();
         });
     }
 
+    function generateRequestId() {
+        if (window.crypto && crypto.randomUUID) {
+            return crypto.randomUUID();
+        }
+        return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+    }
+
+    function cancelProcessing() {
+        if (!currentRequestId) return;
+
+        // Tell the server to stop working on the request, then drop the response
+        fetch(`/cancel/${currentRequestId}`, { method: 'POST', keepalive: true })
+            .catch(e => console.error('Error cancelling processing:', e));
+        if (currentRequestController) {
+            currentRequestController.abort();
+        }
+        currentRequestId = null;
+        currentRequestController = null;
+    }
+
     // Setup modal close buttons
     setupModalCloseButtons();
 
@@ -118,6 +155,10 @@ document.addEventListener('DOMContentLoaded', () => {
             });
         }
 
+        if (suggestButton) {
+            suggestButton.addEventListener('click', suggestPalettes);
+        }
+
         if (importPaletteLink && importPaletteInput) {
             importPaletteLink.addEventListener('click', (e) => {
                 e.preventDefault();
@@ -134,18 +175,63 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    function suggestPalettes() {
+        if (!lastValidImageFile) {
+            showError('Please select an image first.');
+            return;
+        }
+
+        const formData = new FormData();
+        formData.append('file', lastValidImageFile);
+        formData.append('limit', 5);
+
+        suggestButton.disabled = true;
+        fetch('/palettes/suggest', {
+            method: 'POST',
+            body: formData
+        })
+        .then(response => response.json())
+        .then(data => {
+            if (data.error) throw new Error(data.error);
+            paletteSuggestions.innerHTML = '';
+            data.forEach(palette => {
+                const chip = document.createElement('button');
+                chip.type = 'button';
+                chip.className = 'md-button md-button-tonal md-palette-suggestion';
+                chip.textContent = palette.name;
+                chip.title = `Match score: ${palette.score} (lower is closer)`;
+                chip.addEventListener('click', () => {
+                    selectPalette(palette);
+                });
+                paletteSuggestions.appendChild(chip);
+            });
+            // Fetch the suggested palettes' colors in one request ahead of a click
+            fetchPaletteColors(data.map(palette => palette.id)).catch(error => {
+                console.error('Error prefetching palettes:', error);
+            });
+        })
+        .catch(error => {
+            showError(error.message);
+        })
+        .finally(() => {
+            suggestButton.disabled = false;
+        });
+    }
+
     function handlePaletteImport() {
         if (importPaletteInput.files.length > 0) {
             const file = importPaletteInput.files[0];
-            if (!file.name.endsWith('.hex') && !file.name.endsWith('.txt')) {
-                showError('Please select a valid palette file (.hex or .txt)');
+            // The formats the server imports are listed in the input's accept attribute
+            const paletteImportFormats = importPaletteInput.accept.split(',');
+            const extension = file.name.slice(file.name.lastIndexOf('.')).toLowerCase();
+            if (!paletteImportFormats.includes(extension)) {
+                showError(`Please select a valid palette file (${paletteImportFormats.join(', ')})`);
                 importPaletteInput.value = '';
                 return;
             }
 
             const formData = new FormData();
             formData.append('palette_file', file);
-            formData.append('name', file.name.replace(/\.[^/.]+$/, ''));
 
             fetch('/palette/import', {
                 method: 'POST',
@@ -154,12 +240,13 @@ document.addEventListener('DOMContentLoaded', () => {
             .then(response => response.json())
             .then(data => {
                 if (data.error) throw new Error(data.error);
-                const option = document.createElement('option');
-                option.value = data.id;
-                option.text = data.name;
-                paletteSelect.add(option);
-                paletteSelect.value = data.id;
-                loadPaletteSwatches(data.id);
+                // An archive imports several palettes; select the first one
+                const palettes = data.imported || [data];
+                appendPaletteOptions(palettes);
+                selectPalette(palettes[0]);
+                if (data.errors && data.errors.length > 0) {
+                    showError(`Imported ${palettes.length} palettes; skipped ${data.errors.length} invalid files (first: ${data.errors[0].file}: ${data.errors[0].error})`);
+                }
                 
                 // Add a subtle visual feedback
                 if (importPaletteLink) {
@@ -209,42 +296,92 @@ document.addEventListener('DOMContentLoaded', () => {
                 
                 formData.append('max_resolution', document.getElementById('max_resolution').value);
                 formData.append('upscale_factor', document.getElementById('upscale_factor').value);
+                formData.append('downscale_method', document.getElementById('downscale_method').value);
+                if (cropRect) {
+                    const { x, y, width, height } = cropRect;
+                    formData.append('crop', [x, y, width, height].map(value => value.toFixed(4)).join(','));
+                    formData.append('crop_mode', document.getElementById('crop_mode').value);
+                }
+                if (selectedMode === 'auto') {
+                    formData.append('palette_size', document.getElementById('palette_size').value);
+                    formData.append('snap_to_palette', document.getElementById('snap_to_palette').checked ? '1' : '0');
+                }
+
+                // Identify the request so it can be cancelled on the server
+                currentRequestId = generateRequestId();
+                currentRequestController = new AbortController();
+                formData.append('request_id', currentRequestId);
 
                 // Show the loading modal
                 showLoadingModal();
 
-                fetch('/upload', {
+                const resultContainer = document.getElementById('result-container');
+                let resultData = null;
+
+                // The server streams a quick preview first, then the full result
+                fetch('/upload/stream', {
                     method: 'POST',
-                    body: formData
+                    body: formData,
+                    signal: currentRequestController.signal
                 })
                 .then(response => {
                     console.log(`Received response status: ${response.status}`);
                     if (!response.ok) {
-                        throw new Error('Network response was not ok');
+                        return response.json().catch(() => ({})).then(data => {
+                            throw new Error(data.error || 'Network response was not ok');
+                        });
                     }
-                    return response.json();
+                    return readEventStream(response, (event, data) => {
+                        if (event === 'preview') {
+                            // Show the low-resolution preview while the full result renders
+                            resultContainer.innerHTML = `<img src="${data.image}" alt="Preview" class="md-image-display md-image-preview">
+                                <p class="md-text-body-small md-text-secondary md-mt-2">Rendering full resolution...</p>`;
+                            if (loadingModalElement) loadingModalElement.classList.remove('show');
+                        } else if (event === 'result') {
+                            resultData = data;
+                        } else if (event === 'error') {
+                            throw new Error(data.error || 'Error processing image');
+                        }
+                    }).then(() => {
+                        if (!resultData) throw new Error('Processing ended without a result');
+                        return resultData;
+                    });
                 })
                 .then(data => {
                     console.log(`Received data: ${JSON.stringify(data)}`);
                     if (data.error) throw new Error(data.error);
                     
-                    document.getElementById('result-container').innerHTML = `<img src="${data.processed_image_url}" alt="Processed Image" class="md-image-display">`;
+                    resultContainer.innerHTML = `<img src="${data.processed_image_url}" alt="Processed Image" class="md-image-display">`;
                     document.getElementById('download-container').style.display = 'block';
                     document.getElementById('download-link').href = data.processed_image_url;
+                    exportUrl = data.export_url;
+                    updateExportLink();
                     
                     // Log the quantization mode from response
                     console.log(`Response quantization mode: ${data.quantization_mode}`);
                     
+                    // The extracted palette can be reused with the other modes
+                    if (data.auto_palette) {
+                        paletteColors.set(String(data.auto_palette.id), data.auto_palette.colors);
+                        appendPaletteOptions([{...data.auto_palette, swatch: data.auto_palette.colors}]);
+                    }
+                    
                     // Hide the loading modal
                     setTimeout(() => {
                         hideLoadingModal();
                     }, 250); // Small delay to ensure everything is ready
                 })
                 .catch(error => {
+                    if (error.name === 'AbortError') {
+                        console.log('Processing cancelled by the user');
+                        return;
+                    }
                     console.error('Error processing image:', error);
                     showError(error.message);
                 })
                 .finally(() => {
+                    currentRequestId = null;
+                    currentRequestController = null;
                     console.log('Processing finished, ensuring modal is hidden');
                     setTimeout(() => {
                         hideLoadingModal();
@@ -254,6 +391,37 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    function readEventStream(response, onEvent) {
+        // Parse a text/event-stream response body, calling onEvent(event, data) for each event
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+
+        function pump() {
+            return reader.read().then(({ done, value }) => {
+                if (done) return;
+                buffer += decoder.decode(value, { stream: true });
+
+                let boundary;
+                while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                    const rawEvent = buffer.slice(0, boundary);
+                    buffer = buffer.slice(boundary + 2);
+
+                    let event = 'message';
+                    const dataLines = [];
+                    rawEvent.split('\n').forEach(line => {
+                        if (line.startsWith('event:')) event = line.slice(6).trim();
+                        else if (line.startsWith('data:')) dataLines.push(line.slice(5).trim());
+                    });
+                    onEvent(event, JSON.parse(dataLines.join('\n')));
+                }
+                return pump();
+            });
+        }
+
+        return pump();
+    }
+
     function handleFiles(files) {
         if (files.length > 0) {
             const file = files[0];
@@ -265,10 +433,13 @@ document.addEventListener('DOMContentLoaded', () => {
 
             lastValidImageFile = file;
             preview.innerHTML = '';
+            const container = document.createElement('div');
+            container.classList.add('md-crop-container', 'md-mb-2');
             const img = document.createElement('img');
-            img.classList.add('md-mb-2');
             img.file = file;
-            preview.appendChild(img);
+            container.appendChild(img);
+            preview.appendChild(container);
+            setupCropSelector(container);
 
             const reader = new FileReader();
             reader.onload = (e) => {
@@ -276,6 +447,8 @@ document.addEventListener('DOMContentLoaded', () => {
             };
             reader.readAsDataURL(file);
             processButton.disabled = false;
+            if (suggestButton) suggestButton.disabled = false;
+            if (paletteSuggestions) paletteSuggestions.innerHTML = '';
         }
     }
 
@@ -283,65 +456,160 @@ document.addEventListener('DOMContentLoaded', () => {
         // Use a custom select implementation to show color swatches in dropdown
         const select = document.getElementById('palette');
         
-        // First create hidden options with swatches for all options
+        // The server renders the first page of palettes, with their swatch colors
         for (let i = 0; i < select.options.length; i++) {
             const option = select.options[i];
             try {
                 // Get colors from the data attribute (added in template)
                 const colorsAttr = option.getAttribute('data-colors');
                 if (colorsAttr) {
-                    // Parse the colors from the JSON attribute
-                    const colors = JSON.parse(colorsAttr);
-                    
-                    // Store original option text to reuse
-                    const originalText = option.text;
-                    
-                    // Create a span to hold both text and swatches
-                    const container = document.createElement('span');
-                    container.className = 'option-with-swatches';
-                    
-                    // Add the palette name
-                    const nameSpan = document.createElement('span');
-                    nameSpan.textContent = originalText;
-                    container.appendChild(nameSpan);
-                    
-                    // Add color swatches (limited to 5)
-                    if (colors && colors.length > 0) {
-                        const swatchesContainer = document.createElement('span');
-                        swatchesContainer.className = 'option-swatches';
-                        
-                        // Show up to 5 colors
-                        const maxColors = Math.min(colors.length, 5);
-                        for (let j = 0; j < maxColors; j++) {
-                            const swatch = document.createElement('span');
-                            swatch.className = 'option-swatch';
-                            swatch.style.backgroundColor = `#${colors[j]}`;
-                            swatchesContainer.appendChild(swatch);
-                        }
-                        
-                        container.appendChild(swatchesContainer);
-                    }
-                    
-                    // Replace the option's text with our custom HTML
-                    // This is a hack, but it works in most browsers
-                    option.innerHTML = '';
-                    option.appendChild(container);
+                    decoratePaletteOption(option, JSON.parse(colorsAttr));
                 }
             } catch (e) {
                 console.error('Error setting up palette swatches for option:', e);
             }
         }
+
+        if (paletteSearch) {
+            let searchTimer = null;
+            paletteSearch.addEventListener('input', () => {
+                clearTimeout(searchTimer);
+                searchTimer = setTimeout(() => searchPalettes(paletteSearch.value.trim()), 250);
+            });
+        }
     }
-    
-    function loadPaletteSwatches(paletteId) {
-        fetch(`/palette/${paletteId}`)
+
+    function decoratePaletteOption(option, colors) {
+        // Store original option text to reuse
+        const originalText = option.text;
+        
+        // Create a span to hold both text and swatches
+        const container = document.createElement('span');
+        container.className = 'option-with-swatches';
+        
+        // Add the palette name
+        const nameSpan = document.createElement('span');
+        nameSpan.textContent = originalText;
+        container.appendChild(nameSpan);
+        
+        // Add color swatches (limited to 5)
+        if (colors && colors.length > 0) {
+            const swatchesContainer = document.createElement('span');
+            swatchesContainer.className = 'option-swatches';
+            
+            // Show up to 5 colors
+            const maxColors = Math.min(colors.length, 5);
+            for (let j = 0; j < maxColors; j++) {
+                const swatch = document.createElement('span');
+                swatch.className = 'option-swatch';
+                swatch.style.backgroundColor = `#${colors[j]}`;
+                swatchesContainer.appendChild(swatch);
+            }
+            
+            container.appendChild(swatchesContainer);
+        }
+        
+        // Replace the option's text with our custom HTML
+        // This is a hack, but it works in most browsers
+        option.innerHTML = '';
+        option.appendChild(container);
+    }
+
+    function appendPaletteOptions(palettes) {
+        // Palettes are the summaries listed by /palettes: {id, name, swatch}
+        palettes.forEach(palette => {
+            const option = document.createElement('option');
+            option.value = palette.id;
+            option.text = palette.name;
+            paletteSelect.add(option);
+            decoratePaletteOption(option, palette.swatch);
+        });
+    }
+
+    function selectPalette(palette) {
+        // The palette may not be listed yet (later page) or be filtered out by a search
+        if (!Array.from(paletteSelect.options).some(option => option.value === String(palette.id))) {
+            appendPaletteOptions([palette]);
+        }
+        paletteSelect.value = palette.id;
+        loadPaletteSwatches(palette.id);
+    }
+
+    function fetchPalettePages(url, version, onPage) {
+        // Follows the 'next' links of /palettes until the list ends or is replaced
+        return fetch(url)
+            .then(response => {
+                if (!response.ok) throw new Error('Failed to load palettes');
+                return response.json();
+            })
+            .then(data => {
+                if (version !== paletteListVersion) return;
+                onPage(data);
+                if (data.next) return fetchPalettePages(data.next, version, onPage);
+            });
+    }
+
+    function loadRemainingPalettes() {
+        // Loads the palettes after the first page once the page is shown
+        const total = parseInt(paletteSelect.dataset.total || '0', 10);
+        const pageSize = parseInt(paletteSelect.dataset.pageSize || '0', 10);
+        if (!pageSize || paletteSelect.options.length >= total) return;
+        fetchPalettePages(`/palettes?page=2&per_page=${pageSize}`, paletteListVersion, data => {
+            appendPaletteOptions(data.palettes);
+        }).catch(error => {
+            console.error('Error loading palettes:', error);
+        });
+    }
+
+    function searchPalettes(query) {
+        // Replaces the listed palettes with the matches of a server-side search
+        const version = ++paletteListVersion;
+        const pageSize = paletteSelect.dataset.pageSize || '100';
+        const selected = paletteSelect.value;
+        let firstPage = true;
+        fetchPalettePages(`/palettes?q=${encodeURIComponent(query)}&per_page=${pageSize}`, version, data => {
+            if (firstPage) {
+                firstPage = false;
+                // Keep the current list when nothing matches, so a palette stays selected
+                if (data.palettes.length === 0) {
+                    palettePreview.innerHTML = '<p class="md-text-body-small">No palettes match your search.</p>';
+                    return;
+                }
+                paletteSelect.innerHTML = '';
+                appendPaletteOptions(data.palettes);
+                // Keep the selected palette if it matches, otherwise select the best match
+                const keepSelected = data.palettes.some(palette => String(palette.id) === selected);
+                paletteSelect.value = keepSelected ? selected : data.palettes[0].id;
+                loadPaletteSwatches(paletteSelect.value);
+                return;
+            }
+            appendPaletteOptions(data.palettes);
+        }).catch(error => {
+            console.error('Error searching palettes:', error);
+        });
+    }
+
+    function fetchPaletteColors(paletteIds) {
+        // Fetches the colors of the palettes not fetched yet, in one request
+        const missing = paletteIds.map(String).filter(id => !paletteColors.has(id));
+        if (missing.length === 0) return Promise.resolve();
+        return fetch(`/palettes/colors?ids=${missing.map(encodeURIComponent).join(',')}`)
             .then(response => {
                 if (!response.ok) throw new Error('Failed to load palette');
                 return response.json();
             })
             .then(data => {
+                data.palettes.forEach(palette => paletteColors.set(String(palette.id), palette.colors));
+            });
+    }
+    
+    function loadPaletteSwatches(paletteId) {
+        fetchPaletteColors([paletteId])
+            .then(() => {
+                const colors = paletteColors.get(String(paletteId));
+                if (!colors) throw new Error('Palette not found');
                 palettePreview.innerHTML = '';
-                data.colors.forEach(color => {
+                colors.forEach(color => {
                     const swatch = document.createElement('div');
                     swatch.className = 'color-swatch';
                     swatch.style.backgroundColor = `#${color}`;
@@ -359,10 +627,104 @@ document.addEventListener('DOMContentLoaded', () => {
     if (quantizationSelect && quantizationDescription) {
         quantizationSelect.addEventListener('change', () => {
             updateQuantizationDescription();
+            updateAutoPaletteOptions();
         });
 
         // Set initial quantization description
         updateQuantizationDescription();
+        updateAutoPaletteOptions();
+    }
+
+    // Point the export link at the selected format
+    if (exportFormatSelect && exportNativeCheckbox) {
+        exportFormatSelect.addEventListener('change', updateExportLink);
+        exportNativeCheckbox.addEventListener('change', updateExportLink);
+    }
+
+    function updateExportLink() {
+        if (!exportLink || !exportUrl) return;
+        const params = new URLSearchParams({ format: exportFormatSelect.value, stream: '1' });
+        if (exportNativeCheckbox.checked) params.set('native', '1');
+        exportLink.href = `${exportUrl}?${params.toString()}`;
+    }
+
+    // Let the user drag a rectangle over the uploaded image to crop or pixelate it
+    function setupCropSelector(container) {
+        const selection = document.createElement('div');
+        selection.classList.add('md-crop-selection', 'md-d-none');
+        container.appendChild(selection);
+        let start = null;
+
+        cropRect = null;
+        if (cropOptions) cropOptions.classList.remove('md-d-none');
+        if (clearCropButton) clearCropButton.disabled = true;
+
+        const pointerPosition = (e) => {
+            const bounds = container.getBoundingClientRect();
+            return {
+                x: Math.min(Math.max((e.clientX - bounds.left) / bounds.width, 0), 1),
+                y: Math.min(Math.max((e.clientY - bounds.top) / bounds.height, 0), 1)
+            };
+        };
+
+        const drawSelection = (rect) => {
+            selection.style.left = `${rect.x * 100}%`;
+            selection.style.top = `${rect.y * 100}%`;
+            selection.style.width = `${rect.width * 100}%`;
+            selection.style.height = `${rect.height * 100}%`;
+            selection.classList.remove('md-d-none');
+        };
+
+        container.addEventListener('pointerdown', (e) => {
+            e.preventDefault();
+            start = pointerPosition(e);
+            container.setPointerCapture(e.pointerId);
+        });
+
+        container.addEventListener('pointermove', (e) => {
+            if (!start) return;
+            const end = pointerPosition(e);
+            drawSelection({
+                x: Math.min(start.x, end.x),
+                y: Math.min(start.y, end.y),
+                width: Math.abs(end.x - start.x),
+                height: Math.abs(end.y - start.y)
+            });
+        });
+
+        container.addEventListener('pointerup', (e) => {
+            if (!start) return;
+            const end = pointerPosition(e);
+            const rect = {
+                x: Math.min(start.x, end.x),
+                y: Math.min(start.y, end.y),
+                width: Math.abs(end.x - start.x),
+                height: Math.abs(end.y - start.y)
+            };
+            start = null;
+            // Ignore clicks and tiny drags
+            if (rect.width < 0.02 || rect.height < 0.02) {
+                clearCrop();
+                return;
+            }
+            cropRect = rect;
+            drawSelection(rect);
+            if (clearCropButton) clearCropButton.disabled = false;
+        });
+
+        function clearCrop() {
+            cropRect = null;
+            selection.classList.add('md-d-none');
+            if (clearCropButton) clearCropButton.disabled = true;
+        }
+
+        if (clearCropButton) clearCropButton.onclick = clearCrop;
+    }
+
+    function updateAutoPaletteOptions() {
+        if (autoPaletteOptions) {
+            autoPaletteOptions.classList.toggle('md-d-none', quantizationSelect.value !== 'auto');
+        }
     }
 
     function updateQuantizationDescription() {
@@ -388,6 +750,15 @@ document.addEventListener('DOMContentLoaded', () => {
                 case 'kmeans_brightness':
                     quantizationDescription.textContent = 'Uses k-means and maps clusters based on brightness';
                     break;
+                case 'tone_map':
+                    quantizationDescription.textContent = 'Maps brightness bands of the image to the palette sorted from dark to light';
+                    break;
+                case 'tone_map_hue':
+                    quantizationDescription.textContent = 'Maps brightness bands like Tone Map, preferring palette colors of a similar hue';
+                    break;
+                case 'auto':
+                    quantizationDescription.textContent = 'Builds a palette from the image itself, optionally snapped to the selected palette';
+                    break;
                 default:
                     quantizationDescription.textContent = '';
             }
@@ -431,6 +802,8 @@ document.addEventListener('DOMContentLoaded', () => {
         if (fileElem) fileElem.value = '';
         lastValidImageFile = null;
         preview.innerHTML = '';
+        cropRect = null;
+        if (cropOptions) cropOptions.classList.add('md-d-none');
         if (processButton) processButton.disabled = true;
     }
 });
@@ -0,0 +1,143 @@
+import os
+
+import pytest
+
+import admission
+from admission import AdmissionDenied
+
+
+@pytest.fixture
+def config(tmp_path):
+    return {
+        'ADMISSION_STATE_PATH': str(tmp_path / 'admission_state.json'),
+        'ADMISSION_MAX_CONCURRENT_PER_CLIENT': 2,
+        'ADMISSION_MAX_CONCURRENT_PER_ADDRESS': 3,
+        'ADMISSION_GLOBAL_CAPACITY': 10,
+        'ADMISSION_BUCKET_SIZE': 8,
+        'ADMISSION_REFILL_RATE': 1,
+        'ADMISSION_ADDRESS_BUCKET_SIZE': 20,
+        'ADMISSION_ADDRESS_REFILL_RATE': 2,
+        'ADMISSION_LEASE_TIMEOUT': 60,
+        'ADMISSION_RETRY_AFTER': 5,
+        'ADMISSION_MODE_COSTS': {'kmeans': 2},
+    }
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(admission.time, 'time', lambda: now[0])
+    return now
+
+
+def test_request_cost(config):
+    assert admission.request_cost(config, 'contrast', '128,128') == 1
+    assert admission.request_cost(config, 'contrast', '64,64') == 1
+    assert admission.request_cost(config, 'contrast', '512,256') == 4
+    assert admission.request_cost(config, 'kmeans', '256,256') == 4
+    # Malformed resolutions are costed as 512 px
+    assert admission.request_cost(config, 'contrast', 'x') == 4
+
+
+def test_release_frees_the_slot(config, clock):
+    first = admission.acquire(config, 'a', 1)
+    admission.acquire(config, 'a', 1)
+    with pytest.raises(AdmissionDenied) as denied:
+        admission.acquire(config, 'a', 1)
+    assert denied.value.retry_after == 5
+
+    admission.release(config, first)
+    admission.acquire(config, 'a', 1)
+    stats = admission.get_stats(config)
+    assert stats['in_flight'] == 2
+    assert stats['counters']['admitted'] == 3
+    assert stats['counters']['released'] == 1
+    assert stats['counters']['rejected_session'] == 1
+
+
+def test_release_is_idempotent(config, clock):
+    lease_id = admission.acquire(config, 'a', 1)
+    admission.release(config, lease_id)
+    admission.release(config, lease_id)
+    admission.release(config, None)
+    stats = admission.get_stats(config)
+    assert stats['in_flight'] == 0
+    assert stats['counters']['released'] == 1
+
+
+def test_admitted_releases_on_error(config, clock):
+    with pytest.raises(RuntimeError):
+        with admission.admitted(config, 'a', 1, '10.0.0.1'):
+            assert admission.get_stats(config)['in_flight'] == 1
+            raise RuntimeError
+    assert admission.get_stats(config)['in_flight'] == 0
+
+
+def test_address_limits_sessions_behind_one_address(config, clock):
+    for session_id in ('a', 'b', 'c'):
+        admission.acquire(config, session_id, 1, '10.0.0.1')
+    with pytest.raises(AdmissionDenied):
+        admission.acquire(config, 'd', 1, '10.0.0.1')
+    admission.acquire(config, 'd', 1, '10.0.0.2')
+
+    stats = admission.get_stats(config)
+    assert stats['counters']['rejected_address'] == 1
+    assert stats['active_addresses'] == 2
+    assert stats['active_clients'] == 4
+
+
+def test_global_capacity(config, clock):
+    admission.acquire(config, 'a', 6)
+    with pytest.raises(AdmissionDenied, match='busy'):
+        admission.acquire(config, 'b', 6)
+    admission.acquire(config, 'b', 4)
+
+    stats = admission.get_stats(config)
+    assert stats['cost_in_flight'] == 10
+    assert stats['counters']['rejected_global'] == 1
+
+
+def test_cost_is_capped_at_the_bucket_size(config, clock):
+    lease_id = admission.acquire(config, 'a', 100)
+    assert admission.get_stats(config)['cost_in_flight'] == 8
+    admission.release(config, lease_id)
+
+
+def test_token_bucket_refills(config, clock):
+    admission.release(config, admission.acquire(config, 'a', 5))
+    with pytest.raises(AdmissionDenied) as denied:
+        admission.acquire(config, 'a', 5)
+    # 3 tokens are left; 2 more arrive in 2 seconds
+    assert denied.value.retry_after == 2
+    assert admission.get_stats(config)['counters']['rejected_rate'] == 1
+
+    clock[0] += 2
+    admission.acquire(config, 'a', 5)
+
+
+def test_address_bucket_is_shared_by_sessions(config, clock):
+    for session_id in ('a', 'b', 'c', 'd'):
+        admission.release(config, admission.acquire(config, session_id, 5, '10.0.0.1'))
+    # Session 'e' still has a full bucket, but the address has spent its 20 tokens
+    with pytest.raises(AdmissionDenied, match='Rate limit'):
+        admission.acquire(config, 'e', 5, '10.0.0.1')
+
+
+def test_reaps_leases_of_dead_processes(config, clock, monkeypatch):
+    admission.acquire(config, 'a', 1)
+    admission.acquire(config, 'b', 1)
+    monkeypatch.setattr(admission, '_process_alive', lambda pid: pid != os.getpid())
+    assert admission.get_stats(config)['in_flight'] == 0
+
+
+def test_reaps_expired_leases(config, clock):
+    admission.acquire(config, 'a', 1)
+    clock[0] += 61
+    assert admission.get_stats(config)['in_flight'] == 0
+
+
+def test_resets_corrupted_state(config, clock):
+    with open(config['ADMISSION_STATE_PATH'], 'w') as f:
+        f.write('{not json')
+    admission.acquire(config, 'a', 1)
+    assert admission.get_stats(config)['counters']['admitted'] == 1
@@ -0,0 +1,146 @@
+import io
+import struct
+import zipfile
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import palette_import
+from palette_import import InvalidPaletteError, parse_palette
+
+RED_GREEN = [[255, 0, 0], [0, 255, 0]]
+
+
+@pytest.mark.parametrize('newline', [b'\n', b'\r\n', b'\r'])
+def test_hex_line_ends(newline):
+    data = newline.join([b'; comment', b'#ff0000', b'', b'  00FF00  ']) + newline
+    parsed = parse_palette('lospec.hex', data)
+    assert parsed.rgb.tolist() == RED_GREEN
+    assert parsed.name == 'lospec'
+
+
+@pytest.mark.parametrize('newline', [b'\n', b'\r\n'])
+def test_paint_net_txt_ignores_alpha(newline):
+    data = newline.join([b'; paint.net Palette File', b'FFff0000', b'80ff0000', b'FF00ff00']) + newline
+    parsed = parse_palette('paint.txt', data)
+    assert parsed.rgb.tolist() == RED_GREEN
+    assert parsed.duplicates == 1
+
+
+@pytest.mark.parametrize('newline', [b'\n', b'\r\n'])
+def test_gpl_line_ends(newline):
+    data = newline.join([
+        b'GIMP Palette', b'Name: Sunset', b'Columns: 4', b'#',
+        b'255   0   0', b'  0 255   0\tGreen', b''
+    ])
+    parsed = parse_palette('x.gpl', data)
+    assert parsed.name == 'Sunset'
+    assert parsed.rgb.tolist() == RED_GREEN
+
+
+def test_gpl_requires_header():
+    with pytest.raises(InvalidPaletteError, match='GIMP Palette'):
+        parse_palette('x.gpl', b'255 0 0\n')
+
+
+def test_gpl_rejects_out_of_range_component():
+    with pytest.raises(InvalidPaletteError, match='between 0 and 255'):
+        parse_palette('x.gpl', b'GIMP Palette\n256 0 0\n')
+
+
+@pytest.mark.parametrize('data, message', [
+    (b'ff0000\nnot a color\n', 'Line 2'),
+    (b'ff00\n', 'Line 1'),
+    (b'ff0000\x0b00ff00\n', 'colors'),
+    (b'; only a comment\r\n', 'no colors'),
+])
+def test_hex_rejects_malformed(data, message):
+    with pytest.raises(InvalidPaletteError, match=message):
+        parse_palette('bad.hex', data)
+
+
+@pytest.mark.parametrize('newline', [b'\n', b'\r\n'])
+def test_jasc_pal(newline):
+    data = newline.join([b'JASC-PAL', b'0100', b'2', b'255 0 0', b'0 255 0 255']) + newline
+    assert parse_palette('x.pal', data).rgb.tolist() == RED_GREEN
+
+
+def test_jasc_pal_missing_colors():
+    with pytest.raises(InvalidPaletteError, match='declares 3 colors'):
+        parse_palette('x.pal', b'JASC-PAL\n0100\n3\n255 0 0\n')
+
+
+def _riff_pal(colors, count=None):
+    entries = b''.join(bytes(rgb) + b'\x00' for rgb in colors)
+    chunk = struct.pack('<HH', 0x300, len(colors) if count is None else count) + entries
+    body = b'PAL ' + b'data' + struct.pack('<I', len(chunk)) + chunk
+    return b'RIFF' + struct.pack('<I', len(body)) + body
+
+
+def test_riff_pal():
+    assert parse_palette('x.pal', _riff_pal(RED_GREEN)).rgb.tolist() == RED_GREEN
+
+
+@pytest.mark.parametrize('data', [_riff_pal(RED_GREEN, count=5), _riff_pal(RED_GREEN)[:22]])
+def test_riff_pal_truncated(data):
+    with pytest.raises(InvalidPaletteError):
+        parse_palette('x.pal', data)
+
+
+def _ase(group_name, swatches):
+    blocks = []
+    name = group_name.encode('utf-16-be') + b'\x00\x00'
+    blocks.append(struct.pack('>HI', 0xC001, 2 + len(name)) + struct.pack('>H', len(name) // 2) + name)
+    for model, values in swatches:
+        body = struct.pack('>H', 1) + b'\x00\x00' + model + struct.pack(f'>{len(values)}f', *values) + b'\x00\x02'
+        blocks.append(struct.pack('>HI', 0x0001, len(body)) + body)
+    return b'ASEF' + struct.pack('>HHI', 1, 0, len(blocks)) + b''.join(blocks)
+
+
+def test_ase_color_models():
+    data = _ase('Group', [(b'RGB ', (1.0, 0.0, 0.0)), (b'CMYK', (1.0, 0.0, 1.0, 0.0)), (b'Gray', (0.0,))])
+    parsed = parse_palette('x.ase', data)
+    assert parsed.name == 'Group'
+    assert parsed.rgb.tolist() == [[255, 0, 0], [0, 255, 0], [0, 0, 0]]
+
+
+def test_ase_truncated():
+    data = _ase('Group', [(b'RGB ', (1.0, 0.0, 0.0))])
+    with pytest.raises(InvalidPaletteError, match='Truncated'):
+        parse_palette('x.ase', data[:-6])
+
+
+def test_swatch_image_skips_transparent_pixels():
+    img = Image.new('RGBA', (3, 1))
+    img.putdata([(255, 0, 0, 255), (9, 9, 9, 0), (0, 255, 0, 255)])
+    buf = io.BytesIO()
+    img.save(buf, 'PNG')
+    assert parse_palette('swatch.png', buf.getvalue()).rgb.tolist() == RED_GREEN
+
+
+def test_max_colors():
+    with pytest.raises(InvalidPaletteError, match='maximum is 1'):
+        parse_palette('x.hex', b'ff0000\n00ff00\n', max_colors=1)
+
+
+def test_unsupported_format():
+    with pytest.raises(InvalidPaletteError, match='Unsupported'):
+        parse_palette('x.act', b'')
+
+
+def test_dedupe_colors_keeps_first_occurrence():
+    rgb = np.array([[0, 0, 1], [9, 9, 9], [0, 0, 1], [1, 0, 0]], dtype=np.uint8)
+    assert palette_import.dedupe_colors(rgb).tolist() == [[0, 0, 1], [9, 9, 9], [1, 0, 0]]
+
+
+def test_archive_reports_each_entry():
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as archive:
+        archive.writestr('good.hex', 'ff0000\r\n00ff00\r\n')
+        archive.writestr('bad.hex', 'nope\n')
+        archive.writestr('__MACOSX/good.hex', 'ff0000\n')
+    results = dict(palette_import.iter_archive(buf.getvalue()))
+    assert set(results) == {'good.hex', 'bad.hex'}
+    assert results['good.hex'].rgb.tolist() == RED_GREEN
+    assert isinstance(results['bad.hex'], InvalidPaletteError)
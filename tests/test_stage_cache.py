@@ -0,0 +1,121 @@
+import os
+import threading
+import uuid
+
+import numpy as np
+from PIL import Image
+
+import stage_cache
+from stage_cache import StageCache
+
+PALETTE_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'palettes', '001.hex')
+
+
+def array(nbytes, fill=0):
+    return np.full(nbytes, fill, dtype=np.uint8)
+
+
+def test_miss_then_hit():
+    cache = StageCache()
+    calls = []
+    compute = lambda: calls.append(1) or array(10)
+    first = cache.get_or_compute('quantized', 'key', compute)
+    second = cache.get_or_compute('quantized', 'key', compute)
+    assert second is first
+    assert len(calls) == 1
+
+    stats = cache.get_stats()
+    assert stats['stages']['quantized'] == {'hits': 1, 'misses': 1, 'hit_rate': 0.5}
+    assert stats['stages']['decoded']['hit_rate'] is None
+    assert stats['entries'] == 1
+
+
+def test_stages_have_separate_keys():
+    cache = StageCache()
+    cache.get_or_compute('downscaled', 'key', lambda: array(10, 1))
+    assert cache.get_or_compute('quantized', 'key', lambda: array(10, 2))[0] == 2
+
+
+def test_evicts_least_recently_used():
+    cache = StageCache(max_bytes=30, max_entry_bytes=30)
+    cache.get_or_compute('quantized', 'a', lambda: array(10))
+    cache.get_or_compute('quantized', 'b', lambda: array(10))
+    cache.get_or_compute('quantized', 'a', lambda: array(10))
+    cache.get_or_compute('quantized', 'c', lambda: array(15))
+    # 'b' was used least recently
+    assert cache.get_stats()['entries'] == 2
+    assert cache.get_or_compute('quantized', 'b', lambda: array(10, 7))[0] == 7
+
+
+def test_does_not_cache_large_outputs():
+    cache = StageCache(max_bytes=100, max_entry_bytes=10)
+    cache.get_or_compute('upscaled', 'key', lambda: array(11))
+    assert cache.get_stats()['entries'] == 0
+
+
+def test_sizes_images_by_their_bands():
+    cache = StageCache(max_bytes=100, max_entry_bytes=100)
+    cache.get_or_compute('downscaled', 'key', lambda: Image.new('RGB', (4, 4)))
+    assert cache.get_stats()['size_mb'] == round(48 / 2**20, 2)
+    cache.clear()
+    assert cache.get_stats()['entries'] == 0
+
+
+def test_track_records_outcomes_of_the_current_thread():
+    key = uuid.uuid4().hex
+    with stage_cache.track() as outcomes:
+        stage_cache.get_or_compute('quantized', key, lambda: array(1))
+        stage_cache.get_or_compute('quantized', key, lambda: array(1))
+        stage_cache.record_detail('quantize_path', 'lut')
+        # Other threads record into their own requests
+        thread = threading.Thread(target=stage_cache.get_or_compute, args=('upscaled', key, lambda: array(1)))
+        thread.start()
+        thread.join()
+    assert outcomes == {'quantized': 'hit', 'quantize_path': 'lut'}
+
+    # Outside track nothing is recorded
+    stage_cache.get_or_compute('upscaled', key, lambda: array(1))
+    assert outcomes == {'quantized': 'hit', 'quantize_path': 'lut'}
+
+
+def test_track_nests():
+    with stage_cache.track() as outer:
+        with stage_cache.track() as inner:
+            stage_cache.merge({'quantized': 'miss'})
+        stage_cache.merge({'upscaled': 'hit'})
+    assert inner == {'quantized': 'miss'}
+    assert outer == {'upscaled': 'hit'}
+
+
+def test_pipeline_reuses_stages(tmp_path):
+    import image_processor
+
+    rng = np.random.default_rng(0)
+    source = Image.fromarray(rng.integers(0, 256, (40, 60, 3), dtype=np.uint8), 'RGB')
+    source_key = uuid.uuid4().hex
+
+    def process(**options):
+        with stage_cache.track() as outcomes:
+            filename = image_processor.process_source_image(
+                source, PALETTE_PATH, str(tmp_path), max_resolution=(30, 30), source_key=source_key, **options
+            )
+        with Image.open(tmp_path / filename) as result:
+            return np.asarray(result.convert('RGB')), outcomes
+
+    first, outcomes = process(upscale_factor=2)
+    assert outcomes['downscaled'] == outcomes['quantized'] == outcomes['upscaled'] == 'miss'
+
+    again, outcomes = process(upscale_factor=2)
+    assert outcomes['upscaled'] == 'hit'
+    assert np.array_equal(again, first)
+
+    # Only the upscale factor changed: the quantized image is reused
+    larger, outcomes = process(upscale_factor=4)
+    assert outcomes['quantized'] == 'hit'
+    assert outcomes['upscaled'] == 'miss'
+    assert np.array_equal(larger[::2, ::2], first)
+
+    # Without a source key the stage cache is bypassed
+    uncached = image_processor.process_source_image(source, PALETTE_PATH, str(tmp_path), max_resolution=(30, 30), upscale_factor=2)
+    with Image.open(tmp_path / uncached) as result:
+        assert np.array_equal(np.asarray(result.convert('RGB')), first)
@@ -0,0 +1,52 @@
+import io
+import os
+
+import pytest
+from PIL import Image
+
+
+@pytest.fixture(scope='module')
+def client(tmp_path_factory):
+    # The configuration places its directories in the working directory;
+    # the testing configuration keeps the development database untouched
+    os.environ.setdefault('FLASK_ENV', 'testing')
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('app'))
+    try:
+        from app import app
+        yield app.test_client()
+    finally:
+        os.chdir(cwd)
+
+
+def upload(client, **form):
+    image = io.BytesIO()
+    Image.new('RGB', (8, 8), 'red').save(image, 'PNG')
+    data = {'file': (image, 'image.png'), 'palette': '1'}
+    data.update(form)
+    return client.post('/upload', data=data)
+
+
+@pytest.mark.parametrize('form, error', [
+    ({'quantization_mode': 'bogus'}, 'Invalid quantization mode'),
+    ({'quantization_mode': ''}, 'Invalid quantization mode'),
+    ({'upscale_factor': 'x'}, 'Invalid upscale factor'),
+    ({'upscale_factor': '0'}, 'Invalid upscale factor'),
+    ({'max_resolution': 'x'}, 'Invalid maximum resolution'),
+    ({'max_resolution': '64'}, 'Invalid maximum resolution'),
+    ({'max_resolution': '0,64'}, 'Invalid maximum resolution'),
+    ({'palette_size': 'x'}, 'Invalid palette size'),
+    ({'downscale_method': 'bogus'}, 'Invalid downscale method'),
+    ({'crop': '0,0,2,2'}, 'Invalid crop: The crop must be inside the image'),
+    ({'crop_mode': 'bogus'}, 'Invalid crop mode'),
+])
+def test_rejects_invalid_options(client, form, error):
+    response = upload(client, **form)
+    assert response.status_code == 400
+    assert response.get_json()['error'] == error
+
+
+def test_requires_a_file(client):
+    response = client.post('/upload', data={'palette': '1'})
+    assert response.status_code == 400
+    assert response.get_json()['error'] == 'No file part'
@@ -0,0 +1,37 @@
+import pytest
+
+from utils import parse_crop
+
+
+def test_empty_crop_is_none():
+    assert parse_crop('') is None
+    assert parse_crop(None) is None
+
+
+@pytest.mark.parametrize('crop, expected', [
+    ('0,0,1,1', (0.0, 0.0, 1.0, 1.0)),
+    ('0.1,0.2,0.5,0.25', (0.1, 0.2, 0.5, 0.25)),
+    (' 0.1, 0.2 ,0.5,0.25', (0.1, 0.2, 0.5, 0.25)),
+])
+def test_parses_fractions(crop, expected):
+    assert parse_crop(crop) == pytest.approx(expected)
+
+
+def test_clamps_client_rounding_at_the_edges():
+    assert parse_crop('0.5,0.5,0.5005,0.5') == pytest.approx((0.5, 0.5, 0.5, 0.5))
+
+
+@pytest.mark.parametrize('crop, message', [
+    ('x,0,1,1', 'could not convert'),
+    ('0,0,1', 'four values'),
+    ('0,0,1,1,1', 'four values'),
+    ('1,0,0.1,0.1', 'start inside the image'),
+    ('-0.1,0,0.5,0.5', 'start inside the image'),
+    ('0,0,0,1', 'positive size'),
+    ('0,0,nan,1', 'positive size'),
+    ('0,0,1.1,1', 'inside the image'),
+    ('0.5,0.5,0.5,0.6', 'inside the image'),
+])
+def test_rejects_malformed_crops(crop, message):
+    with pytest.raises(ValueError, match=message):
+        parse_crop(crop)
@@ -70,4 +70,31 @@ def parse_resolution(resolution_str):
         return (width, height)
     except Exception as e:
         print(f"Error parsing resolution string: {str(e)}")
-        return (512, 512)  # Default resolution
\ No newline at end of file
+        return (512, 512)  # Default resolution
+
+def parse_crop(crop_str):
+    """
+    Parse a normalized crop rectangle.
+    
+    Args:
+        crop_str: A string in the format 'x,y,width,height', with every value
+                  a fraction of the image size between 0 and 1.
+        
+    Returns:
+        A tuple of (x, y, width, height) as floats, or None for an empty string.
+        
+    Raises:
+        ValueError: If the rectangle is malformed or not inside the image.
+    """
+    if not crop_str:
+        return None
+    values = [float(value) for value in crop_str.split(',')]
+    if len(values) != 4:
+        raise ValueError("A crop needs four values: x, y, width, height")
+    x, y, width, height = values
+    if not (0 <= x < 1 and 0 <= y < 1 and 0 < width and 0 < height):
+        raise ValueError("The crop must start inside the image and have a positive size")
+    # Allow rounding errors of the client at the right and bottom edges
+    if x + width > 1.001 or y + height > 1.001:
+        raise ValueError("The crop must be inside the image")
+    return (x, y, min(width, 1 - x), min(height, 1 - y))
@@ -0,0 +1,213 @@
+import os
+import time
+import logging
+import argparse
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import imageio.v2 as imageio
+from PIL import Image
+
+from image_processor import (
+    resize_to_fit,
+    quantize_image,
+    quantize_kmeans_array,
+    upscale_image,
+    map_bounded,
+    DOWNSCALE_METHODS,
+)
+
+# Quantization modes that cluster pixels and can reuse the previous frame's centers
+KMEANS_MODES = ('kmeans', 'kmeans_brightness')
+
+def _pixelate_frame(frame, palette_path, max_resolution, quantization_mode, upscale_factor, init_centers=None, downscale_method="lanczos"):
+    """
+    Pixelate a single video frame.
+
+    Runs in a worker process, so it only takes picklable arguments.
+
+    Args:
+        frame: A (H, W, 3) uint8 array.
+        palette_path: The path to the palette file.
+        max_resolution: The maximum width and height of the pixelated frame.
+        quantization_mode: The selected quantization mode.
+        upscale_factor: The pixel upscale factor.
+        init_centers: Optional k-means centers to warm start from.
+        downscale_method: One of image_processor.DOWNSCALE_METHODS.
+
+    Returns:
+        A (frame, cluster_centers) tuple; cluster_centers is None for
+        modes that do not cluster.
+    """
+    img = resize_to_fit(Image.fromarray(frame[..., :3]), max_resolution, method=downscale_method)
+
+    cluster_centers = None
+    if quantization_mode in KMEANS_MODES:
+        result, cluster_centers = quantize_kmeans_array(
+            np.asarray(img),
+            palette_path,
+            brightness=quantization_mode == 'kmeans_brightness',
+            init_centers=init_centers
+        )
+        img = Image.fromarray(result)
+    else:
+        img = quantize_image(img, palette_path, quantization_mode)
+
+    img = upscale_image(img, upscale_factor)
+
+    # Most video codecs need even frame dimensions
+    result = np.asarray(img)
+    pad_height = result.shape[0] % 2
+    pad_width = result.shape[1] % 2
+    if pad_height or pad_width:
+        result = np.pad(result, ((0, pad_height), (0, pad_width), (0, 0)), mode='edge')
+
+    return result, cluster_centers
+
+def _iter_batches(items, size):
+    """Group an iterator into lists of at most `size` items."""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def process_video(
+    video_path,
+    palette_path,
+    output_path,
+    max_resolution=(128, 128),
+    quantization_mode="contrast",
+    upscale_factor=4,
+    warm_start=True,
+    workers=None,
+    fps=None,
+    downscale_method="lanczos"
+):
+    """
+    Pixelate a video clip frame by frame and write the result incrementally.
+
+    Frames are decoded lazily and pixelated by a process pool with a bounded
+    number of frames in flight, and each result is appended to the output as
+    soon as it is ready, so memory use does not grow with the clip length.
+
+    With warm_start, the k-means modes process frames in batches of `workers`
+    frames, and every frame of a batch starts from the cluster centers of the
+    last frame of the previous batch. This converges in a few iterations
+    instead of ten full restarts, and keeps colors stable between frames.
+
+    Args:
+        video_path: The path to the source clip.
+        palette_path: The path to the palette file.
+        output_path: Where to write the pixelated clip.
+        max_resolution: The maximum width and height of the pixelated frames.
+        quantization_mode: The selected quantization mode.
+        upscale_factor: The pixel upscale factor.
+        warm_start: Reuse k-means centers between frames (k-means modes only).
+        workers: The number of worker processes (default: CPU count).
+        fps: The output frame rate (default: the source frame rate).
+        downscale_method: One of image_processor.DOWNSCALE_METHODS.
+
+    Returns:
+        A dict with the number of frames, elapsed seconds and frames per second.
+    """
+    workers = workers or os.cpu_count() or 1
+    start_time = time.perf_counter()
+    frame_count = 0
+
+    try:
+        reader = imageio.get_reader(video_path)
+        try:
+            if fps is None:
+                fps = reader.get_meta_data().get('fps', 24)
+
+            # macro_block_size=1 keeps the exact pixel-art frame size
+            writer = imageio.get_writer(output_path, fps=fps, macro_block_size=1)
+            try:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    if warm_start and quantization_mode in KMEANS_MODES:
+                        init_centers = None
+                        for batch in _iter_batches(iter(reader), workers):
+                            futures = [
+                                executor.submit(
+                                    _pixelate_frame,
+                                    frame,
+                                    palette_path,
+                                    max_resolution,
+                                    quantization_mode,
+                                    upscale_factor,
+                                    init_centers,
+                                    downscale_method
+                                )
+                                for frame in batch
+                            ]
+                            for future in futures:
+                                result, cluster_centers = future.result()
+                                writer.append_data(result)
+                                frame_count += 1
+                            init_centers = cluster_centers
+                    else:
+                        pixelate = partial(
+                            _pixelate_frame,
+                            palette_path=palette_path,
+                            max_resolution=max_resolution,
+                            quantization_mode=quantization_mode,
+                            upscale_factor=upscale_factor,
+                            downscale_method=downscale_method
+                        )
+                        results = map_bounded(executor, pixelate, iter(reader), workers * 2)
+                        for result, _ in results:
+                            writer.append_data(result)
+                            frame_count += 1
+            finally:
+                writer.close()
+        finally:
+            reader.close()
+    except Exception as e:
+        logging.error(f"Error processing video: {str(e)}")
+        raise
+
+    elapsed = time.perf_counter() - start_time
+    stats = {
+        'frames': frame_count,
+        'seconds': round(elapsed, 3),
+        'fps': round(frame_count / elapsed, 2) if elapsed > 0 else 0.0
+    }
+    logging.info(f"Pixelated {frame_count} frames in {stats['seconds']}s ({stats['fps']} frames/s)")
+    return stats
+
+def main():
+    """Pixelate a video clip from the command line."""
+    parser = argparse.ArgumentParser(description="Pixelate a video clip with a color palette.")
+    parser.add_argument('video', help="The source clip")
+    parser.add_argument('output', help="Where to write the pixelated clip")
+    parser.add_argument('--palette', required=True, help="The path to a .hex palette file")
+    parser.add_argument('--mode', default='contrast', help="The quantization mode")
+    parser.add_argument('--resolution', default='128,128', help="The maximum resolution as 'width,height'")
+    parser.add_argument('--upscale', type=int, default=4, help="The pixel upscale factor")
+    parser.add_argument('--workers', type=int, default=None, help="The number of worker processes")
+    parser.add_argument('--fps', type=float, default=None, help="The output frame rate")
+    parser.add_argument('--downscale', default='lanczos', choices=DOWNSCALE_METHODS, help="The downscaling method")
+    parser.add_argument('--no-warm-start', action='store_true', help="Fit k-means from scratch for every frame")
+    args = parser.parse_args()
+
+    stats = process_video(
+        args.video,
+        args.palette,
+        args.output,
+        max_resolution=args.resolution,
+        quantization_mode=args.mode,
+        upscale_factor=args.upscale,
+        warm_start=not args.no_warm_start,
+        workers=args.workers,
+        fps=args.fps,
+        downscale_method=args.downscale
+    )
+    print(f"Pixelated {stats['frames']} frames in {stats['seconds']}s ({stats['fps']} frames/s)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+import os
+import time
+import logging
+import threading
+
+import numpy as np
+from PIL import Image
+
+from image_processor import DOWNSCALE_METHODS, resize_to_fit, quantize_image, extract_palette
+from palette_manager import get_default_palette
+
+# Size of the synthetic source image and of its pixelated version
+WARMUP_SOURCE_SIZE = (320, 240)
+WARMUP_RESOLUTION = (64, 64)
+
+# Set once the worker has run every processing path
+_ready = threading.Event()
+_report = {}
+_started = False
+_start_lock = threading.Lock()
+
+def make_warmup_image(size=WARMUP_SOURCE_SIZE, seed=0):
+    """Create a synthetic source image with gradients, flat areas and noise."""
+    width, height = size
+    rng = np.random.RandomState(seed)
+    x = np.linspace(0, 255, width)[None, :]
+    y = np.linspace(0, 255, height)[:, None]
+    img = np.dstack([np.broadcast_to(x, (height, width)), np.broadcast_to(y, (height, width)), (x + y) / 2])
+    img[height // 3:2 * height // 3, width // 3:2 * width // 3] = [200, 40, 90]
+    img += rng.normal(0, 8, size=img.shape)
+    return Image.fromarray(np.clip(img, 0, 255).astype(np.uint8))
+
+def run_warmup(app_config):
+    """
+    Run every quantization mode and downscale method once on a synthetic image.
+
+    This pays the one-off costs of a fresh worker before it takes traffic:
+    lazy imports inside scikit-learn and scikit-image, BLAS and OpenMP thread
+    pool start-up, and the CIELAB lookup table of the default palette.
+
+    Args:
+        app_config: The Flask app configuration.
+
+    Returns:
+        A dict of warmup step -> duration in milliseconds.
+    """
+    report = {}
+    palette = get_default_palette()
+    if palette is None:
+        logging.error("Warmup skipped: no palettes are loaded")
+        return report
+    palette_path = os.path.join(app_config['UPLOADED_PALETTES_DEST'], palette.filename)
+    source = make_warmup_image()
+
+    for method in DOWNSCALE_METHODS:
+        start = time.perf_counter()
+        image = resize_to_fit(source, WARMUP_RESOLUTION, method=method)
+        report[f"downscale_{method}"] = round((time.perf_counter() - start) * 1000, 1)
+
+    for mode in app_config['QUANTIZATION_MODES']:
+        start = time.perf_counter()
+        if mode['value'] == 'auto':
+            extract_palette(image, app_config['DEFAULT_AUTO_PALETTE_SIZE'], snap_palette_path=palette_path)
+        quantize_image(image, palette_path, mode['value'])
+        report[mode['value']] = round((time.perf_counter() - start) * 1000, 1)
+    return report
+
+def _run(app_config):
+    """Warm up the worker, then mark it ready even if a step failed."""
+    global _report
+    start = time.perf_counter()
+    try:
+        _report = run_warmup(app_config)
+    except Exception as e:
+        logging.error(f"Error during worker warmup: {str(e)}")
+    finally:
+        _report['total'] = round((time.perf_counter() - start) * 1000, 1)
+        _ready.set()
+        logging.info(f"Worker {os.getpid()} warmed up in {_report['total']} ms")
+
+def start(app_config, background=True):
+    """
+    Warm up this worker process once.
+
+    Args:
+        app_config: The Flask app configuration.
+        background: Run the warmup in a thread, so the worker can answer
+                    readiness probes meanwhile.
+    """
+    global _started
+    with _start_lock:
+        if _started:
+            return
+        _started = True
+
+    if background:
+        threading.Thread(target=_run, args=(app_config,), name="warmup", daemon=True).start()
+    else:
+        _run(app_config)
+
+def is_ready():
+    """Check whether this worker has finished its warmup."""
+    return _ready.is_set()
+
+def get_report():
+    """Get the duration of each warmup step, in milliseconds."""
+    return dict(_report)